@@ -1,8 +1,10 @@
-from typing import Optional, Sequence
+from typing import Sequence, Type
 
+from django.conf import settings
 from django.contrib import admin, messages
 from django.contrib.admin.models import LogEntry
-from django.contrib.contenttypes.models import ContentType
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
 from django.db import models
 from django.db.models import Field, Model
 from django.forms import Form, ValidationError
@@ -10,7 +12,9 @@ from django.http import HttpRequest
 from django.utils.translation import gettext as _
 
 from occupation.models import Tenant
-from occupation.utils import get_tenant_model
+from occupation.paginator import EstimatedCount, EstimatedCountPaginator
+from occupation.utils import get_active_tenant, get_tenant_field, get_tenant_fields, get_tenant_model
+from occupation.widgets import TenantSelect
 
 
 class TenantAdmin(admin.ModelAdmin):
@@ -21,24 +25,55 @@ if get_tenant_model() == Tenant:
     admin.site.register(Tenant, TenantAdmin)
 
 
-def patch_admin() -> None:
-    TenantModel = get_tenant_model()
+class TenantFormMixin:
+    """
+    Refuse to save a form for a model that belongs to a tenant, unless a tenant
+    is active: that is, the tenant the current request activated.
+    """
+
+    def clean(self):
+        cleaned_data = super().clean()  # type: ignore
+        if not get_active_tenant():
+            raise ValidationError(
+                _('You must activate a tenant before saving this model.'),
+            )
+        return cleaned_data
 
-    def get_tenant_field(model: type) -> Optional[Field]:
-        for field in model._meta.fields:  # type: ignore
-            if getattr(field, "related_model", None) == TenantModel:
-                return field
-        return None
 
-    _known_models_cache = {}
+def tenant_form(form: Type[Form]) -> Type[Form]:
+    "A subclass of this form class that includes the TenantFormMixin."
+    return type(form)(form.__name__, (TenantFormMixin, form), {"__module__": form.__module__})
 
-    def has_tenant_field(content_type: ContentType) -> bool:
-        if content_type not in _known_models_cache:
-            _known_models_cache[content_type] = get_tenant_field(content_type.model_class())
-        return bool(_known_models_cache[content_type])
 
+class EstimatedCountChangeList(ChangeList):
+    def get_results(self, request: HttpRequest) -> None:
+        "Estimate the total (unfiltered) count too, if it is large."
+        root_queryset = self.root_queryset
+        self.root_queryset = EstimatedCount(root_queryset)
+        try:
+            super().get_results(request)
+        finally:
+            self.root_queryset = root_queryset
+
+
+def patch_admin() -> None:
     class AutoTenantMixin:
         model: Model
+        form: Type[Form]
+
+        def __init__(self) -> None:
+            """
+            Build the tenant-aware form class once, rather than each time a
+            form is requested: Django's get_form() subclasses it per request.
+
+            Changelists of models that belong to a tenant only count the rows
+            when the planner expects there to be few of them.
+            """
+            super().__init__()
+            if get_tenant_field(self.model) and not issubclass(self.form, TenantFormMixin):
+                self.form = tenant_form(self.form)
+            if self.model._meta.label_lower in get_tenant_fields() and self.paginator is Paginator:
+                self.paginator = EstimatedCountPaginator
 
         def get_fields(self, request: HttpRequest, obj: Model = None) -> Sequence[Field]:
             """
@@ -57,14 +92,14 @@ def patch_admin() -> None:
         if not change:
             tenant_field = get_tenant_field(obj)
             if tenant_field:
-                setattr(obj, tenant_field.attname, request.session["active_tenant"])
+                setattr(obj, tenant_field.attname, request.tenant.pk)
         obj.save()
 
     admin.ModelAdmin.save_model = save_model
 
     def add_view(self, request: HttpRequest, form_url="", extra_context=None):
         tenant_field = get_tenant_field(self.model)
-        if request.method == "GET" and tenant_field and 'active_tenant' not in request.session:
+        if request.method == "GET" and tenant_field and getattr(request, "tenant", None) is None:
             self.message_user(
                 request,
                 _('You must activate a tenant before saving this model'),
@@ -74,25 +109,25 @@ def patch_admin() -> None:
 
     admin.ModelAdmin.add_view = add_view
 
-    _get_form = admin.ModelAdmin.get_form
+    _get_changelist = admin.ModelAdmin.get_changelist
 
-    def get_form(self, request: HttpRequest, obj: Model = None, change: bool = False, **kwargs):
-        form_class = _get_form(self, request, obj, change=change, **kwargs)
-        _clean = form_class.clean
-        tenant_field = get_tenant_field(self.model)
+    def get_changelist(self, request: HttpRequest, **kwargs):
+        changelist = _get_changelist(self, request, **kwargs)
+        if changelist is ChangeList and self.model._meta.label_lower in get_tenant_fields():
+            return EstimatedCountChangeList
+        return changelist
 
-        def clean(_self):
-            _clean(_self)
-            if tenant_field and 'active_tenant' not in request.session:
-                raise ValidationError(
-                    _('You must activate a tenant before saving this model.'),
-                )
+    admin.ModelAdmin.get_changelist = get_changelist
 
-        form_class.clean = clean
+    _media = admin.ModelAdmin.media
 
-        return form_class
+    def media(self):
+        "Load the tenant search widget's scripts with the page's own, so neither are loaded twice."
+        if settings.OCCUPATION_ADMIN_TENANT_SEARCH:
+            return _media.fget(self) + TenantSelect().media
+        return _media.fget(self)
 
-    admin.ModelAdmin.get_form = get_form
+    admin.ModelAdmin.media = property(media)
 
     if not getattr(LogEntry, "tenant_id", None):
         # Adding this value is delegated to a postgres trigger - that way it will always
@@ -110,7 +145,8 @@ def patch_admin() -> None:
 
     def get_admin_url_with_tenant(self):
         url = get_admin_url(self)
-        if self.tenant_id and url and has_tenant_field(self.content_type):
+        # A content type's natural key is the label of its model, so this doesn't need the model class.
+        if self.tenant_id and url and "{0.app_label}.{0.model}".format(self.content_type) in get_tenant_fields():
             return "{0}?__tenant={1}".format(url, self.tenant_id)
         return url
 
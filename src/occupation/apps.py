@@ -21,11 +21,16 @@ class OccupationConfig(AppConfig):
     name = "occupation"
 
     def ready(self) -> None:
-        # from . import receivers  # NOQA
         from django.db.backends.signals import connection_created
 
+        from . import receivers  # NOQA
+
         connection_created.connect(set_dummy_active_tenant)
 
+        from occupation.utils import get_tenant_fields
+
+        get_tenant_fields()
+
         from occupation.admin import patch_admin
 
         patch_admin()
@@ -150,6 +155,46 @@ def check_installed_before_admin(app_configs: AppConfigs = None, **kwargs) -> Me
     return []
 
 
+@register("settings")
+def check_activation_mode(app_configs: AppConfigs = None, **kwargs) -> Messages:
+    from django.conf import settings
+
+    from occupation.utils import ACTIVATION_MODES
+
+    if settings.OCCUPATION_ACTIVATION_MODE not in ACTIVATION_MODES:
+        return [
+            Error(
+                "Unknown OCCUPATION_ACTIVATION_MODE '{}'".format(settings.OCCUPATION_ACTIVATION_MODE),
+                hint="Choose one of: {}".format(", ".join(ACTIVATION_MODES)),
+                id="occupation.E006",
+            )
+        ]
+    return []
+
+
+@register("settings")
+def check_tenant_host_field(app_configs: AppConfigs = None, **kwargs) -> Messages:
+    from django.conf import settings
+    from django.core.exceptions import FieldDoesNotExist
+
+    from occupation.utils import get_tenant_model
+
+    field = settings.OCCUPATION_TENANT_HOST_FIELD
+
+    if field is not None:
+        model = get_tenant_model()
+        try:
+            model._meta.get_field(field)
+        except FieldDoesNotExist:
+            return [
+                Error(
+                    "OCCUPATION_TENANT_HOST_FIELD '{}' is not a field of {}".format(field, model._meta.label),
+                    id="occupation.E007",
+                )
+            ]
+    return []
+
+
 @register("settings")
 def check_database_role_does_not_bypass_rls(app_configs: AppConfigs = None, **kwargs) -> Messages:
     from django.conf import settings
@@ -172,4 +217,22 @@ def check_database_role_does_not_bypass_rls(app_configs: AppConfigs = None, **kw
 
 
 def set_dummy_active_tenant(sender, connection: ConnectionProxy, **kwargs) -> None:
-    connection.cursor().execute("SET occupation.active_tenant = ''")
+    from django.conf import settings
+
+    from occupation.utils import (
+        ACTIVE_TENANT,
+        IS_SUPERUSER,
+        USER_ID,
+        apply_config,
+        get_activation_state,
+        install_execute_wrapper,
+    )
+
+    # A new connection has none of our settings.
+    state = get_activation_state(connection)
+    state.applied = {}
+    state.uncommitted = {}
+    install_execute_wrapper(connection)
+
+    if settings.OCCUPATION_ACTIVATION_MODE == "eager":
+        apply_config({ACTIVE_TENANT: "", USER_ID: "", IS_SUPERUSER: ""}, connection=connection)
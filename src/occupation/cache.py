@@ -0,0 +1,150 @@
+"""
+:mod:`occupation.cache`
+
+Caching of the tenants that each user is able to see, so that switching tenant
+(and rendering the tenant selector) does not need to query the database. This is
+only enabled when ``OCCUPATION_CACHE`` names a cache.
+
+Tenant objects themselves may also be kept in a process-local LRU cache, when
+``OCCUPATION_TENANT_CACHE_SIZE`` is set, and each process keeps a map of host
+names to tenants when ``OCCUPATION_TENANT_HOST_FIELD`` is set.
+
+Entries are invalidated by the receivers in :mod:`occupation.receivers`.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import AbstractBaseUser
+from django.core.cache import BaseCache, caches
+
+from occupation.models import AbstractBaseTenant
+from occupation.utils import get_tenant_model
+
+VISIBLE_TENANTS_KEY = "occupation:visible_tenants:{}"
+
+VisibleTenants = Dict[int, str]
+
+
+def get_cache() -> Optional[BaseCache]:
+    if settings.OCCUPATION_CACHE is None:
+        return None
+    return caches[settings.OCCUPATION_CACHE]
+
+
+def get_visible_tenants(user: AbstractBaseUser) -> VisibleTenants:
+    "A mapping of tenant pk to name, for every tenant that this user may see."
+    cache = get_cache()
+    key = VISIBLE_TENANTS_KEY.format(user.pk)
+
+    if cache is not None:
+        visible_tenants = cache.get(key)
+        if visible_tenants is not None:
+            return visible_tenants
+
+    visible_tenants = dict(user.visible_tenants.values_list("pk", "name"))
+
+    if cache is not None:
+        cache.set(key, visible_tenants, settings.OCCUPATION_CACHE_TIMEOUT)
+
+    return visible_tenants
+
+
+def get_visible_tenant_name(user: AbstractBaseUser, tenant_id: int) -> Optional[str]:
+    "The name of the tenant, if this user may see it."
+    if get_cache() is None:
+        # Don't fetch every tenant when we would only use one of them.
+        return user.visible_tenants.filter(pk=tenant_id).values_list("name", flat=True).first()
+    return get_visible_tenants(user).get(tenant_id)
+
+
+def invalidate_visible_tenants(user_ids: Iterable[int]) -> None:
+    cache = get_cache()
+    if cache is not None:
+        cache.delete_many([VISIBLE_TENANTS_KEY.format(user_id) for user_id in user_ids])
+
+
+_tenants: "OrderedDict[Any, AbstractBaseTenant]" = OrderedDict()
+_tenants_lock = threading.Lock()
+
+
+def get_tenant(tenant_id: Any) -> Optional[AbstractBaseTenant]:
+    "Fetch a tenant, from the process-local cache if possible."
+    size = settings.OCCUPATION_TENANT_CACHE_SIZE
+    TenantModel = get_tenant_model()
+
+    if not size:
+        return TenantModel.objects.filter(pk=tenant_id).first()
+
+    tenant_id = TenantModel._meta.pk.to_python(tenant_id)
+
+    with _tenants_lock:
+        tenant = _tenants.get(tenant_id)
+        if tenant is not None:
+            _tenants.move_to_end(tenant_id)
+            # Callers are free to change their copy.
+            return copy.copy(tenant)
+
+    tenant = TenantModel.objects.filter(pk=tenant_id).first()
+
+    if tenant is not None:
+        with _tenants_lock:
+            _tenants[tenant_id] = copy.copy(tenant)
+            while len(_tenants) > size:
+                _tenants.popitem(last=False)
+
+    return tenant
+
+
+def invalidate_tenant(tenant_id: Any) -> None:
+    with _tenants_lock:
+        _tenants.pop(tenant_id, None)
+
+
+_host_map: Optional[Dict[str, Any]] = None
+_host_map_expires = 0.0
+_host_map_lock = threading.Lock()
+
+
+def get_host_map() -> Dict[str, Any]:
+    "A mapping of host name to the pk of the (active) tenant it belongs to."
+    global _host_map, _host_map_expires
+
+    with _host_map_lock:
+        if _host_map is not None and time.monotonic() < _host_map_expires:
+            return _host_map
+
+    field = settings.OCCUPATION_TENANT_HOST_FIELD
+    host_map = {
+        str(host).lower(): tenant_id
+        for host, tenant_id in get_tenant_model().objects.filter(is_active=True).values_list(field, "pk")
+        if host
+    }
+
+    with _host_map_lock:
+        _host_map = host_map
+        _host_map_expires = time.monotonic() + settings.OCCUPATION_TENANT_HOST_MAP_TTL
+
+    return host_map
+
+
+def get_host_tenant(host: str) -> Optional[Any]:
+    """
+    The pk of the tenant for this host: matching either the whole host
+    name, or the first part of it (the subdomain).
+    """
+    host_map = get_host_map()
+    host = host.lower()
+    if host in host_map:
+        return host_map[host]
+    return host_map.get(host.split(".", 1)[0])
+
+
+def invalidate_host_map() -> None:
+    global _host_map
+
+    with _host_map_lock:
+        _host_map = None
@@ -0,0 +1,174 @@
+"""
+:mod:`occupation.cloning`
+
+Copy every row that belongs to one tenant into another tenant, without the rows
+ever leaving the database.
+
+The source tenant's rows of each model are first copied into temporary tables
+(with the source tenant active, so the policies select them), along with a
+mapping from each row's primary key to a new one, taken from the table's
+sequence. With the target tenant active, the rows are then inserted with
+``INSERT ... SELECT``, replacing the tenant, and remapping the primary key and
+every FK to a cloned model through those mapping tables.
+
+Models are inserted after those that their policies refer to, as the policy on a
+model that is linked to the tenant through another model can only see its new
+rows once those they refer to exist. As every new key is
+known before any row is inserted, other FKs (which django creates as
+deferrable) may refer to rows that come later. Rows that must be unique
+regardless of tenant will cause the clone to fail (and be rolled back).
+"""
+from typing import Any, Dict, List, Optional, Sequence
+
+from django.db import connection, transaction
+from django.db.models import Field, UUIDField
+
+from occupation.utils import (
+    ACTIVE_TENANT,
+    IS_SUPERUSER,
+    Config,
+    ModelType,
+    TenantType,
+    config_statement,
+    db_column,
+    get_fk_chains,
+    get_row_level_security_models,
+    get_tenant_field,
+    get_tenant_model,
+)
+
+CURRENT_SETTINGS = "SELECT current_setting(%s, true), current_setting(%s, true)"
+SERIAL_SEQUENCE = "SELECT pg_get_serial_sequence(%s, %s)"
+COPY_SOURCE_ROWS = "CREATE TEMPORARY TABLE {rows} ON COMMIT DROP AS SELECT * FROM {table_name}"
+CREATE_KEY_MAP = """
+CREATE TEMPORARY TABLE {key_map} ON COMMIT DROP AS SELECT {pk} AS old_pk, {new_pk} AS new_pk FROM {rows}
+"""
+INDEX_KEY_MAP = "CREATE INDEX ON {key_map} (old_pk)"
+ANALYZE = "ANALYZE {table_name}"
+INSERT_ROWS = "INSERT INTO {table_name} ({columns}) SELECT {values} FROM {rows} AS source {joins}"
+TARGET_TENANT = "occupation_active_tenant()::{fk_type}"
+JOIN_KEY_MAP = "LEFT JOIN {key_map} AS {alias} ON ({alias}.old_pk = source.{column})"
+DROP_TABLE = "DROP TABLE IF EXISTS {table_name}"
+
+
+def policy_depth(model: ModelType, tenant_model: TenantType, seen: Sequence[ModelType] = ()) -> int:
+    "How many tables the policy on this model depends upon, one after another."
+    related_models = [
+        chain[0].related_model
+        for chain in get_fk_chains(model, tenant_model)
+        if chain[0].related_model is not tenant_model and chain[0].related_model not in seen
+    ]
+    return max([0] + [1 + policy_depth(related, tenant_model, [*seen, model]) for related in related_models])
+
+
+def get_clone_models(models: Optional[Sequence[ModelType]] = None) -> List[ModelType]:
+    "The models (with row level security) that hold tables of tenant data, each after those its policy refers to."
+    tenant_model = get_tenant_model()
+    clone_models = [model for model in get_row_level_security_models() if not model._meta.proxy]
+    if models is not None:
+        clone_models = [model for model in clone_models if model in models]
+    # Multi-table inheritance children share their parent's primary keys.
+    return sorted(
+        clone_models,
+        key=lambda model: (policy_depth(model, tenant_model), len(model._meta.get_parent_list())),
+    )
+
+
+def new_pk(cursor, model: ModelType) -> str:
+    "The expression to get a new primary key for a row of this model."
+    pk = model._meta.pk
+    cursor.execute(SERIAL_SEQUENCE, [model._meta.db_table, db_column(pk)])
+    sequence = cursor.fetchone()[0]
+
+    if sequence:
+        return "nextval('{}')".format(sequence)
+    if isinstance(pk, UUIDField):
+        return "gen_random_uuid()"
+
+    raise ValueError("Unable to create new primary keys for {}".format(model._meta.label))
+
+
+def column_value(field: Field, key_maps: Dict[ModelType, str], joins: List[str]) -> str:
+    "The value of this column in the clone of a row."
+    column = db_column(field)
+    model = field.model
+
+    if field is get_tenant_field(model):
+        return TARGET_TENANT.format(fk_type=field.target_field.rel_db_type(connection))
+
+    if field.primary_key and not field.is_relation:
+        key_map = key_maps[model]
+    elif field.related_model in key_maps and field.target_field == field.related_model._meta.pk:
+        key_map = key_maps[field.related_model]
+    else:
+        return "source.{}".format(column)
+
+    alias = "map_{}".format(len(joins))
+    joins.append(JOIN_KEY_MAP.format(key_map=key_map, alias=alias, column=column))
+    # Anything referred to that was not cloned is left as it was.
+    return "COALESCE({alias}.new_pk, source.{column})".format(alias=alias, column=column)
+
+
+def set_tenant(cursor, tenant: Any) -> None:
+    "Activate this tenant until the end of the transaction: as a superuser, every tenant's rows would be cloned."
+    cursor.execute(*config_statement({ACTIVE_TENANT: str(tenant), IS_SUPERUSER: ""}, local=True))
+
+
+def clone_tenant(source: Any, target: Any, models: Optional[Sequence[ModelType]] = None) -> Dict[str, int]:
+    """
+    Clone the rows of these (or every) model with row level security, from the
+    source tenant to the target tenant, returning how many rows of each model
+    were cloned.
+    """
+    clone_models = get_clone_models(models)
+    rows: Dict[ModelType, str] = {}
+    key_maps: Dict[ModelType, str] = {}
+    cloned = {}
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(CURRENT_SETTINGS, [ACTIVE_TENANT, IS_SUPERUSER])
+        active_tenant, is_superuser = cursor.fetchone()
+        set_tenant(cursor, source)
+
+        for i, model in enumerate(clone_models):
+            rows[model] = "occupation_clone_{}".format(i)
+            cursor.execute(COPY_SOURCE_ROWS.format(rows=rows[model], table_name=model._meta.db_table))
+
+            pk = model._meta.pk
+            if pk.related_model in key_maps:
+                key_maps[model] = key_maps[pk.related_model]
+                continue
+
+            key_maps[model] = "occupation_clone_map_{}".format(i)
+            cursor.execute(
+                CREATE_KEY_MAP.format(
+                    key_map=key_maps[model], pk=db_column(pk), new_pk=new_pk(cursor, model), rows=rows[model]
+                )
+            )
+            cursor.execute(INDEX_KEY_MAP.format(key_map=key_maps[model]))
+            cursor.execute(ANALYZE.format(table_name=key_maps[model]))
+
+        set_tenant(cursor, target)
+
+        for model in clone_models:
+            fields = [field for field in model._meta.local_concrete_fields if not getattr(field, "generated", False)]
+            joins: List[str] = []
+            values = [column_value(field, key_maps, joins) for field in fields]
+            cursor.execute(
+                INSERT_ROWS.format(
+                    table_name=model._meta.db_table,
+                    columns=", ".join(db_column(field) for field in fields),
+                    values=", ".join(values),
+                    rows=rows[model],
+                    joins=" ".join(joins),
+                )
+            )
+            cloned[model._meta.label] = cursor.rowcount
+
+        # This may be part of a larger transaction, which should carry on as it was.
+        for table_name in [*rows.values(), *set(key_maps.values())]:
+            cursor.execute(DROP_TABLE.format(table_name=table_name))
+        settings: Config = {ACTIVE_TENANT: active_tenant or "", IS_SUPERUSER: is_superuser or ""}
+        cursor.execute(*config_statement(settings, local=True))
+
+    return cloned
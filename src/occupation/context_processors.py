@@ -1,12 +1,58 @@
+from typing import Any, List, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import AbstractBaseUser
 from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject, cached_property
+
+from occupation.cache import get_cache, get_visible_tenants
+from occupation.models import AbstractBaseTenant
+
+
+class VisibleTenants:
+    """
+    The tenants that a user may see, fetched with a single query the first time
+    that either the tenants or the choices are used.
+
+    When a cache is configured, the choices are read from that instead, and the
+    tenants themselves are only fetched if they are needed.
+    """
+
+    def __init__(self, user: AbstractBaseUser) -> None:
+        self.user = user
+        self.limit = settings.OCCUPATION_TENANT_CHOICES_LIMIT
+
+    @cached_property
+    def tenants(self) -> List[AbstractBaseTenant]:
+        queryset = self.user.visible_tenants.order_by("name")
+        if self.limit is not None:
+            queryset = queryset[: self.limit]
+        return list(queryset)
+
+    @cached_property
+    def choices(self) -> List[Tuple[Any, str]]:
+        if "tenants" in self.__dict__ or get_cache() is None:
+            return [(tenant.pk, tenant.name) for tenant in self.tenants]
+        choices = sorted(get_visible_tenants(self.user).items(), key=lambda choice: choice[1])
+        return choices if self.limit is None else choices[: self.limit]
 
 
 def tenants(request: HttpRequest) -> dict:
     if request.user.is_anonymous:
         return {}
 
+    # Share the one instance between every template rendered in this request.
+    if not hasattr(request, "_visible_tenants"):
+        request._visible_tenants = VisibleTenants(request.user)
+    visible_tenants = request._visible_tenants
+
+    tenant = getattr(request, "tenant", None)
+
     return {
-        "active_tenant": request.session.get("active_tenant"),
-        "tenant_choices": request.user.visible_tenants.values_list("pk", "name"),
-        "visible_tenants": request.user.visible_tenants.all(),
+        # Don't evaluate the (lazy) tenant just to test its truth.
+        "active_tenant": tenant.pk if tenant is not None else None,
+        "tenant": tenant,
+        "tenant_choices": SimpleLazyObject(lambda: visible_tenants.choices),
+        "visible_tenants": SimpleLazyObject(lambda: visible_tenants.tenants),
+        "tenant_search": settings.OCCUPATION_ADMIN_TENANT_SEARCH,
     }
@@ -0,0 +1,53 @@
+"""
+:mod:`occupation.management.commands.clone_tenant`
+
+Copy the rows of every model with row level security (or just those named) from
+one tenant to another, inside the database: see :mod:`occupation.cloning`.
+"""
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from occupation.cloning import clone_tenant
+from occupation.utils import get_tenant_model
+
+
+class Command(BaseCommand):
+    help = "Copy the rows of one tenant into another tenant."
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="The tenant to copy rows from")
+        parser.add_argument("target", help="The tenant to copy rows into")
+        parser.add_argument(
+            "labels",
+            nargs="*",
+            metavar="app_label.ModelName",
+            help="Only clone these models",
+        )
+
+    def handle(self, *args, **options):
+        tenant_model = get_tenant_model()
+
+        try:
+            source, target = (tenant_model._meta.pk.to_python(options[name]) for name in ("source", "target"))
+        except ValidationError as exc:
+            raise CommandError("; ".join(exc.messages))
+
+        for tenant in (source, target):
+            if not tenant_model.objects.filter(pk=tenant).exists():
+                raise CommandError("Tenant {} does not exist.".format(tenant))
+
+        try:
+            models = [apps.get_model(label) for label in options["labels"]] or None
+        except (LookupError, ValueError) as exc:
+            raise CommandError(str(exc))
+
+        try:
+            cloned = clone_tenant(source, target, models)
+        except (DatabaseError, ValueError) as exc:
+            raise CommandError("Unable to clone tenant {}: {}".format(source, exc))
+
+        if options["verbosity"] >= 1:
+            for label, count in cloned.items():
+                self.stdout.write("Cloned %d row(s) of %s" % (count, label))
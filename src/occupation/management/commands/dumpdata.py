@@ -0,0 +1,147 @@
+"""
+:mod:`occupation.management.commands.dumpdata`
+
+This replaces the ``dumpdata`` command with one that takes new options:
+``--tenant``, which may be given more than once, and ``--all-tenants``. Each
+tenant will be "active" when dumping its data, so only that tenant's rows are
+included. Without any app labels, every model with row level security is dumped.
+
+Django already fetches the objects using server-side cursors, and serializes
+them as they are fetched. With ``--copy``, the tables are streamed using
+``COPY ... TO STDOUT`` instead, in the same text format that ``pg_dump`` (and
+``psql``) use: this skips creating model instances altogether.
+
+When dumping more than one tenant, ``--output`` must contain ``{tenant}``, and
+each tenant is written to its own file.
+"""
+import io
+from typing import Any, Dict, List
+
+from django.core.management.base import CommandError, OutputWrapper
+from django.core.management.commands import dumpdata
+from django.db import connections, transaction
+
+from occupation.utils import ModelType, activate_tenant, get_active_tenant_ids, get_row_level_security_models
+
+COPY_HEADER = "COPY {table} ({columns}) FROM stdin;\n"
+COPY_TO = "COPY (SELECT {columns} FROM {table}) TO STDOUT"
+COPY_FOOTER = "\\.\n\n"
+
+
+class CopyWriter(io.TextIOBase):
+    "Write the data a COPY streams out as text, to a file or the command's output."
+
+    def __init__(self, stream: Any) -> None:
+        self.stream = stream
+
+    def write(self, data: Any) -> int:
+        if isinstance(data, (bytes, memoryview)):
+            data = bytes(data).decode("utf-8")
+        if isinstance(self.stream, OutputWrapper):
+            self.stream.write(data, ending="")
+        else:
+            self.stream.write(data)
+        return len(data)
+
+
+def copy_to(cursor: Any, sql: str, stream: CopyWriter) -> None:
+    raw = cursor.cursor
+    # psycopg2
+    if hasattr(raw, "copy_expert"):
+        raw.copy_expert(sql, stream)
+        return
+    # psycopg (3)
+    with raw.copy(sql) as copy:
+        for data in copy:
+            stream.write(data)
+
+
+class Command(dumpdata.Command):
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--tenant",
+            action="append",
+            dest="tenants",
+            help="Specify which tenant should be active: may be given more than once",
+        )
+        parser.add_argument(
+            "--all-tenants",
+            action="store_true",
+            dest="all_tenants",
+            help="Dump every active tenant",
+        )
+        parser.add_argument(
+            "--copy",
+            action="store_true",
+            dest="copy",
+            help="Stream the tables using COPY, rather than serializing objects",
+        )
+
+    def get_models(self, app_labels: List[str], using: str) -> List[ModelType]:
+        models = get_row_level_security_models(connections[using])
+
+        if app_labels:
+            labels = {label.lower() for label in app_labels}
+            models = [
+                model for model in models if model._meta.app_label in labels or model._meta.label_lower in labels
+            ]
+
+        return models
+
+    def copy(self, models: List[ModelType], output: str, using: str) -> None:
+        connection = connections[using]
+        stream = open(output, "w", encoding="utf-8") if output else self.stdout
+        writer = CopyWriter(stream)
+
+        try:
+            with transaction.atomic(using=using), connection.cursor() as cursor:
+                # The tenant is applied with the first query: COPY doesn't pass through Django.
+                cursor.execute("SELECT 1")
+                for model in models:
+                    # Inherited columns are in the parent's table, and generated ones can't be loaded.
+                    fields = [
+                        field for field in model._meta.local_concrete_fields if not getattr(field, "generated", False)
+                    ]
+                    data = {
+                        "table": connection.ops.quote_name(model._meta.db_table),
+                        "columns": ", ".join(connection.ops.quote_name(field.column) for field in fields),
+                    }
+                    writer.write(COPY_HEADER.format(**data))
+                    copy_to(cursor, COPY_TO.format(**data), writer)
+                    writer.write(COPY_FOOTER)
+        finally:
+            if output:
+                stream.close()
+
+    def dump_tenant(self, tenant: str, app_labels: List[str], options: Dict[str, Any]) -> None:
+        output = options["output"] and options["output"].format(tenant=tenant)
+
+        connection = connections[options["database"]]
+
+        activate_tenant(tenant, connection=connection)
+        try:
+            models = self.get_models(app_labels, options["database"])
+            if not models:
+                raise CommandError("There are no models with row level security to dump.")
+            if options["copy"]:
+                self.copy(models, output, options["database"])
+            else:
+                with transaction.atomic(using=options["database"]):
+                    super().handle(*[model._meta.label for model in models], **{**options, "output": output})
+        finally:
+            activate_tenant("", connection=connection)
+
+    def handle(self, *app_labels, **options):
+        tenants = get_active_tenant_ids() if options["all_tenants"] else options["tenants"] or []
+
+        if not tenants:
+            if options["copy"]:
+                raise CommandError("--copy needs a tenant.")
+            return super().handle(*app_labels, **options)
+
+        if len(tenants) > 1 and "{tenant}" not in (options["output"] or ""):
+            raise CommandError("Dumping more than one tenant needs an --output containing '{tenant}'.")
+
+        for tenant in tenants:
+            self.dump_tenant(tenant, list(app_labels), options)
@@ -1,34 +1,253 @@
 """
 :mod:`occupation.management.commands.loaddata`
 
-This replaces the ``loaddata`` command with one that takes a new
-option: ``--tenant``. This tenant will be "active" when executing the
-query, and RLS should apply to that.
+This replaces the ``loaddata`` command with one that takes new options:
+``--tenant``, which may be given more than once, and ``--all-tenants``. Each
+tenant will be "active" when executing the queries that load the fixtures into
+it, and RLS should apply to that.
+
+The fixtures are only read (and parsed, for JSON) once, however many tenants
+they are loaded into. With ``--jobs``, the tenants are loaded by that many
+worker processes, each with its own connection.
+
+As each tenant can only see its own rows, sequences are not reset after loading
+into each tenant (which would move them back to the highest key that tenant can
+see), but once they all have been loaded, and then only ever forwards.
 """
+import json
+import multiprocessing
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import django
+from django.apps import apps
+from django.core import serializers
+from django.core.management.base import CommandError
 from django.core.management.commands import loaddata
+from django.core.management.utils import parse_apps_and_model_labels
+from django.db import connections, transaction
+
+from occupation.utils import ModelType, activate_tenant, db_column, get_active_tenant_ids
+
+# Formats whose deserializers parse the text into python objects first: we can do that once.
+PARSERS = {
+    "json": json.loads,
+    "jsonl": lambda data: [json.loads(line) for line in data.splitlines() if line.strip()],
+}
+
+# The options that a worker process needs to load fixtures.
+WORKER_OPTIONS = ("ignore", "database", "app_label", "exclude", "format")
+
+# Only ever move a sequence forwards, past the highest key the active tenant can see.
+RESET_SEQUENCE = """
+SELECT setval(%s, MAX({pk})) FROM {table_name}
+HAVING MAX({pk}) > COALESCE(pg_sequence_last_value(%s::regclass), 0)
+"""
+SERIAL_SEQUENCE = "SELECT pg_get_serial_sequence(%s, %s)"
+
+Fixture = Tuple[str, str, Any]
+Loaded = Tuple[str, int, List[str]]
+
+_worker: Optional["Command"] = None
+
 
-from occupation.utils import activate_tenant
+def init_worker(options: Dict[str, Any], fixtures: Dict[str, List[Fixture]]) -> None:
+    global _worker
+
+    # Processes that were spawned, rather than forked, need to set up django.
+    if not apps.ready:
+        django.setup()
+
+    _worker = Command()
+    _worker.configure({**options, "verbosity": 0})
+    _worker.fixtures = fixtures
+
+
+def load_tenant(tenant: str) -> Loaded:
+    count = _worker.load_tenant(tenant)  # type: ignore
+    return tenant, count, [model._meta.label for model in _worker.models]  # type: ignore
+
+
+def sequence_models(models: Iterable[ModelType]) -> List[ModelType]:
+    "These models, and the many to many tables they create, as loaddata would reset the sequences of."
+    tables = []
+    for model in models:
+        tables.append(model)
+        for field in model._meta.local_many_to_many:
+            if field.remote_field.through._meta.auto_created:
+                tables.append(field.remote_field.through)
+    return tables
+
+
+def advance_sequences(connection, models: Iterable[ModelType]) -> None:
+    "Move the sequences of these models past the highest keys that the active tenant can see."
+    with connection.cursor() as cursor:
+        for model in sequence_models(models):
+            pk = model._meta.pk
+            if pk.is_relation:
+                continue
+            cursor.execute(SERIAL_SEQUENCE, [model._meta.db_table, db_column(pk)])
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                table_name = connection.ops.quote_name(model._meta.db_table)
+                pk_column = connection.ops.quote_name(db_column(pk))
+                cursor.execute(RESET_SEQUENCE.format(pk=pk_column, table_name=table_name), [sequence, sequence])
 
 
 class Command(loaddata.Command):
+    fixtures: Optional[Dict[str, List[Fixture]]] = None
+
     def add_arguments(self, parser):
         super().add_arguments(parser)
         parser.add_argument(
             "--tenant",
+            action="append",
+            dest="tenants",
+            help="Specify which tenant should be active: may be given more than once",
+        )
+        parser.add_argument(
+            "--all-tenants",
+            action="store_true",
+            dest="all_tenants",
+            help="Load the fixtures into every active tenant",
+        )
+        parser.add_argument(
+            "--jobs",
             action="store",
-            dest="tenant",
-            help="Specify which tenant should be active",
+            type=int,
+            default=1,
+            dest="jobs",
+            help="Load into this many tenants at once",
         )
 
+    def configure(self, options: Dict[str, Any]) -> None:
+        "Set up as loaddata.Command.handle() would."
+        self.ignore = options["ignore"]
+        self.using = options["database"]
+        self.app_label = options["app_label"]
+        self.verbosity = options["verbosity"]
+        self.excluded_models, self.excluded_apps = parse_apps_and_model_labels(options["exclude"])
+        self.format = options["format"]
+        self.serialization_formats = serializers.get_public_serializer_formats()
+
+    def get_tenants(self, options: Dict[str, Any]) -> List[str]:
+        if options["all_tenants"]:
+            return get_active_tenant_ids()
+        tenants = options["tenants"]
+        # call_command(..., tenant=...) passes a single tenant, rather than a list.
+        if tenants is not None and not isinstance(tenants, (list, tuple)):
+            tenants = [tenants]
+        return list(tenants or [])
+
+    def read_fixtures(self, fixture_labels: Tuple[str, ...]) -> Dict[str, List[Fixture]]:
+        "Read (and where possible, parse) each fixture once, to load into every tenant."
+        fixtures: Dict[str, List[Fixture]] = {}
+
+        for fixture_label in fixture_labels:
+            fixtures[fixture_label] = []
+            for fixture_file, _fixture_dir, fixture_name in self.find_fixtures(fixture_label):
+                _name, ser_fmt, cmp_fmt = self.parse_name(os.path.basename(fixture_file))
+                open_method, mode = self.compression_formats[cmp_fmt]
+                fixture = open_method(fixture_file, mode)
+                try:
+                    data = fixture.read()
+                finally:
+                    fixture.close()
+                if ser_fmt in PARSERS:
+                    try:
+                        data, ser_fmt = PARSERS[ser_fmt](data), "python"
+                    except ValueError as exc:
+                        raise CommandError("Problem installing fixture '%s': %s" % (fixture_file, exc))
+                fixtures[fixture_label].append((fixture_name, ser_fmt, data))
+
+        return fixtures
+
+    def load_label(self, fixture_label: str) -> None:
+        if self.fixtures is None:
+            return super().load_label(fixture_label)
+
+        for fixture_name, ser_fmt, data in self.fixtures[fixture_label]:
+            self.fixture_count += 1
+            objects = serializers.deserialize(
+                ser_fmt,
+                data,
+                using=self.using,
+                ignorenonexistent=self.ignore,
+                handle_forward_references=True,
+            )
+            try:
+                for obj in objects:
+                    self.fixture_object_count += 1
+                    if self.save_obj(obj):
+                        self.loaded_object_count += 1
+            except Exception as exc:
+                if not isinstance(exc, CommandError):
+                    exc.args = ("Problem installing fixture '%s': %s" % (fixture_name, exc),)
+                raise
+
+    def reset_sequences(self, connection, models):
+        # Loading into tenants resets them all at once, in advance_sequences().
+        if self.fixtures is None:
+            super().reset_sequences(connection, models)
+
+    def load_tenant(self, tenant: str) -> int:
+        "Load the (already read) fixtures with this tenant active, returning how many objects were loaded."
+        connection = connections[self.using]
+        activate_tenant(tenant, connection=connection)
+        try:
+            with transaction.atomic(using=self.using):
+                self.loaddata(list(self.fixtures or {}))
+        finally:
+            activate_tenant("", connection=connection)
+        return self.loaded_object_count
+
+    def advance_sequences(self, results: List[Loaded]) -> None:
+        "Once every tenant has been loaded, move the sequences past the keys in each of them."
+        connection = connections[self.using]
+        try:
+            for tenant, _count, labels in results:
+                activate_tenant(tenant, connection=connection)
+                advance_sequences(connection, [apps.get_model(label) for label in labels])
+        finally:
+            activate_tenant("", connection=connection)
+
+    def load_in_parallel(self, tenants: List[str], jobs: int, options: Dict[str, Any]) -> List[Loaded]:
+        # Each worker must open its own connection, rather than share ours.
+        connections.close_all()
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        worker_options = {key: options[key] for key in WORKER_OPTIONS}
+
+        pool = context.Pool(min(jobs, len(tenants)), init_worker, (worker_options, self.fixtures))
+        try:
+            return pool.map(load_tenant, tenants)
+        finally:
+            pool.close()
+            pool.join()
+
     def handle(self, *fixture_labels, **options):
-        tenant = options.get("tenant")
-        if tenant:
-            activate_tenant(tenant)
+        tenants = self.get_tenants(options)
+
+        if not tenants:
+            return super().handle(*fixture_labels, **options)
+
+        self.configure(options)
+        self.fixtures = self.read_fixtures(fixture_labels)
+
+        # Report once per tenant, rather than for each time we load the fixtures.
+        verbosity, self.verbosity = self.verbosity, 0
+
+        if options["jobs"] > 1 and len(tenants) > 1:
+            results = self.load_in_parallel(tenants, options["jobs"], options)
+        else:
+            results = []
+            for tenant in tenants:
+                count = self.load_tenant(tenant)
+                results.append((tenant, count, [model._meta.label for model in self.models]))
 
-        # We should wrap this in a try/except, and present a reasonable
-        # error message if we think we tried to load data without a schema
-        # that required one.
-        super().handle(*fixture_labels, **options)
+        self.advance_sequences(results)
 
-        if tenant:
-            activate_tenant("")
+        if verbosity >= 1:
+            for tenant, count, _labels in results:
+                self.stdout.write("Installed %d object(s) into tenant %s" % (count, tenant))
@@ -0,0 +1,173 @@
+"""
+:mod:`occupation.management.commands.occupation_explain`
+
+Show what the row level security policy on each model costs, by running
+``EXPLAIN (ANALYZE, BUFFERS)`` on a query for all of its rows, with a tenant
+active, and again with the policy bypassed, selecting the same rows by filtering
+on the tenant through the model's FKs.
+
+The policy is bypassed by (temporarily) no longer forcing row level security on
+the tables, so the database user must own them: this takes a lock on each table,
+until the transaction that each model is explained in is rolled back.
+"""
+import json
+from typing import Any, Dict, Iterator, List, Optional
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+from django.db.models import QuerySet
+
+from occupation.utils import (
+    NO_FORCE_RLS,
+    ModelType,
+    activate_tenant,
+    explain_json,
+    get_fk_chain,
+    get_row_level_security_models,
+    get_tenant_model,
+)
+
+EXPLAIN = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+
+
+def get_nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from get_nodes(child)
+
+
+def explain(model: ModelType, queryset: Optional[QuerySet] = None) -> Dict[str, Any]:
+    "Summarise the plan of a query for every (visible) row of this model, or of this queryset."
+    if queryset is None:
+        queryset = model._base_manager.all()
+    sql, params = queryset.query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        result = explain_json(cursor, EXPLAIN, sql, params)
+
+    nodes = list(get_nodes(result[0]["Plan"]))
+
+    return {
+        "cost": nodes[0]["Total Cost"],
+        "planning_time": result[0]["Planning Time"],
+        "execution_time": result[0]["Execution Time"],
+        "rows": nodes[0]["Actual Rows"],
+        "rows_filtered": sum(node.get("Rows Removed by Filter", 0) for node in nodes),
+        "buffers": sum(node.get("Shared Hit Blocks", 0) + node.get("Shared Read Blocks", 0) for node in nodes),
+        "index_used": any("Index" in node["Node Type"] for node in nodes),
+        "nodes": [node["Node Type"] for node in nodes],
+    }
+
+
+def explain_without_policy(model: ModelType, tenant: str) -> Optional[Dict[str, Any]]:
+    """
+    The same, as the owner of the tables, when row level security is not forced,
+    but the tenant's rows are selected by following the FKs to the tenant.
+    """
+    chain = get_fk_chain(model, get_tenant_model())
+    queryset = model._base_manager.filter(**{"__".join(field.name for field in chain): tenant})
+    tables = [model._meta.db_table] + [field.related_model._meta.db_table for field in chain[:-1]]
+
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for table_name in tables:
+                    cursor.execute(NO_FORCE_RLS.format(table_name=table_name))
+            result = explain(model, queryset)
+            transaction.set_rollback(True)
+            return result
+    except DatabaseError:
+        return None
+
+
+def analyze(model: ModelType, tenant: str) -> Dict[str, Any]:
+    policy = explain(model)
+    baseline = explain_without_policy(model, tenant)
+
+    return {
+        "model": model._meta.label,
+        "table": model._meta.db_table,
+        "depth": len(get_fk_chain(model, get_tenant_model())),
+        "policy": policy,
+        "baseline": baseline,
+        "overhead": {
+            "cost": policy["cost"] - baseline["cost"],
+            "execution_time": policy["execution_time"] - baseline["execution_time"],
+        }
+        if baseline
+        else None,
+    }
+
+
+class Command(BaseCommand):
+    help = "Show the cost of the row level security policy on each model, with a tenant active."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "args",
+            nargs="*",
+            metavar="app_label.ModelName",
+            help="Only explain these models",
+        )
+        parser.add_argument(
+            "--tenant",
+            action="store",
+            dest="tenant",
+            required=True,
+            help="Specify which tenant should be active",
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            dest="json",
+            help="Output JSON, rather than text",
+        )
+
+    def get_models(self, labels: List[str]) -> List[ModelType]:
+        models = get_row_level_security_models()
+
+        if labels:
+            try:
+                selected = [apps.get_model(label) for label in labels]
+            except (LookupError, ValueError) as exc:
+                raise CommandError(str(exc))
+            models = [model for model in selected if model in models]
+
+        return models
+
+    def handle(self, *labels, **options):
+        results = []
+
+        activate_tenant(options["tenant"])
+        try:
+            # Each in a transaction of its own, so that the tables are not all locked at once.
+            for model in self.get_models(labels):
+                with transaction.atomic():
+                    results.append(analyze(model, options["tenant"]))
+                    transaction.set_rollback(True)
+        finally:
+            activate_tenant("")
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for result in results:
+            self.stdout.write(
+                "{model} ({table}): {depth} FK(s) to the tenant, index {used}".format(
+                    used="used" if result["policy"]["index_used"] else "not used", **result
+                )
+            )
+            for name in ("policy", "baseline"):
+                if result[name]:
+                    self.stdout.write(
+                        "  {name:<8}  cost {cost:>10.2f}  {execution_time:>8.3f}ms  {rows:>8} rows  "
+                        "{rows_filtered:>8} filtered  {buffers:>6} buffers  {plan}".format(
+                            name=name, plan=" > ".join(result[name]["nodes"]), **result[name]
+                        )
+                    )
+            if result["overhead"]:
+                self.stdout.write(
+                    "  overhead  cost {cost:>10.2f}  {execution_time:>8.3f}ms".format(**result["overhead"])
+                )
@@ -1,31 +1,160 @@
-from typing import Callable
+from typing import Any, Callable, Optional, Tuple
 
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.sessions.backends.base import SessionBase as Session
-from django.db import connection
-from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http.request import split_domain_port
 from django.shortcuts import redirect
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext as _
 
+from occupation.cache import get_host_tenant, get_tenant, get_visible_tenant_name
 from occupation.exceptions import Forbidden
-from occupation.models import AbstractBaseTenant
 from occupation.signals import session_tenant_changed
-from occupation.utils import activate_tenant, get_tenant_model
+from occupation.utils import aactivate_tenant, activate_tenant, get_tenant_model
 
 TENANT_CHANGED = _("Tenant changed to %(active_tenant)s")
 TENANT_CLEARED = _("Tenant deselected")
 UNABLE_TO_CHANGE_TENANT = _("You may not select that tenant")
 
+TENANT_TOKEN_SALT = "occupation.middleware.tenant-token"
+
+TENANT_SEARCH_PATH = "/__search_tenants__/"
+
 Tenant = get_tenant_model()
 
 
+class LazyTenant(SimpleLazyObject):
+    """
+    The active tenant, which is only fetched (at most once) when something other
+    than its pk is used.
+    """
+
+    def __init__(self, tenant_id: Any) -> None:
+        self.__dict__["_tenant_id"] = tenant_id
+        super().__init__(lambda: get_tenant(tenant_id))
+
+    @property
+    def pk(self) -> Any:
+        return self.__dict__["_tenant_id"]
+
+
+def attach_tenant(request: HttpRequest, tenant_id: Any) -> None:
+    request.tenant = LazyTenant(tenant_id) if tenant_id else None
+
+
 def clear_tenant(session: Session) -> None:
     session.pop("active_tenant", None)
     session.pop("active_tenant_name", None)
 
 
-def set_tenant(session: Session, tenant: AbstractBaseTenant) -> None:
-    session.update({"active_tenant": tenant.pk, "active_tenant_name": tenant.name})
+def set_tenant(session: Session, tenant_id: int, name: str) -> None:
+    session.update({"active_tenant": tenant_id, "active_tenant_name": name})
+
+
+def check_visible_tenant(user: AbstractBaseUser, tenant: str) -> Tuple[Any, str]:
+    """
+    Ensure that this user may see this tenant, returning the tenant's
+    pk and name.
+    """
+    try:
+        tenant_id = Tenant._meta.pk.to_python(tenant)
+    except ValidationError:
+        raise Forbidden()
+
+    name = get_visible_tenant_name(user, tenant_id)
+    if name is None:
+        raise Forbidden()
+
+    return tenant_id, name
+
+
+def make_tenant_token(user: AbstractBaseUser, tenant_id: Any) -> str:
+    """
+    A signed token that selects this tenant for this user, for a single
+    request, when sent in the ``OCCUPATION_TENANT_TOKEN_HEADER``.
+    """
+    return signing.dumps([str(user.pk), str(tenant_id)], salt=TENANT_TOKEN_SALT)
+
+
+def read_tenant_token(user: AbstractBaseUser, token: str) -> Any:
+    try:
+        user_id, tenant_id = signing.loads(
+            token,
+            salt=TENANT_TOKEN_SALT,
+            max_age=settings.OCCUPATION_TENANT_TOKEN_MAX_AGE,
+        )
+    except (signing.BadSignature, ValueError):
+        raise Forbidden()
+
+    if not user.is_authenticated or str(user.pk) != user_id:
+        raise Forbidden()
+
+    try:
+        return Tenant._meta.pk.to_python(tenant_id)
+    except ValidationError:
+        raise Forbidden()
+
+
+def stateless_tenant_requested(request: HttpRequest) -> bool:
+    return settings.OCCUPATION_TENANT_HOST_FIELD is not None or any(
+        header and header in request.META
+        for header in (settings.OCCUPATION_TENANT_TOKEN_HEADER, settings.OCCUPATION_TENANT_HEADER)
+    )
+
+
+def select_host_tenant(request: HttpRequest) -> None:
+    """
+    Select the tenant that this request's host belongs to, for this request only.
+
+    Requests to a host without a tenant, or from anonymous users, have no tenant.
+    """
+    host, _port = split_domain_port(request.get_host())
+    tenant_id = get_host_tenant(host)
+
+    if tenant_id is None or not request.user.is_authenticated:
+        request.stateless_tenant = ""
+        return
+
+    if get_visible_tenant_name(request.user, tenant_id) is None:
+        raise Forbidden()
+
+    request.stateless_tenant = tenant_id
+
+
+def select_stateless_tenant(request: HttpRequest) -> None:
+    """
+    Select the tenant from a request header (or the host), for this request only.
+
+    The tenant is stored on the request, rather than in the session, and the
+    session is not used at all, so API clients need not load or save one.
+    """
+    token_header = settings.OCCUPATION_TENANT_TOKEN_HEADER
+    header = settings.OCCUPATION_TENANT_HEADER
+
+    if token_header and token_header in request.META:
+        request.stateless_tenant = read_tenant_token(request.user, request.META[token_header])
+        return
+
+    if not header or header not in request.META:
+        select_host_tenant(request)
+        return
+
+    tenant = request.META[header]
+
+    if not tenant:
+        request.stateless_tenant = ""
+        return
+
+    if not request.user.is_authenticated:
+        raise Forbidden()
+
+    request.stateless_tenant, _name = check_visible_tenant(request.user, tenant)
 
 
 def select_tenant(request: HttpRequest, tenant: str) -> None:
@@ -53,49 +182,151 @@ def select_tenant(request: HttpRequest, tenant: str) -> None:
     if tenant == str(session.get("active_tenant")):
         return
 
-    # Can this user view this tenant?
+    tenant_id, name = check_visible_tenant(user, tenant)
+    set_tenant(session, tenant_id, name)
+    # Only fetch the tenant if a receiver actually uses it.
+    tenant_instance = LazyTenant(tenant_id)
+    session_tenant_changed.send(sender=request, tenant=tenant_instance, user=user, session=session)
+
+
+def tenant_change_requested(request: HttpRequest) -> bool:
+    return (
+        stateless_tenant_requested(request)
+        or request.path.startswith("/__change_tenant__/")
+        or request.GET.get("__tenant") is not None
+        or "HTTP_X_CHANGE_TENANT" in request.META
+    )
+
+
+def change_tenant(request: HttpRequest) -> Optional[HttpResponse]:
+    """
+    Select the tenant requested by this request, returning a response if
+    the request should not be passed on to the view.
+    """
     try:
-        tenant_instance: AbstractBaseTenant = user.visible_tenants.get(pk=tenant)
-    except Tenant.DoesNotExist:
-        raise Forbidden()
-    else:
-        set_tenant(session, tenant_instance)
-        session_tenant_changed.send(sender=request, tenant=tenant_instance, user=user, session=session)
+        if stateless_tenant_requested(request):
+            select_stateless_tenant(request)
+        elif request.path.startswith("/__change_tenant__/"):
+            select_tenant(request, request.path.split("/")[2])
+            if request.session.get("active_tenant"):
+                return HttpResponse(TENANT_CHANGED % request.session)
+            return HttpResponse(TENANT_CLEARED)
+        elif request.GET.get("__tenant") is not None:
+            select_tenant(request, request.GET["__tenant"])
+            data = request.GET.copy()
+            data.pop("__tenant")
+            if request.method == "GET":
+                if data:
+                    return redirect(request.path + "?" + data.urlencode())
+                return redirect(request.path)
+            request.GET = data
+        elif "HTTP_X_CHANGE_TENANT" in request.META:
+            select_tenant(request, request.META["HTTP_X_CHANGE_TENANT"])
+    except Forbidden:
+        return HttpResponseForbidden(UNABLE_TO_CHANGE_TENANT)
 
+    return None
 
+
+def search_tenants(request: HttpRequest) -> HttpResponse:
+    """
+    A page of the tenants visible to this user whose name starts with ``term``,
+    in the format the admin's autocomplete (select2) widgets expect.
+
+    The search is case sensitive, so that it may use the (``varchar_pattern_ops``)
+    index on the name, whatever the database's collation.
+    """
+    if not request.user.is_authenticated:
+        return HttpResponseForbidden(UNABLE_TO_CHANGE_TENANT)
+
+    size = settings.OCCUPATION_TENANT_SEARCH_PAGE_SIZE
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+
+    # Fetch one more than we need, to see if there is another page.
+    start, stop = (page - 1) * size, page * size + 1
+    tenants = list(
+        request.user.visible_tenants.filter(name__startswith=request.GET.get("term", ""))
+        .order_by("name")
+        .values_list("pk", "name")[start:stop]
+    )
+
+    return JsonResponse(
+        {
+            "results": [{"id": str(pk), "text": name} for pk, name in tenants[:size]],
+            "pagination": {"more": len(tenants) > size},
+        }
+    )
+
+
+@sync_and_async_middleware
 def SelectTenant(get_response: Callable) -> Callable:
-    def middleware(request: HttpRequest) -> HttpResponse:
-        try:
-            if request.path.startswith("/__change_tenant__/"):
-                select_tenant(request, request.path.split("/")[2])
-                if request.session.get("active_tenant"):
-                    return HttpResponse(TENANT_CHANGED % request.session)
-                return HttpResponse(TENANT_CLEARED)
-            elif request.GET.get("__tenant") is not None:
-                select_tenant(request, request.GET["__tenant"])
-                data = request.GET.copy()
-                data.pop("__tenant")
-                if request.method == "GET":
-                    if data:
-                        return redirect(request.path + "?" + data.urlencode())
-                    return redirect(request.path)
-                request.GET = data
-            elif "HTTP_X_CHANGE_TENANT" in request.META:
-                select_tenant(request, request.META["HTTP_X_CHANGE_TENANT"])
-        except Forbidden:
-            return HttpResponseForbidden(UNABLE_TO_CHANGE_TENANT)
+    if iscoroutinefunction(get_response):
 
+        async def async_middleware(request: HttpRequest) -> HttpResponse:
+            if request.path == TENANT_SEARCH_PATH:
+                return await sync_to_async(search_tenants)(request)
+            # Only hand off to a thread when there is a change to make.
+            if tenant_change_requested(request):
+                response = await sync_to_async(change_tenant)(request)
+                if response is not None:
+                    return response
+            return await get_response(request)
+
+        return async_middleware
+
+    def middleware(request: HttpRequest) -> HttpResponse:
+        if request.path == TENANT_SEARCH_PATH:
+            return search_tenants(request)
+        if tenant_change_requested(request):
+            response = change_tenant(request)
+            if response is not None:
+                return response
         return get_response(request)
 
     return middleware
 
 
+def get_activation(request: HttpRequest) -> Tuple[str, str, bool]:
+    "The tenant, user id and superuser status to activate for this request."
+    user = request.user
+    user_id = user.pk if user.is_authenticated else None
+    is_superuser = bool(user_id and getattr(user, "is_superuser", False))
+    if hasattr(request, "stateless_tenant"):
+        return request.stateless_tenant, user_id or "", is_superuser
+    return request.session.get("active_tenant", ""), user_id or "", is_superuser
+
+
+async def aget_activation(request: HttpRequest) -> Tuple[str, str, bool]:
+    if not hasattr(request, "auser") or not hasattr(request.session, "aget"):
+        return await sync_to_async(get_activation)(request)
+
+    user = await request.auser()
+    user_id = user.pk if user.is_authenticated else None
+    is_superuser = bool(user_id and getattr(user, "is_superuser", False))
+    if hasattr(request, "stateless_tenant"):
+        return request.stateless_tenant, user_id or "", is_superuser
+    return await request.session.aget("active_tenant", ""), user_id or "", is_superuser
+
+
+@sync_and_async_middleware
 def ActivateTenant(get_response: Callable) -> Callable:
+    if iscoroutinefunction(get_response):
+
+        async def async_middleware(request: HttpRequest) -> HttpResponse:
+            tenant_id, user_id, is_superuser = await aget_activation(request)
+            attach_tenant(request, tenant_id)
+            await aactivate_tenant(tenant_id, user_id=user_id, is_superuser=is_superuser)
+            return await get_response(request)
+
+        return async_middleware
+
     def middleware(request: HttpRequest) -> HttpResponse:
-        # Should we put this into the one query?
-        if request.user.is_authenticated and request.user.pk:
-            connection.cursor().execute("SET occupation.user_id = %s", [request.user.pk])
-        activate_tenant(request.session.get("active_tenant", ""))
+        tenant_id, user_id, is_superuser = get_activation(request)
+        attach_tenant(request, tenant_id)
+        activate_tenant(tenant_id, user_id=user_id, is_superuser=is_superuser)
         return get_response(request)
 
     return middleware
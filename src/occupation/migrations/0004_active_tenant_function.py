@@ -0,0 +1,17 @@
+from django.db import migrations
+
+from occupation.utils import ACTIVE_TENANT_FUNCTION, DROP_ACTIVE_TENANT_FUNCTION
+
+
+class Migration(migrations.Migration):
+    """
+    Policies compare the tenant column with occupation_active_tenant(), rather
+    than casting the column to text: existing policies may be rewritten using the
+    UpdateRowLevelSecurityPolicy operation.
+    """
+
+    dependencies = [("occupation", "0003_patch_admin")]
+
+    operations = [
+        migrations.RunSQL(ACTIVE_TENANT_FUNCTION, DROP_ACTIVE_TENANT_FUNCTION),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+from occupation.utils import DROP_IS_SUPERUSER_FUNCTION, IS_SUPERUSER_FUNCTION
+
+
+class Migration(migrations.Migration):
+    """
+    Superuser policies check occupation_is_superuser(), which reads a setting
+    that ActivateTenant applies once per request.
+    """
+
+    dependencies = [("occupation", "0004_active_tenant_function")]
+
+    operations = [
+        migrations.RunSQL(IS_SUPERUSER_FUNCTION, DROP_IS_SUPERUSER_FUNCTION),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Searching for tenants by the start of their name uses LIKE 'term%', which a
+    plain btree index can only serve under the C collation.
+    """
+
+    dependencies = [("occupation", "0005_is_superuser_function")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="tenant",
+            index=models.Index(fields=["name"], name="occupation_tenant_name_like", opclasses=["varchar_pattern_ops"]),
+        ),
+    ]
@@ -22,3 +22,5 @@ class Tenant(AbstractBaseTenant):
 
     class Meta:
         swappable = "OCCUPATION_TENANT_MODEL"
+        # The unique index can't serve LIKE 'term%' unless the database uses the C collation.
+        indexes = [models.Index(fields=["name"], name="occupation_tenant_name_like", opclasses=["varchar_pattern_ops"])]
@@ -1,16 +1,169 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+from django.apps.registry import Apps
 from django.db import migrations
 from django.db.backends.base.schema import BaseDatabaseSchemaEditor as SchemaEditor
 from django.db.migrations.state import ProjectState
 
-from occupation.utils import disable_row_level_security, enable_row_level_security
+from occupation.partitioning import partition_table, unpartition_table
+from occupation.utils import (
+    DROP_TENANT_DEFAULT,
+    LEGACY_DIRECT_LINK,
+    SET_TENANT_DEFAULT,
+    ModelType,
+    check_policy_indexes,
+    create_policy_functions,
+    denormalize_tenant,
+    disable_row_level_security_statements,
+    drop_created_indexes,
+    enable_row_level_security_statements,
+    get_fk_chain,
+    get_policy_indexes,
+    get_tenant_column,
+    get_tenant_model,
+    normalize_tenant,
+    update_row_level_security_policy_statement,
+)
+
+
+class EnableRowLevelSecurityForModels(migrations.operations.base.Operation):
+    """
+    Enable row level security on several models, in the migration's transaction.
 
+    Every policy is worked out from the same FK graph, and the statements are
+    executed by the schema editor, so ``sqlmigrate`` shows them.
+
+    Pass create_indexes=True to create any indexes the policies need, and
+    composite_index=True to index (tenant, pk) rather than just the tenant:
+    these depend upon the indexes that already exist, so are not shown by
+    ``sqlmigrate``. Those that were created are dropped when reversing.
+    """
 
-class EnableRowLevelSecurity(migrations.operations.base.Operation):
     reduces_to_sql = True
 
-    def __init__(self, model_name: str, *args, **kwargs) -> None:
-        self.superuser = kwargs.pop("superuser", False)
-        super().__init__(*args, **kwargs)
+    def __init__(
+        self,
+        model_names: Sequence[str],
+        superuser: bool = False,
+        create_indexes: bool = False,
+        composite_index: bool = False,
+    ) -> None:
+        super().__init__()
+        self.model_names = list(model_names)
+        self.superuser = superuser
+        self.create_indexes = create_indexes
+        self.composite_index = composite_index
+
+    def get_models(self, app_label: str, apps: Apps) -> List[ModelType]:
+        return [apps.get_model(app_label, model_name) for model_name in self.model_names]
+
+    def database_forwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        tenant_model = get_tenant_model(to_state.apps)
+        models = self.get_models(app_label, to_state.apps)
+
+        if not schema_editor.collect_sql:
+            with schema_editor.connection.cursor() as cursor:
+                create_policy_functions(cursor)
+
+        for model in models:
+            for statement in enable_row_level_security_statements(model, tenant_model, self.superuser):
+                schema_editor.execute(statement)
+
+        if not schema_editor.collect_sql:
+            for model in models:
+                check_policy_indexes(
+                    model,
+                    tenant_model,
+                    create_indexes=self.create_indexes,
+                    composite_index=self.composite_index,
+                    deferred_sql=schema_editor.deferred_sql,
+                    connection=schema_editor.connection,
+                )
+
+    def database_backwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        tenant_model = get_tenant_model(to_state.apps)
+        models = list(reversed(self.get_models(app_label, to_state.apps)))
+
+        for model in models:
+            for statement in disable_row_level_security_statements(model, self.superuser):
+                schema_editor.execute(statement)
+
+        if self.create_indexes and not schema_editor.collect_sql:
+            for model in models:
+                drop_created_indexes(
+                    get_policy_indexes(model, tenant_model, composite=self.composite_index),
+                    connection=schema_editor.connection,
+                )
+
+    def state_forwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def state_backwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def describe(self) -> str:
+        return "Enable row level security on {}".format(", ".join(self.model_names))
+
+
+class EnableRowLevelSecurity(EnableRowLevelSecurityForModels):
+    "Enable row level security on a model."
+
+    def __init__(self, model_name: str, **kwargs) -> None:
+        super().__init__([model_name], **kwargs)
+        self.model_name = model_name
+
+
+class EnableRowLevelSecurityForApp(EnableRowLevelSecurityForModels):
+    """
+    Enable row level security on every (managed, concrete) model in this app
+    that is linked to the tenant model, apart from those excluded.
+    """
+
+    def __init__(self, exclude: Sequence[str] = (), **kwargs) -> None:
+        super().__init__([], **kwargs)
+        self.exclude = [model_name.lower() for model_name in exclude]
+
+    def get_models(self, app_label: str, apps: Apps) -> List[ModelType]:
+        tenant_model = get_tenant_model(apps)
+        return [
+            model
+            for model in apps.get_models()
+            if model._meta.app_label == app_label
+            and model._meta.model_name not in self.exclude
+            # Proxies share a table that already has a policy, and we don't manage others' tables.
+            and not model._meta.proxy
+            and model._meta.managed
+            and model is not tenant_model
+            and get_fk_chain(model, tenant_model)
+        ]
+
+    def describe(self) -> str:
+        return "Enable row level security on every tenant model in this app"
+
+
+class UpdateRowLevelSecurityPolicy(migrations.operations.base.Operation):
+    """
+    Rewrite the policy on a model that already has row level security enabled,
+    as EnableRowLevelSecurity would now create it. Reversing this restores the
+    older policy, that cast the tenant column to text.
+    """
+
+    reduces_to_sql = True
+
+    def __init__(self, model_name: str) -> None:
+        super().__init__()
         self.model_name = model_name
 
     def database_forwards(
@@ -20,11 +173,123 @@ class EnableRowLevelSecurity(migrations.operations.base.Operation):
         from_state: ProjectState,
         to_state: ProjectState,
     ) -> None:
-        enable_row_level_security(
+        if not schema_editor.collect_sql:
+            with schema_editor.connection.cursor() as cursor:
+                create_policy_functions(cursor)
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute(update_row_level_security_policy_statement(model, get_tenant_model(to_state.apps)))
+
+    def database_backwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        model = to_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute(
+            update_row_level_security_policy_statement(model, get_tenant_model(to_state.apps), LEGACY_DIRECT_LINK)
+        )
+
+    def state_forwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def state_backwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def describe(self) -> str:
+        return "Update row level security policy on {}".format(self.model_name)
+
+
+class SetTenantDefault(migrations.operations.base.Operation):
+    """
+    Make the active tenant the database default of a model's tenant FK (or of
+    another column holding the tenant), so that inserts and ``COPY`` may leave
+    it out.
+
+    The model's state is unchanged: on Django 5.0 and later, prefer
+    ``db_default=ActiveTenant()`` on the field, which also lets the ORM leave it out.
+    """
+
+    reduces_to_sql = True
+
+    def __init__(self, model_name: str, column: Optional[str] = None) -> None:
+        super().__init__()
+        self.model_name = model_name
+        self.column = column
+
+    def get_data(self, app_label: str, schema_editor: SchemaEditor, state: ProjectState) -> Dict[str, str]:
+        model = state.apps.get_model(app_label, self.model_name)
+        tenant_model = get_tenant_model(state.apps)
+
+        return {
+            "table_name": model._meta.db_table,
+            "column": self.column or get_tenant_column(model, tenant_model),
+            "fk_type": tenant_model._meta.pk.rel_db_type(schema_editor.connection),
+        }
+
+    def database_forwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        if not schema_editor.collect_sql:
+            with schema_editor.connection.cursor() as cursor:
+                create_policy_functions(cursor)
+
+        schema_editor.execute(SET_TENANT_DEFAULT.format(**self.get_data(app_label, schema_editor, to_state)))
+
+    def database_backwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        schema_editor.execute(DROP_TENANT_DEFAULT.format(**self.get_data(app_label, schema_editor, to_state)))
+
+    def state_forwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def state_backwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def describe(self) -> str:
+        return "Default the tenant of {} to the active tenant".format(self.model_name)
+
+
+class DenormalizeTenant(migrations.operations.base.Operation):
+    """
+    Add a column holding the tenant to a model that is only indirectly linked to
+    the tenant model, and use that in its policy.
+
+    The column is not added to the model's state: it is maintained by a trigger.
+    """
+
+    reduces_to_sql = False
+
+    def __init__(self, model_name: str, column: str = "tenant_id", batch_size: int = 10000) -> None:
+        super().__init__()
+        self.model_name = model_name
+        self.column = column
+        self.batch_size = batch_size
+
+    def database_forwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        denormalize_tenant(
             app_label,
             self.model_name,
             apps=to_state.apps,
-            superuser=self.superuser,
+            column=self.column,
+            batch_size=self.batch_size,
         )
 
     def database_backwards(
@@ -34,15 +299,78 @@ class EnableRowLevelSecurity(migrations.operations.base.Operation):
         from_state: ProjectState,
         to_state: ProjectState,
     ) -> None:
-        disable_row_level_security(
+        normalize_tenant(app_label, self.model_name, apps=to_state.apps, column=self.column)
+
+    def state_forwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def state_backwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
+        pass
+
+    def describe(self) -> str:
+        return "Denormalize {} onto {}".format(self.column, self.model_name)
+
+
+class PartitionByTenant(migrations.operations.base.Operation):
+    """
+    Rebuild the table of a model as a table partitioned on its tenant column.
+
+    Use method="list" with a list of tenants that should each have a partition of
+    their own (all others share a default partition), or method="hash" with the
+    number of partitions.
+    """
+
+    reduces_to_sql = False
+
+    def __init__(
+        self,
+        model_name: str,
+        method: str = "list",
+        tenants: Sequence[Any] = (),
+        modulus: int = 8,
+        column: Optional[str] = None,
+        batch_size: int = 10000,
+    ) -> None:
+        super().__init__()
+        self.model_name = model_name
+        self.method = method
+        self.tenants = list(tenants)
+        self.modulus = modulus
+        self.column = column
+        self.batch_size = batch_size
+
+    def database_forwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        partition_table(
             app_label,
             self.model_name,
             apps=to_state.apps,
-            superuser=self.superuser,
+            method=self.method,
+            tenants=self.tenants,
+            modulus=self.modulus,
+            column=self.column,
+            batch_size=self.batch_size,
         )
 
+    def database_backwards(
+        self,
+        app_label: str,
+        schema_editor: SchemaEditor,
+        from_state: ProjectState,
+        to_state: ProjectState,
+    ) -> None:
+        unpartition_table(app_label, self.model_name, apps=to_state.apps, batch_size=self.batch_size)
+
     def state_forwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
         pass
 
     def state_backwards(self, app_label: str, state: ProjectState) -> None:  # pragma: no cover
         pass
+
+    def describe(self) -> str:
+        return "Partition {} by tenant ({})".format(self.model_name, self.method)
@@ -0,0 +1,66 @@
+"""
+:mod:`occupation.paginator`
+
+Counting the rows of a table with row level security means evaluating the policy
+for every row in that table, not just those that belong to the active tenant. For
+large tables, the query planner's estimate of the number of rows is used instead.
+"""
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+from occupation.utils import explain_json
+
+ESTIMATE = "EXPLAIN (FORMAT JSON) "
+
+
+def estimate_count(queryset: QuerySet) -> int:
+    "The number of rows the query planner expects this queryset to return."
+    sql, params = queryset.order_by().query.sql_with_params()
+
+    with connections[queryset.db].cursor() as cursor:
+        result = explain_json(cursor, ESTIMATE, sql, params)
+
+    return int(result[0]["Plan"]["Plan Rows"])
+
+
+def count(queryset: QuerySet) -> int:
+    """
+    The number of rows in this queryset: exactly, unless the planner estimates that
+    there are more than OCCUPATION_ESTIMATED_COUNT_THRESHOLD of them.
+    """
+    threshold = settings.OCCUPATION_ESTIMATED_COUNT_THRESHOLD
+
+    if threshold is not None:
+        estimate = estimate_count(queryset)
+        if estimate > threshold:
+            return estimate
+
+    return queryset.count()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator that only counts querysets that the planner expects to be small.
+
+    Estimates may be wrong in either direction, so the last pages may be empty, or
+    some rows may not be reachable by page number.
+    """
+
+    @cached_property
+    def count(self) -> int:
+        if isinstance(self.object_list, QuerySet):
+            return count(self.object_list)
+        return super().count
+
+
+class EstimatedCount:
+    "Stand in for a queryset, where only its count() is needed."
+
+    def __init__(self, queryset: QuerySet) -> None:
+        self.queryset = queryset
+
+    def count(self) -> int:
+        return count(self.queryset)
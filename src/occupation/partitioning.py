@@ -0,0 +1,316 @@
+"""
+:mod:`occupation.partitioning`
+
+Rebuild the table of a tenant-linked model as a table that is partitioned on its
+tenant column: LIST partitioned (with a partition for each of a chosen set of
+tenants, and a default partition for the rest), or HASH partitioned.
+
+The table is rebuilt (and its rows copied in batches) rather than altered, as
+Postgres cannot partition an existing table. Its indexes, FKs, triggers and
+policies are copied from the original table. Each partition has row level
+security forced (but no policy of its own), so rows may only be accessed through
+the partitioned table.
+
+Postgres requires every unique index on a partitioned table to include the
+partition column, so the primary key becomes (pk, tenant): this also means that
+no FK may refer to a partitioned table.
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from django.apps import apps
+from django.apps.registry import Apps
+from django.db import connection, transaction
+from django.db.backends.utils import truncate_name
+
+from occupation.utils import ENABLE_RLS, FORCE_RLS, NO_FORCE_RLS, ModelType, db_column, get_fk_chain, get_tenant_model
+
+PARTITION_METHODS = ("list", "hash")
+
+# The bounds of each partition (with their parameters), by partition name.
+Partitions = Dict[str, Tuple[str, List[Any]]]
+
+TABLE_INDEXES = """
+SELECT indexdef, indisunique, ARRAY(
+  SELECT attname::TEXT FROM pg_attribute WHERE attrelid = indrelid AND attnum = ANY(indkey)
+)
+FROM pg_indexes
+INNER JOIN pg_class ON (relname = indexname)
+INNER JOIN pg_index ON (indexrelid = pg_class.oid)
+WHERE tablename = %s AND NOT indisprimary
+"""
+TABLE_CONSTRAINTS = """
+SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'
+"""
+REFERENCING_CONSTRAINTS = """
+SELECT conrelid::regclass::TEXT, conname FROM pg_constraint WHERE confrelid = %s::regclass AND contype = 'f'
+"""
+PRIMARY_KEY = "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'"
+TABLE_TRIGGERS = "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal"
+TABLE_POLICIES = """
+SELECT policyname, permissive, roles::TEXT[], cmd, qual, with_check FROM pg_policies WHERE tablename = %s
+"""
+IS_IDENTITY = "SELECT attidentity != '' FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s"
+SERIAL_SEQUENCE = "SELECT pg_get_serial_sequence(%s, %s)"
+# Generated columns can't be inserted into: they are computed again in the new table.
+INSERTABLE_COLUMNS = """
+SELECT attname FROM pg_attribute
+WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+ORDER BY attnum
+"""
+LIST_PARTITIONED_TABLES = """
+SELECT relname FROM pg_partitioned_table INNER JOIN pg_class ON (pg_class.oid = partrelid) WHERE partstrat = 'l'
+"""
+
+RENAME_TABLE = "ALTER TABLE {table_name} RENAME TO {new_name}"
+CREATE_TABLE = """
+CREATE TABLE {table_name} (
+  LIKE {source} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY INCLUDING GENERATED
+) {partition_by}
+"""
+CREATE_PARTITION = "CREATE TABLE {partition} PARTITION OF {table_name} {bounds}"
+COPY_ROWS = """
+WITH batch AS (SELECT * FROM {source} {after} ORDER BY {pk} LIMIT %s)
+INSERT INTO {table_name} ({columns}) SELECT {columns} FROM batch RETURNING {pk}
+"""
+SET_IDENTITY = "SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE(MAX({pk}), 0) + 1, false) FROM {table_name}"
+OWN_SEQUENCE = "ALTER SEQUENCE {sequence} OWNED BY {table_name}.{pk}"
+DROP_TABLE = "DROP TABLE {table_name}"
+ADD_PRIMARY_KEY = "ALTER TABLE {table_name} ADD CONSTRAINT {name} PRIMARY KEY ({columns})"
+ADD_CONSTRAINT = "ALTER TABLE {table_name} ADD CONSTRAINT {name} {definition}"
+CREATE_POLICY = "CREATE POLICY {name} ON {table_name} AS {permissive} FOR {cmd} TO {roles}{using}{check}"
+
+
+def quote_name(name: str) -> str:
+    return connection.ops.quote_name(name)
+
+
+def partition_name(table_name: str, suffix: Any) -> str:
+    "The (unquoted) name of a partition: the suffix may be a tenant's id, such as a UUID."
+    return truncate_name("{}_{}".format(table_name, suffix), connection.ops.max_name_length())
+
+
+def get_partition_column(model: ModelType, apps: Apps = apps, column: Optional[str] = None) -> str:
+    "The tenant FK column of the model (or the denormalized column)."
+    if column:
+        return column
+
+    chain = get_fk_chain(model, get_tenant_model(apps))
+
+    if len(chain) != 1:
+        raise Exception("{} has no FK to the tenant model: which column should it be partitioned on?".format(model))
+
+    return db_column(chain[0])
+
+
+def check_not_referenced(cursor, table_name: str) -> None:
+    cursor.execute(REFERENCING_CONSTRAINTS, [table_name])
+    referenced_by = cursor.fetchall()
+    if referenced_by:
+        raise Exception(
+            "{} cannot be rebuilt, as it is referenced by {}".format(
+                table_name, ", ".join("{} ({})".format(*constraint) for constraint in referenced_by)
+            )
+        )
+
+
+def get_table_definition(cursor, table_name: str) -> Dict[str, Any]:
+    "Everything about this table that is not copied by CREATE TABLE ... (LIKE ...)."
+    check_not_referenced(cursor, table_name)
+
+    cursor.execute(TABLE_INDEXES, [table_name])
+    indexes = cursor.fetchall()
+    cursor.execute(TABLE_CONSTRAINTS, [table_name])
+    constraints = cursor.fetchall()
+    cursor.execute(TABLE_TRIGGERS, [table_name])
+    triggers = [trigger for (trigger,) in cursor.fetchall()]
+    cursor.execute(TABLE_POLICIES, [table_name])
+    policies = cursor.fetchall()
+    cursor.execute(PRIMARY_KEY, [table_name])
+    (primary_key,) = cursor.fetchone()
+
+    return {
+        "indexes": indexes,
+        "constraints": constraints,
+        "triggers": triggers,
+        "policies": policies,
+        "primary_key": primary_key,
+    }
+
+
+def rebuild_table(
+    model: ModelType,
+    key: List[str],
+    partition_by: str = "",
+    partitions: Optional[Partitions] = None,
+    batch_size: int = 10000,
+) -> None:
+    """
+    Replace the table of this model with a new one (partitioned, or not), with the same
+    rows, and everything else that refers to the table.
+
+    key is the columns of the new primary key.
+    """
+    partitions = partitions or {}
+    table_name = model._meta.db_table
+    pk = db_column(model._meta.pk)
+    source = truncate_name("{}_rebuild".format(table_name), connection.ops.max_name_length())
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        definition = get_table_definition(cursor, table_name)
+        cursor.execute(IS_IDENTITY, [table_name, pk])
+        (is_identity,) = cursor.fetchone()
+        cursor.execute(SERIAL_SEQUENCE, [table_name, pk])
+        (sequence,) = cursor.fetchone()
+        cursor.execute(INSERTABLE_COLUMNS, [table_name])
+        columns = ", ".join(connection.ops.quote_name(column) for (column,) in cursor.fetchall())
+
+        cursor.execute(RENAME_TABLE.format(table_name=table_name, new_name=source))
+        cursor.execute(CREATE_TABLE.format(table_name=table_name, source=source, partition_by=partition_by))
+        for partition, (bounds, params) in partitions.items():
+            cursor.execute(
+                CREATE_PARTITION.format(partition=quote_name(partition), table_name=table_name, bounds=bounds), params
+            )
+
+        # As the owner of the table, we can see every row while row level security is not forced.
+        cursor.execute(NO_FORCE_RLS.format(table_name=source))
+        copy = COPY_ROWS.format(source=source, table_name=table_name, pk=pk, columns=columns, after="")
+        cursor.execute(copy, [batch_size])
+        rows = cursor.fetchall()
+        copy = COPY_ROWS.format(
+            source=source, table_name=table_name, pk=pk, columns=columns, after="WHERE {} > %s".format(pk)
+        )
+        while rows:
+            cursor.execute(copy, [max(value for (value,) in rows), batch_size])
+            rows = cursor.fetchall()
+
+        if is_identity:
+            cursor.execute(SET_IDENTITY.format(pk=pk, table_name=table_name), [table_name, pk])
+        elif sequence:
+            cursor.execute(OWN_SEQUENCE.format(sequence=sequence, table_name=table_name, pk=pk))
+
+        cursor.execute(DROP_TABLE.format(table_name=source))
+
+        cursor.execute(
+            ADD_PRIMARY_KEY.format(table_name=table_name, name=definition["primary_key"], columns=", ".join(key))
+        )
+        for indexdef, _unique, _columns in definition["indexes"]:
+            cursor.execute(indexdef.replace(" ON ONLY ", " ON "))
+        for name, constraint in definition["constraints"]:
+            cursor.execute(ADD_CONSTRAINT.format(table_name=table_name, name=name, definition=constraint))
+        for trigger in definition["triggers"]:
+            cursor.execute(trigger)
+
+        if definition["policies"]:
+            cursor.execute(ENABLE_RLS.format(table_name=table_name))
+            cursor.execute(FORCE_RLS.format(table_name=table_name))
+        for name, permissive, roles, cmd, qual, with_check in definition["policies"]:
+            cursor.execute(
+                CREATE_POLICY.format(
+                    name=name,
+                    table_name=table_name,
+                    permissive=permissive,
+                    cmd=cmd,
+                    roles=", ".join(roles),
+                    using=" USING ({})".format(qual) if qual else "",
+                    check=" WITH CHECK ({})".format(with_check) if with_check else "",
+                )
+            )
+        for partition in partitions:
+            cursor.execute(ENABLE_RLS.format(table_name=quote_name(partition)))
+            cursor.execute(FORCE_RLS.format(table_name=quote_name(partition)))
+
+
+def partition_table(
+    app_label: str,
+    model_name: str,
+    apps: Apps = apps,
+    method: str = "list",
+    tenants: Sequence[Any] = (),
+    modulus: int = 8,
+    column: Optional[str] = None,
+    batch_size: int = 10000,
+) -> None:
+    """
+    Partition the table of this model by its tenant column.
+
+    LIST partitioning creates a partition for each of the tenants, and a default
+    partition for all others: HASH partitioning creates modulus partitions.
+    """
+    if method not in PARTITION_METHODS:
+        raise ValueError("Unknown partition method '{}': choose one of {}".format(method, ", ".join(PARTITION_METHODS)))
+
+    model = apps.get_model(app_label, model_name)
+    table_name = model._meta.db_table
+    column = get_partition_column(model, apps, column)
+
+    with connection.cursor() as cursor:
+        check_not_referenced(cursor, table_name)
+        cursor.execute(TABLE_INDEXES, [table_name])
+        for indexdef, unique, columns in cursor.fetchall():
+            if unique and column not in columns:
+                raise Exception("Unique indexes must include {} to be partitioned: {}".format(column, indexdef))
+
+    partitions: Partitions
+    if method == "list":
+        partitions = {
+            partition_name(table_name, "tenant_{}".format(tenant)): ("FOR VALUES IN (%s)", [str(tenant)])
+            for tenant in tenants
+        }
+        partitions[partition_name(table_name, "default")] = ("DEFAULT", [])
+    else:
+        partitions = {
+            partition_name(table_name, "p{}".format(remainder)): (
+                "FOR VALUES WITH (MODULUS %s, REMAINDER %s)",
+                [modulus, remainder],
+            )
+            for remainder in range(modulus)
+        }
+
+    rebuild_table(
+        model,
+        key=[db_column(model._meta.pk), column],
+        partition_by="PARTITION BY {} ({})".format(method.upper(), column),
+        partitions=partitions,
+        batch_size=batch_size,
+    )
+
+
+def unpartition_table(app_label: str, model_name: str, apps: Apps = apps, batch_size: int = 10000) -> None:
+    "Undo partition_table(), copying the rows back into a single table."
+    model = apps.get_model(app_label, model_name)
+    rebuild_table(model, key=[db_column(model._meta.pk)], batch_size=batch_size)
+
+
+def create_tenant_partition(model: ModelType, tenant_id: Any) -> None:
+    """
+    Create a partition for this tenant in the (LIST partitioned) table of this
+    model: the tenant must not have any rows in the default partition yet.
+    """
+    table_name = model._meta.db_table
+    partition = quote_name(partition_name(table_name, "tenant_{}".format(tenant_id)))
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            CREATE_PARTITION.format(
+                partition=partition,
+                table_name=table_name,
+                bounds="FOR VALUES IN (%s)",
+            ),
+            [str(tenant_id)],
+        )
+        cursor.execute(ENABLE_RLS.format(table_name=partition))
+        cursor.execute(FORCE_RLS.format(table_name=partition))
+
+
+def create_tenant_partitions(tenant_id: Any) -> None:
+    """
+    Create a partition for this tenant in every LIST partitioned table: this may be
+    called when a tenant is created.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(LIST_PARTITIONED_TABLES)
+        tables = {table for (table,) in cursor.fetchall()}
+
+    for model in apps.get_models():
+        if model._meta.db_table in tables:
+            create_tenant_partition(model, tenant_id)
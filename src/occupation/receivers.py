@@ -0,0 +1,37 @@
+# pylint: disable=unused-argument
+"""
+:mod:`occupation.receivers`
+
+Signal receivers that keep cached tenant data up to date.
+"""
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import receiver
+
+from occupation.cache import invalidate_host_map, invalidate_tenant, invalidate_visible_tenants
+from occupation.utils import get_tenant_model
+
+Tenant = get_tenant_model()
+
+
+@receiver(m2m_changed, sender=Tenant.users.through)
+def tenant_users_changed(sender, instance, action, reverse, pk_set, **kwargs) -> None:
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+
+    if reverse:
+        # user.visible_tenants was changed.
+        invalidate_visible_tenants([instance.pk])
+    elif action == "pre_clear":
+        invalidate_visible_tenants(instance.users.values_list("pk", flat=True))
+    else:
+        invalidate_visible_tenants(pk_set)
+
+
+@receiver(post_save, sender=Tenant)
+@receiver(pre_delete, sender=Tenant)
+def tenant_changed(sender, instance, **kwargs) -> None:
+    # The name or is_active may have changed, or the tenant is about to go away.
+    if instance.pk is not None:
+        invalidate_tenant(instance.pk)
+        invalidate_host_map()
+        invalidate_visible_tenants(instance.users.values_list("pk", flat=True))
@@ -5,3 +5,100 @@ The model that will store the tenant objects.
 This should be a subclass of :class:`tenant.models.AbstractTenant`, or
 expose the same methods.
 """
+
+OCCUPATION_ACTIVATION_MODE = "eager"
+"""
+How the active tenant (and user) are sent to the database.
+
+``"eager"`` sends them as soon as they are activated (unless the connection
+already has those values). ``"lazy"`` keeps them on the connection until the
+next query, and sends them with it: requests that never hit the database will
+not do any database work for the tenant.
+
+``"transaction"`` applies them with ``set_config(..., true)`` (``SET LOCAL``) at
+the start of every transaction, and with every query when in autocommit mode.
+Nothing outlives the transaction, so this is safe to use behind a pooler that
+runs in transaction pooling mode, such as PgBouncer.
+"""
+
+OCCUPATION_CACHE = None
+"""
+The alias of the cache (from ``CACHES``) used to store the tenants that each user
+may see, or ``None`` to always read them from the database.
+
+Entries are invalidated when a tenant or its users change, so this must be a cache
+that is shared between all processes, rather than a local-memory cache.
+"""
+
+OCCUPATION_CACHE_TIMEOUT = 60 * 60
+"""
+How long (in seconds) a user's visible tenants may be cached for.
+"""
+
+OCCUPATION_TENANT_CHOICES_LIMIT = None
+"""
+The maximum number of tenants (ordered by name) that the ``tenants`` context
+processor will provide, or ``None`` for no limit. Users that can see more tenants
+than this will need some other way to select the remainder.
+"""
+
+OCCUPATION_TENANT_SEARCH_PAGE_SIZE = 20
+"""
+How many tenants each page of results from ``/__search_tenants__/`` contains.
+"""
+
+OCCUPATION_ADMIN_TENANT_SEARCH = False
+"""
+Select the tenant in the admin with a widget that searches the tenants the user may
+see as they type, rather than a list of every one of them. Use this when users may
+see more tenants than can be listed in every page.
+"""
+
+OCCUPATION_TENANT_CACHE_SIZE = 0
+"""
+How many tenant objects each process may keep in memory, so that ``request.tenant``
+does not need to be fetched from the database. Entries are invalidated when a
+tenant is saved or deleted, but only in the process that made the change.
+"""
+
+OCCUPATION_TENANT_HEADER = None
+"""
+The ``request.META`` key of a header (for example ``"HTTP_X_TENANT"``) that selects
+the tenant for that request only, without using the session. The tenant must be
+visible to the authenticated user.
+"""
+
+OCCUPATION_TENANT_TOKEN_HEADER = None
+"""
+The ``request.META`` key of a header that contains a signed token (from
+:func:`occupation.middleware.make_tenant_token`) that selects the tenant for that
+request only, without using the session. The token must belong to the
+authenticated user, but the tenant is not checked against the database.
+"""
+
+OCCUPATION_TENANT_TOKEN_MAX_AGE = 60 * 60
+"""
+How long (in seconds) a tenant token remains valid.
+"""
+
+OCCUPATION_TENANT_HOST_FIELD = None
+"""
+The name of a field on the tenant model that holds the host name (or subdomain)
+that the tenant is served from. When set, the tenant is selected by the host that
+each request was made to, without using the session: it must still be visible to
+the authenticated user.
+"""
+
+OCCUPATION_TENANT_HOST_MAP_TTL = 5 * 60
+"""
+How long (in seconds) each process may use its map of host names to tenants,
+before fetching it again. It is also refreshed whenever a tenant is saved or
+deleted in that process.
+"""
+
+OCCUPATION_ESTIMATED_COUNT_THRESHOLD = 10000
+"""
+Admin changelists of models that belong to a tenant use the query planner's estimate
+of the number of rows, rather than counting them, when it is more than this. Set to
+``None`` to always count the rows.
+"""
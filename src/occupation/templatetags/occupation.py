@@ -1,10 +1,29 @@
 from django import template
+from django.utils.html import format_html
 
 from ..utils import get_tenant_model
+from ..widgets import TenantSelect
 
 register = template.Library()
 
+CHANGE_TENANT = "window.location.search = '?__tenant=' + this.value;"
+
 
 @register.filter
 def is_tenant_model(obj):
     return isinstance(obj, get_tenant_model())
+
+
+@register.simple_tag(takes_context=True)
+def tenant_select(context):
+    "A searchable tenant selector, that only needs the active tenant."
+    tenant = context.get("tenant")
+    widget = TenantSelect(
+        attrs={"id": "__tenant_list", "onchange": CHANGE_TENANT},
+        choices=[(tenant.pk, tenant.name)] if tenant else [],
+    )
+    media = widget.media
+    # Model admin pages already load these (see patch_admin): loading them again would initialise them twice.
+    if set(media._js) & set(getattr(context.get("media"), "_js", ())):
+        media = ""
+    return format_html("{}{}", media, widget.render("__tenant", tenant and tenant.pk))
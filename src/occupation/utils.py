@@ -1,17 +1,27 @@
-from typing import Iterator, List, Sequence, Type
+import json
+import logging
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Type
 
+from asgiref.sync import sync_to_async
 from django.apps import apps
 from django.apps.registry import Apps
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.db import connection, transaction
-from django.db.models import Field, Model
+from django.db import connection as default_connection, transaction
+from django.db.backends.ddl_references import Statement
+from django.db.backends.utils import truncate_name
+from django.db.models import Field, Func, Model
 
 from occupation.models import AbstractBaseTenant
 
 ModelType = Type[Model]
 TenantType = Type[AbstractBaseTenant]
 Fields = List[Field]
+Index = Tuple[str, List[str]]
+
+logger = logging.getLogger(__name__)
 
 
 def get_tenant_model(apps: Apps = apps) -> TenantType:
@@ -34,70 +44,380 @@ FORCE_RLS = "ALTER TABLE {table_name} FORCE ROW LEVEL SECURITY"
 DISABLE_RLS = "ALTER TABLE {table_name} DISABLE ROW LEVEL SECURITY"
 CREATE_POLICY = "CREATE POLICY access_tenant_data ON {table_name} FOR ALL USING ({policy}) WITH CHECK ({policy})"
 DROP_POLICY = "DROP POLICY access_tenant_data ON {table_name}"
+ALTER_POLICY = "ALTER POLICY access_tenant_data ON {table_name} USING ({policy}) WITH CHECK ({policy})"
 
-CREATE_SUPERUSER_POLICY = """
-CREATE POLICY superuser_access_tenant_data ON {table_name} USING (is_superuser(current_setting('occupation.user_id')))
-"""
+# The superuser status of the user is set once, by ActivateTenant, so this does not
+# need to look up the user for every row.
+CREATE_SUPERUSER_POLICY = "CREATE POLICY superuser_access_tenant_data ON {table_name} USING (occupation_is_superuser())"
 DROP_SUPERUSER_POLICY = "DROP POLICY superuser_access_tenant_data ON {table_name}"
 
+ACTIVE_TENANT_FUNCTION = """
+CREATE OR REPLACE FUNCTION occupation_active_tenant()
+RETURNS TEXT AS $$
+  SELECT NULLIF(current_setting('occupation.active_tenant', true), '')
+$$ LANGUAGE sql STABLE PARALLEL SAFE
+"""
+DROP_ACTIVE_TENANT_FUNCTION = "DROP FUNCTION occupation_active_tenant()"
+
+IS_SUPERUSER_FUNCTION = """
+CREATE OR REPLACE FUNCTION occupation_is_superuser()
+RETURNS BOOLEAN AS $$
+  SELECT COALESCE(current_setting('occupation.is_superuser', true), '') = 'true'
+$$ LANGUAGE sql STABLE PARALLEL SAFE
+"""
+DROP_IS_SUPERUSER_FUNCTION = "DROP FUNCTION occupation_is_superuser()"
+
+POLICY_FUNCTIONS = {
+    "occupation_active_tenant()": ACTIVE_TENANT_FUNCTION,
+    "occupation_is_superuser()": IS_SUPERUSER_FUNCTION,
+}
+FUNCTION_EXISTS = "SELECT to_regprocedure(%s) IS NOT NULL"
 
-def enable_row_level_security(app_label: str, model_name: str, apps: Apps = apps, superuser: bool = False) -> None:
-    model = apps.get_model(app_label, model_name)
 
-    policy_clauses = get_policy_clauses(model, get_tenant_model(apps))
+def create_policy_functions(cursor) -> None:
+    "Policies need these functions, even if the occupation migrations have not been applied yet."
+    for signature, function in POLICY_FUNCTIONS.items():
+        cursor.execute(FUNCTION_EXISTS, [signature])
+        if not cursor.fetchone()[0]:
+            cursor.execute(function)
+
+
+def enable_row_level_security_statements(model: ModelType, tenant_model: TenantType, superuser: bool = False) -> List[str]:
+    policy_clauses = get_policy_clauses(model, tenant_model)
 
     if not policy_clauses:
         raise Exception("Unable to find any FK chains back to tenant model.")
 
     data = {"table_name": model._meta.db_table, "policy": " AND ".join(policy_clauses)}
 
+    return [ENABLE_RLS.format(**data), FORCE_RLS.format(**data), CREATE_POLICY.format(**data)] + (
+        [CREATE_SUPERUSER_POLICY.format(**data)] if superuser else []
+    )
+
+
+def disable_row_level_security_statements(model: ModelType, superuser: bool = False) -> List[str]:
+    data = {"table_name": model._meta.db_table}
+
+    return [DISABLE_RLS.format(**data), DROP_POLICY.format(**data)] + (
+        [DROP_SUPERUSER_POLICY.format(**data)] if superuser else []
+    )
+
+
+def enable_row_level_security(
+    app_label: str,
+    model_name: str,
+    apps: Apps = apps,
+    superuser: bool = False,
+    create_indexes: bool = False,
+    composite_index: bool = False,
+) -> None:
+    """
+    Enable (and force) row level security on this model's table, with a policy
+    that only allows access to rows that belong to the active tenant.
+
+    Indexes the policy needs may also be created, including a composite
+    (tenant, pk) index for models with an FK to the tenant: any that are still
+    missing afterwards are logged.
+    """
+    model = apps.get_model(app_label, model_name)
+    tenant_model = get_tenant_model(apps)
+    statements = enable_row_level_security_statements(model, tenant_model, superuser)
+
     with transaction.atomic():
-        with connection.cursor() as cursor:
-            cursor.execute(ENABLE_RLS.format(**data))
-            cursor.execute(FORCE_RLS.format(**data))
-            cursor.execute(CREATE_POLICY.format(**data))
-            if superuser:
-                cursor.execute(CREATE_SUPERUSER_POLICY.format(**data))
+        with default_connection.cursor() as cursor:
+            create_policy_functions(cursor)
+            for statement in statements:
+                cursor.execute(statement)
+
+    check_policy_indexes(model, tenant_model, create_indexes, composite_index)
 
 
 def disable_row_level_security(app_label: str, model_name: str, apps: Apps = apps, superuser: bool = False) -> None:
     model = apps.get_model(app_label, model_name)
 
-    data = {
-        "table_name": model._meta.db_table,
-    }
-
     with transaction.atomic():
-        with connection.cursor() as cursor:
-            cursor.execute(DISABLE_RLS.format(**data))
-            cursor.execute(DROP_POLICY.format(**data))
-            if superuser:
-                cursor.execute(DROP_SUPERUSER_POLICY.format(**data))
+        with default_connection.cursor() as cursor:
+            for statement in disable_row_level_security_statements(model, superuser):
+                cursor.execute(statement)
+
+
+POLICY_TABLES = "SELECT tablename FROM pg_policies WHERE policyname = 'access_tenant_data'"
+
+
+def get_row_level_security_models(connection=default_connection) -> List[ModelType]:
+    "Every installed model whose table has a row level security policy for the tenant."
+    with connection.cursor() as cursor:
+        cursor.execute(POLICY_TABLES)
+        tables = {table for (table,) in cursor.fetchall()}
 
+    return [model for model in apps.get_models() if model._meta.db_table in tables]
+
+
+def get_active_tenant_ids() -> List[str]:
+    "The ids of every active tenant, in order."
+    tenants = get_tenant_model().objects.filter(is_active=True).order_by("pk")
+    return [str(pk) for pk in tenants.values_list("pk", flat=True)]
+
+
+def explain_json(cursor, explain: str, sql: str, params: Sequence[Any]) -> List[Dict[str, Any]]:
+    "Run this query under ``EXPLAIN (..., FORMAT JSON)``, returning the plans."
+    cursor.execute(explain + sql, params)
+    result = cursor.fetchone()[0]
+
+    # psycopg2 decodes the JSON for us, psycopg (3) may not.
+    if isinstance(result, str):
+        result = json.loads(result)
+
+    return result
+
+
+INDEXES = """
+SELECT ARRAY(
+  SELECT attname::TEXT FROM unnest(indkey) WITH ORDINALITY AS k(attnum, n)
+  INNER JOIN pg_attribute ON (attrelid = indrelid AND pg_attribute.attnum = k.attnum)
+  ORDER BY n
+)
+FROM pg_index WHERE indrelid = %s::regclass
+"""
+CREATE_INDEX = "CREATE INDEX {concurrently} {index_name} ON {table_name} ({columns})"
+# Indexes we create are marked, so that only those are dropped again.
+POLICY_INDEX_COMMENT = "occupation: row level security policy"
+COMMENT_ON_INDEX = "COMMENT ON INDEX {index_name} IS '{comment}'"
+POLICY_INDEX_EXISTS = """
+SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'i' AND obj_description(oid, 'pg_class') = %s
+"""
+DROP_INDEX = "DROP INDEX {concurrently} IF EXISTS {index_name}"
+
+
+def get_policy_indexes(model: ModelType, tenant_model: TenantType, composite: bool = False) -> List[Index]:
+    "The (table, columns) that the policy on this model filters on, and should be indexed."
+    indexes = []
+
+    for field in [chain[0] for chain in get_fk_chains(model, tenant_model)]:
+        if field.related_model is tenant_model:
+            columns = [db_column(field)]
+            if composite:
+                columns.append(db_column(model._meta.pk))
+            indexes.append((model._meta.db_table, columns))
+        else:
+            indexes.append((model._meta.db_table, [db_column(field)]))
+            indexes.append((field.related_model._meta.db_table, [db_column(field.target_field)]))
+
+    return indexes
+
+
+def policy_index_name(table_name: str, columns: List[str], connection=default_connection) -> str:
+    return truncate_name("{}_{}_idx".format(table_name, "_".join(columns)), connection.ops.max_name_length())
+
+
+def is_deferred_index(statement: Any, table_name: str, columns: List[str]) -> bool:
+    "Is this (deferred) statement from a schema editor going to create an index on these columns?"
+    return (
+        isinstance(statement, Statement)
+        and ("INDEX" in statement.template or "UNIQUE" in statement.template)
+        and all(statement.references_column(table_name, column) for column in columns)
+    )
+
+
+def get_missing_indexes(
+    indexes: List[Index], deferred_sql: Sequence[Any] = (), connection=default_connection
+) -> List[Index]:
+    """
+    Those indexes that no existing index starts with the same columns as, and
+    that a schema editor will not be creating at the end of this migration.
+    """
+    missing = []
+
+    with connection.cursor() as cursor:
+        for table_name, columns in indexes:
+            cursor.execute(INDEXES, [table_name])
+            if any(existing[: len(columns)] == columns for (existing,) in cursor.fetchall()):
+                continue
+            if any(is_deferred_index(statement, table_name, columns) for statement in deferred_sql):
+                continue
+            missing.append((table_name, columns))
+
+    return missing
+
+
+def create_missing_indexes(
+    indexes: List[Index], deferred_sql: Sequence[Any] = (), connection=default_connection
+) -> None:
+    "Create these indexes (if missing): concurrently, unless we are in a transaction."
+    concurrently = "" if connection.in_atomic_block else "CONCURRENTLY"
+
+    with connection.cursor() as cursor:
+        for table_name, columns in get_missing_indexes(indexes, deferred_sql, connection):
+            index_name = policy_index_name(table_name, columns, connection)
+            cursor.execute(
+                CREATE_INDEX.format(
+                    concurrently=concurrently,
+                    index_name=index_name,
+                    table_name=table_name,
+                    columns=", ".join(columns),
+                )
+            )
+            cursor.execute(COMMENT_ON_INDEX.format(index_name=index_name, comment=POLICY_INDEX_COMMENT))
 
-def get_fk_chains(model: ModelType, root: TenantType, parents: Fields = None) -> Iterator[Fields]:
-    if not parents:
-        parents = []
 
-    for field in model._meta.fields:
-        if field.related_model is root:
-            yield parents + [field]
-        elif field.related_model:
-            for chain in get_fk_chains(field.related_model, root, parents + [field]):
-                yield parents + chain
+def drop_created_indexes(indexes: List[Index], connection=default_connection) -> None:
+    "Drop those of these indexes that create_missing_indexes() created."
+    concurrently = "" if connection.in_atomic_block else "CONCURRENTLY"
 
+    with connection.cursor() as cursor:
+        for table_name, columns in indexes:
+            index_name = policy_index_name(table_name, columns, connection)
+            cursor.execute(POLICY_INDEX_EXISTS, [index_name, POLICY_INDEX_COMMENT])
+            if cursor.fetchone():
+                cursor.execute(DROP_INDEX.format(concurrently=concurrently, index_name=index_name))
 
-DIRECT_LINK = "{fk}::TEXT = current_setting('occupation.active_tenant')"
+
+def check_policy_indexes(
+    model: ModelType,
+    tenant_model: TenantType,
+    create_indexes: bool = False,
+    composite_index: bool = False,
+    deferred_sql: Sequence[Any] = (),
+    connection=default_connection,
+) -> None:
+    "Create the indexes the policy on this model needs (if asked to), and log any that are missing."
+    indexes = get_policy_indexes(model, tenant_model, composite=composite_index)
+
+    if create_indexes:
+        create_missing_indexes(indexes, deferred_sql, connection)
+
+    for table_name, columns in get_missing_indexes(indexes, deferred_sql, connection):
+        logger.warning(
+            "The row level security policy on %s uses %s (%s), which is not indexed.",
+            model._meta.db_table,
+            table_name,
+            ", ".join(columns),
+        )
+
+
+def model_label(model: ModelType) -> str:
+    # Unresolved relations are still a string, rather than a model.
+    return model.lower() if isinstance(model, str) else model._meta.label_lower
+
+
+def get_tenant_distances(root: TenantType) -> Dict[str, int]:
+    """
+    The (shortest) number of FK hops from each model that can reach the tenant model.
+
+    This is a breadth-first search backwards along every FK from the tenant model,
+    so cycles of FKs are only visited once. It's stored on the app registry, and only
+    built again when that registry's models change.
+    """
+    registry = root._meta.apps
+    models = registry.get_models(include_auto_created=True)
+    graph = getattr(registry, "occupation_fk_graph", None)
+
+    if graph is not None and graph[0] is models and graph[1] == model_label(root):
+        return graph[2]
+
+    referrers: Dict[str, Set[str]] = defaultdict(set)
+    for model in models:
+        for field in model._meta.fields:
+            if field.related_model:
+                referrers[model_label(field.related_model)].add(model_label(model))
+
+    distances = {model_label(root): 0}
+    queue = deque([model_label(root)])
+    while queue:
+        label = queue.popleft()
+        for referrer in referrers[label]:
+            if referrer not in distances:
+                distances[referrer] = distances[label] + 1
+                queue.append(referrer)
+
+    registry.occupation_fk_graph = (models, model_label(root), distances)
+    return distances
+
+
+def get_fk_chain(model: ModelType, root: TenantType) -> Fields:
+    "The shortest chain of FKs from model to the tenant model (or an empty list)."
+    distances = get_tenant_distances(root)
+    chain = []
+
+    while model_label(model) != model_label(root):
+        fields = [field for field in model._meta.fields if model_label(field.related_model or "") in distances]
+        if not fields:
+            return []
+        field = min(fields, key=lambda field: distances[model_label(field.related_model)])
+        chain.append(field)
+        model = field.related_model
+
+    return chain
+
+
+def get_fk_chains(model: ModelType, root: TenantType) -> Iterator[Fields]:
+    """
+    The shortest chain of FKs back to the tenant model, starting with each
+    FK on model that can reach it, in the order the FKs are declared.
+
+    FKs to the model itself, and chains that lead back through it (such as to a
+    model that refers back to this one), are not followed: a policy that checked
+    them would recurse. Only the model's own columns are used: those of a
+    multi-table inheritance parent are in the parent's table.
+    """
+    distances = get_tenant_distances(root)
+
+    for field in model._meta.local_fields:
+        if not field.related_model or model_label(field.related_model) not in distances:
+            continue
+        if model_label(field.related_model) == model_label(model):
+            continue
+        chain = [field] + get_fk_chain(field.related_model, root)
+        if all(model_label(link.related_model) != model_label(model) for link in chain):
+            yield chain
+
+
+def get_tenant_fields(apps: Apps = apps) -> Dict[str, Fields]:
+    """
+    The chain of FKs to the tenant model from each model that has one, keyed by
+    model label (which is also a content type's "app_label.model").
+
+    This is built when occupation is ready, and kept on the app registry until its
+    models change, so looking a model up doesn't need to scan its fields.
+    """
+    root = get_tenant_model(apps)
+    models = apps.get_models(include_auto_created=True)
+    registry = getattr(apps, "occupation_tenant_fields", None)
+
+    if registry is not None and registry[0] is models and registry[1] == model_label(root):
+        return registry[2]
+
+    tenant_fields = {}
+    for model in models:
+        chain = get_fk_chain(model, root)
+        if chain:
+            tenant_fields[model_label(model)] = chain
+
+    apps.occupation_tenant_fields = (models, model_label(root), tenant_fields)
+    return tenant_fields
+
+
+def get_tenant_field(model: ModelType) -> Optional[Field]:
+    "The FK from model (or an instance of it) directly to the tenant model, if it has one."
+    chain = get_tenant_fields(model._meta.apps).get(model._meta.label_lower, [])
+    return chain[0] if len(chain) == 1 else None
+
+
+# Comparing the column (rather than casting it to text) allows an index on it to be used: the
+# function is STABLE, so it is only evaluated once per query.
+DIRECT_LINK = "{fk} = occupation_active_tenant()::{fk_type}"
+LEGACY_DIRECT_LINK = "{fk}::TEXT = current_setting('occupation.active_tenant')"
 INDIRECT_LINK = "EXISTS (SELECT 1 FROM {related_table} WHERE {table_name}.{fk} = {related_table}.{pk})"
 
 
-def get_policy_clauses(model: ModelType, tenant_model: TenantType) -> Sequence[str]:
-    fields = set(field[0] for field in get_fk_chains(model, tenant_model))
+def get_policy_clauses(model: ModelType, tenant_model: TenantType, direct_link: str = DIRECT_LINK) -> Sequence[str]:
+    fields = [chain[0] for chain in get_fk_chains(model, tenant_model)]
 
     return [
-        (DIRECT_LINK if field.related_model is tenant_model else INDIRECT_LINK).format(
+        (direct_link if field.related_model is tenant_model else INDIRECT_LINK).format(
             fk=db_column(field),
-            pk=db_column(field.remote_field.target_field),
+            fk_type=field.db_type(default_connection),
+            pk=db_column(field.target_field),
             related_table=field.related_model._meta.db_table,
             table_name=model._meta.db_table,
         )
@@ -109,5 +429,484 @@ def db_column(field: Field) -> str:
     return field.db_column or field.attname
 
 
-def activate_tenant(tenant_id: str) -> None:
-    connection.cursor().execute("SET occupation.active_tenant = %s", [tenant_id or ''])
+def update_row_level_security_policy_statement(
+    model: ModelType, tenant_model: TenantType, direct_link: str = DIRECT_LINK
+) -> str:
+    policy_clauses = get_policy_clauses(model, tenant_model, direct_link)
+
+    if not policy_clauses:
+        raise Exception("Unable to find any FK chains back to tenant model.")
+
+    return ALTER_POLICY.format(table_name=model._meta.db_table, policy=" AND ".join(policy_clauses))
+
+
+def update_row_level_security_policy(
+    app_label: str, model_name: str, apps: Apps = apps, direct_link: str = DIRECT_LINK
+) -> None:
+    "Replace the policy on this model's table with the one we would now create for it."
+    model = apps.get_model(app_label, model_name)
+    statement = update_row_level_security_policy_statement(model, get_tenant_model(apps), direct_link)
+
+    with transaction.atomic():
+        with default_connection.cursor() as cursor:
+            create_policy_functions(cursor)
+            cursor.execute(statement)
+
+
+SET_TENANT_DEFAULT = "ALTER TABLE {table_name} ALTER COLUMN {column} SET DEFAULT occupation_active_tenant()::{fk_type}"
+DROP_TENANT_DEFAULT = "ALTER TABLE {table_name} ALTER COLUMN {column} DROP DEFAULT"
+
+
+class ActiveTenant(Func):
+    """
+    The active tenant's id, as a database expression.
+
+    Use it as the ``db_default`` of a tenant FK, so that inserts (including
+    ``bulk_create()`` and ``COPY``) may leave the tenant out.
+    """
+
+    template = "occupation_active_tenant()::%(fk_type)s"
+
+    def _resolve_output_field(self) -> Field:
+        return get_tenant_model()._meta.pk
+
+    def as_sql(self, compiler, connection, **extra_context):
+        fk_type = get_tenant_model()._meta.pk.rel_db_type(connection)
+        return super().as_sql(compiler, connection, fk_type=fk_type, **extra_context)
+
+
+def get_tenant_column(model: ModelType, tenant_model: TenantType) -> str:
+    "The column of this model's (first) FK to the tenant model."
+    fields = [chain[0] for chain in get_fk_chains(model, tenant_model) if len(chain) == 1]
+
+    if not fields:
+        raise Exception("Unable to find an FK to the tenant model.")
+
+    return db_column(fields[0])
+
+
+TENANT_LOOKUP = "SELECT {tenant_fk} FROM {tables} WHERE {related_table}.{pk} = {source}.{fk}"
+
+ADD_TENANT_COLUMN = """
+ALTER TABLE {table_name} ADD COLUMN {column} {column_type} NULL
+REFERENCES {tenant_table} ({tenant_pk}) DEFERRABLE INITIALLY DEFERRED
+"""
+DROP_TENANT_COLUMN = "ALTER TABLE {table_name} DROP COLUMN {column}"
+CREATE_TENANT_COLUMN_INDEX = "CREATE INDEX {index_name} ON {table_name} ({column})"
+
+DENORMALIZE_FUNCTION = """
+CREATE OR REPLACE FUNCTION {function}()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.{column} = ({lookup});
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+DROP_DENORMALIZE_FUNCTION = "DROP FUNCTION {function}()"
+
+DENORMALIZE_TRIGGER = """
+CREATE TRIGGER {function}
+BEFORE INSERT OR UPDATE OF {fk} ON {table_name}
+FOR EACH ROW EXECUTE PROCEDURE {function}()
+"""
+DROP_DENORMALIZE_TRIGGER = "DROP TRIGGER {function} ON {table_name}"
+
+BACKFILL_TENANT_COLUMN = """
+UPDATE {table_name} SET {column} = ({lookup})
+WHERE {pk} IN (SELECT {pk} FROM {table_name} {after} ORDER BY {pk} LIMIT %s)
+RETURNING {pk}
+"""
+
+FORCED_RLS_TABLES = "SELECT relname FROM pg_class WHERE relname = ANY(%s) AND relforcerowsecurity"
+NO_FORCE_RLS = "ALTER TABLE {table_name} NO FORCE ROW LEVEL SECURITY"
+
+
+def tenant_lookup(chain: Fields, source: str) -> str:
+    "A query for the tenant of a row in source (the table at the start of this chain of FKs)."
+    first, *rest = chain
+    related_models = [field.related_model for field in chain[:-1]]
+    tables = " ".join(
+        [related_models[0]._meta.db_table]
+        + [
+            "INNER JOIN {related_table} ON {table_name}.{fk} = {related_table}.{pk}".format(
+                related_table=field.related_model._meta.db_table,
+                table_name=model._meta.db_table,
+                fk=db_column(field),
+                pk=db_column(field.target_field),
+            )
+            for model, field in zip(related_models, rest[:-1])
+        ]
+    )
+    return TENANT_LOOKUP.format(
+        tenant_fk="{}.{}".format(related_models[-1]._meta.db_table, db_column(rest[-1])),
+        tables=tables,
+        related_table=related_models[0]._meta.db_table,
+        pk=db_column(first.target_field),
+        source=source,
+        fk=db_column(first),
+    )
+
+
+def denormalize_tenant(
+    app_label: str,
+    model_name: str,
+    apps: Apps = apps,
+    column: str = "tenant_id",
+    batch_size: int = 10000,
+) -> None:
+    """
+    Store the tenant of each row of a model that is only indirectly linked to the
+    tenant model in a column of its own, so the policy can compare that column
+    directly, rather than looking up the related row.
+
+    The column is filled in batches, and kept up to date by a trigger whenever a
+    row is inserted, or its FK changed: a row's tenant is not updated if a related
+    row is moved to a different tenant. When this is not run in a transaction, each
+    batch is committed separately: row level security is only ever not forced on
+    the tables within the transaction of a batch.
+    """
+    model = apps.get_model(app_label, model_name)
+    tenant_model = get_tenant_model(apps)
+    chain = get_fk_chain(model, tenant_model)
+
+    if len(chain) < 2:
+        raise Exception("{} is not indirectly linked to the tenant model.".format(model._meta.label))
+
+    table_name = model._meta.db_table
+    connection = default_connection
+    column_type = chain[-1].target_field.rel_db_type(connection)
+    data = {
+        "table_name": table_name,
+        "column": column,
+        "column_type": column_type,
+        "tenant_table": tenant_model._meta.db_table,
+        "tenant_pk": db_column(tenant_model._meta.pk),
+        "index_name": truncate_name("{}_{}_idx".format(table_name, column), connection.ops.max_name_length()),
+        "function": truncate_name("{}_set_{}".format(table_name, column), connection.ops.max_name_length()),
+        "fk": db_column(chain[0]),
+        "pk": db_column(model._meta.pk),
+        "policy": DIRECT_LINK.format(fk=column, fk_type=column_type),
+    }
+    tables = [table_name] + [field.related_model._meta.db_table for field in chain[:-1]]
+
+    with connection.cursor() as cursor:
+        cursor.execute(ADD_TENANT_COLUMN.format(**data))
+        cursor.execute(DENORMALIZE_FUNCTION.format(lookup=tenant_lookup(chain, "NEW"), **data))
+        cursor.execute(DENORMALIZE_TRIGGER.format(**data))
+
+        cursor.execute(FORCED_RLS_TABLES, [tables])
+        forced = [table for (table,) in cursor.fetchall()]
+
+        def backfill_batch(after: str, params: List[Any]) -> List[Tuple[Any]]:
+            # The owner of these tables can only see every row while RLS is not forced: that
+            # must never be committed, so it is lifted and restored within each batch.
+            with transaction.atomic(using=connection.alias):
+                for table in forced:
+                    cursor.execute(NO_FORCE_RLS.format(table_name=table))
+                cursor.execute(
+                    BACKFILL_TENANT_COLUMN.format(lookup=tenant_lookup(chain, table_name), after=after, **data),
+                    params + [batch_size],
+                )
+                rows = cursor.fetchall()
+                # Tables with pending (deferred) FK checks can't be altered.
+                connection.check_constraints()
+                for table in forced:
+                    cursor.execute(FORCE_RLS.format(table_name=table))
+            return rows
+
+        rows = backfill_batch("", [])
+        while rows:
+            rows = backfill_batch("WHERE {} > %s".format(data["pk"]), [max(pk for (pk,) in rows)])
+
+        cursor.execute(CREATE_TENANT_COLUMN_INDEX.format(**data))
+        cursor.execute(ALTER_POLICY.format(**data))
+
+
+def normalize_tenant(app_label: str, model_name: str, apps: Apps = apps, column: str = "tenant_id") -> None:
+    "Undo denormalize_tenant(): removing the column, and looking up the tenant through the FK again."
+    model = apps.get_model(app_label, model_name)
+    table_name = model._meta.db_table
+    connection = default_connection
+    data = {
+        "table_name": table_name,
+        "column": column,
+        "function": truncate_name("{}_set_{}".format(table_name, column), connection.ops.max_name_length()),
+        "policy": " AND ".join(get_policy_clauses(model, get_tenant_model(apps))),
+    }
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(ALTER_POLICY.format(**data))
+            cursor.execute(DROP_DENORMALIZE_TRIGGER.format(**data))
+            cursor.execute(DROP_DENORMALIZE_FUNCTION.format(**data))
+            cursor.execute(DROP_TENANT_COLUMN.format(**data))
+
+
+ACTIVE_TENANT = "occupation.active_tenant"
+USER_ID = "occupation.user_id"
+IS_SUPERUSER = "occupation.is_superuser"
+
+SET_CONFIG = "set_config(%s, %s, false)"
+SET_LOCAL_CONFIG = "set_config(%s, %s, true)"
+
+ACTIVATION_MODES = ("eager", "lazy", "transaction")
+
+# psycopg2.extensions.TRANSACTION_STATUS_IDLE, psycopg.pq.TransactionStatus.IDLE
+TRANSACTION_STATUS_IDLE = 0
+
+Config = Dict[str, str]
+
+# The settings that the current request (or task, or thread) wants the database to
+# see. This is never mutated: activation always sets a new dict.
+requested_config: ContextVar[Config] = ContextVar(
+    "occupation_requested_config",
+    default={ACTIVE_TENANT: "", USER_ID: "", IS_SUPERUSER: ""},
+)
+
+
+class ActivationState:
+    """
+    Record of the occupation settings we have applied to a database connection.
+
+    ``applied`` holds the values the connection has at session level. Values set
+    inside a transaction are held in ``uncommitted`` until that transaction commits.
+    A value that is missing from both is unknown: for instance, when it was set inside
+    a savepoint that might still be rolled back. ``skipped`` counts the number of
+    times we were able to avoid sending a ``set_config()`` statement because the
+    connection already had the requested values.
+    """
+
+    def __init__(self) -> None:
+        self.applied: Config = {}
+        self.uncommitted: Config = {}
+        self.requested: Optional[Config] = None
+        self.skipped = 0
+
+
+def get_activation_state(connection=default_connection) -> ActivationState:
+    state = getattr(connection, "occupation_state", None)
+    if state is None:
+        state = connection.occupation_state = ActivationState()
+    return state
+
+
+def get_requested_config() -> Config:
+    return requested_config.get()
+
+
+def request_config(values: Config) -> Config:
+    config = dict(requested_config.get(), **values)
+    requested_config.set(config)
+    return config
+
+
+def config_statement(values: Config, local: bool = False) -> Tuple[str, List[str]]:
+    return (
+        "SELECT {}".format(", ".join([SET_LOCAL_CONFIG if local else SET_CONFIG] * len(values))),
+        [param for item in values.items() for param in item],
+    )
+
+
+def in_transaction(connection=default_connection) -> bool:
+    "Has the current database transaction already executed a statement?"
+    return connection.connection.info.transaction_status != TRANSACTION_STATUS_IDLE
+
+
+def config_is_applied(values: Config, connection=default_connection) -> bool:
+    # A closed connection will start again without any of our settings.
+    if connection.connection is None:
+        return False
+
+    state = get_activation_state(connection)
+
+    if state.uncommitted and not in_transaction(connection):
+        # The transaction has finished: if it committed, these are already in applied.
+        state.uncommitted = {}
+
+    return all(state.uncommitted.get(key, state.applied.get(key)) == value for key, value in values.items())
+
+
+def record_config(values: Config, connection=default_connection) -> None:
+    state = get_activation_state(connection)
+
+    if connection.get_autocommit():
+        state.applied.update(values)
+    elif connection.in_atomic_block and not connection.savepoint_ids:
+        state.uncommitted.update(values)
+        transaction.on_commit(lambda: state.applied.update(values), using=connection.alias)
+    else:
+        # A rollback (to a savepoint) could undo these without us knowing.
+        for key in values:
+            state.applied.pop(key, None)
+            state.uncommitted.pop(key, None)
+
+
+def apply_config(values: Config, connection=default_connection) -> None:
+    """
+    Apply all of the supplied settings to the connection in a single statement,
+    unless the connection already has exactly these values.
+    """
+    if config_is_applied(values, connection):
+        get_activation_state(connection).skipped += 1
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(*config_statement(values))
+
+    record_config(values, connection)
+
+
+def install_execute_wrapper(connection=default_connection) -> None:
+    if apply_requested_config not in connection.execute_wrappers:
+        # Django's execute_wrapper() context manager removes the last wrapper from
+        # the list when it exits, so we need to be at the start.
+        connection.execute_wrappers.insert(0, apply_requested_config)
+
+
+def can_prefix_query(sql: str, params, many: bool, context) -> bool:
+    """
+    Can we send our settings in the same round trip as this query?
+
+    This relies on psycopg2 returning the results of the last statement, and
+    is not possible for executemany(), or for server-side (named) cursors.
+    """
+    return (
+        not many
+        and isinstance(params, (list, tuple))
+        and context["connection"].Database.__name__ == "psycopg2"
+        and getattr(context["cursor"].cursor, "name", None) is None
+    )
+
+
+def execute_config(execute, statement: str, params: List[str], context) -> None:
+    """
+    Send the settings before the query, in a separate statement.
+
+    A server-side (named) cursor may only execute the one query, so the settings
+    are sent on another cursor of the same connection, which shares its transaction.
+    """
+    if getattr(context["cursor"].cursor, "name", None) is None:
+        execute(statement, params, False, context)
+        return
+
+    connection = context["connection"]
+    with connection.wrap_database_errors, connection.connection.cursor() as cursor:
+        cursor.execute(statement, params)
+
+
+def apply_requested_config(execute, sql: str, params, many: bool, context):
+    """
+    Database execute wrapper that sends the requested settings, when they are
+    activated lazily, or scoped to a transaction.
+    """
+    mode = settings.OCCUPATION_ACTIVATION_MODE
+    if mode == "lazy":
+        return apply_pending_config(execute, sql, params, many, context)
+    if mode == "transaction":
+        return apply_local_config(execute, sql, params, many, context)
+    return execute(sql, params, many, context)
+
+
+def apply_pending_config(execute, sql: str, params, many: bool, context):
+    """
+    Send the requested settings before the query, unless the connection already
+    has them.
+    """
+    connection = context["connection"]
+    state = get_activation_state(connection)
+    values = get_requested_config()
+    is_new, state.requested = values is not state.requested, values
+
+    if config_is_applied(values, connection):
+        state.skipped += is_new
+        return execute(sql, params, many, context)
+
+    statement, config_params = config_statement(values)
+
+    if not can_prefix_query(sql, params, many, context):
+        execute_config(execute, statement, config_params, context)
+        record_config(values, connection)
+        return execute(sql, params, many, context)
+
+    # If this fails, the settings are rolled back with the query, and we'll try again next time.
+    result = execute("{}; {}".format(statement, sql), config_params + list(params), many, context)
+    record_config(values, connection)
+    return result
+
+
+def apply_local_config(execute, sql: str, params, many: bool, context):
+    """
+    Apply the requested settings to the transaction that this query is about to start.
+
+    Outside of an atomic block, every query is its own transaction, so the
+    settings must be sent with the query each time.
+    """
+    connection = context["connection"]
+
+    if in_transaction(connection):
+        return execute(sql, params, many, context)
+
+    statement, config_params = config_statement(get_requested_config(), local=True)
+
+    if can_prefix_query(sql, params, many, context):
+        # Statements sent in the one query string share a transaction, even in autocommit mode.
+        return execute("{}; {}".format(statement, sql), config_params + list(params), many, context)
+
+    if connection.get_autocommit():
+        with transaction.atomic(using=connection.alias):
+            execute_config(execute, statement, config_params, context)
+            return execute(sql, params, many, context)
+
+    execute_config(execute, statement, config_params, context)
+    return execute(sql, params, many, context)
+
+
+def set_config(values: Config, connection=default_connection) -> None:
+    request_config(values)
+    if settings.OCCUPATION_ACTIVATION_MODE == "eager":
+        apply_config(values, connection)
+    else:
+        install_execute_wrapper(connection)
+
+
+def activation_config(tenant_id: str, user_id: Optional[str] = None, is_superuser: bool = False) -> Config:
+    # Superuser status must never outlive the activation that granted it.
+    values = {ACTIVE_TENANT: str(tenant_id or ""), IS_SUPERUSER: "true" if user_id is not None and is_superuser else ""}
+    if user_id is not None:
+        values[USER_ID] = str(user_id)
+    return values
+
+
+def activate_tenant(
+    tenant_id: str,
+    user_id: Optional[str] = None,
+    connection=default_connection,
+    is_superuser: bool = False,
+) -> None:
+    """
+    Activate the tenant (and user) for queries on this connection.
+
+    Superuser status is cleared by every activation, unless it is passed along
+    with the user.
+    """
+    set_config(activation_config(tenant_id, user_id, is_superuser), connection=connection)
+
+
+async def aactivate_tenant(tenant_id: str, user_id: Optional[str] = None, is_superuser: bool = False) -> None:
+    """
+    Activate the tenant from async code.
+
+    In lazy and transaction modes this only records the values in a context variable,
+    which is visible to the thread that the async ORM runs queries in: no thread
+    hand-off is required. Eager activation needs the database, so it must hand off.
+    """
+    if settings.OCCUPATION_ACTIVATION_MODE == "eager":
+        await sync_to_async(activate_tenant)(tenant_id, user_id=user_id, is_superuser=is_superuser)
+    else:
+        request_config(activation_config(tenant_id, user_id, is_superuser))
+
+
+def get_active_tenant() -> str:
+    "The id of the tenant that is active in the current context, or an empty string."
+    return get_requested_config()[ACTIVE_TENANT]
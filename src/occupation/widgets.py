@@ -0,0 +1,43 @@
+from typing import Any, Dict, Optional
+
+from django import forms
+from django.utils.translation import gettext as _
+
+from occupation.middleware import TENANT_SEARCH_PATH
+
+
+class TenantSelect(forms.Select):
+    """
+    Select a tenant by searching the tenants the user may see, using the admin's
+    autocomplete widget: only the selected tenant needs to be in the choices.
+    """
+
+    class Media:
+        js = (
+            "admin/js/vendor/jquery/jquery.js",
+            "admin/js/vendor/select2/select2.full.js",
+            "admin/js/jquery.init.js",
+            "admin/js/autocomplete.js",
+        )
+        css = {
+            "screen": (
+                "admin/css/vendor/select2/select2.css",
+                "admin/css/autocomplete.css",
+            ),
+        }
+
+    def build_attrs(self, base_attrs: Dict[str, Any], extra_attrs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        attrs = super().build_attrs(base_attrs, extra_attrs=extra_attrs)
+        attrs.update(
+            {
+                "class": "admin-autocomplete",
+                "data-ajax--cache": "true",
+                "data-ajax--delay": 250,
+                "data-ajax--type": "GET",
+                "data-ajax--url": TENANT_SEARCH_PATH,
+                "data-theme": "admin-autocomplete",
+                "data-allow-clear": "true",
+                "data-placeholder": _("No tenant. Please select..."),
+            }
+        )
+        return attrs
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+import occupation.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tests", "0001_initial")]
+
+    operations = [
+        migrations.CreateModel(
+            name="RestrictedChildModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        verbose_name="ID",
+                        serialize=False,
+                        auto_created=True,
+                        primary_key=True,
+                    ),
+                ),
+                ("name", models.CharField(max_length=10)),
+                (
+                    "parent",
+                    models.ForeignKey(on_delete=models.CASCADE, to="tests.RestrictedModel"),
+                ),
+            ],
+        ),
+        occupation.operations.EnableRowLevelSecurity("RestrictedChildModel"),
+    ]
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db import migrations, models
+
+import occupation.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tests", "0002_restrictedchildmodel")]
+
+    operations = [
+        migrations.CreateModel(
+            name="PartitionedModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        verbose_name="ID",
+                        serialize=False,
+                        auto_created=True,
+                        primary_key=True,
+                    ),
+                ),
+                ("name", models.CharField(db_index=True, max_length=10)),
+                (
+                    "tenant",
+                    models.ForeignKey(
+                        on_delete=models.CASCADE,
+                        related_name="+",
+                        to=settings.OCCUPATION_TENANT_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        occupation.operations.EnableRowLevelSecurity("PartitionedModel"),
+    ]
@@ -0,0 +1,46 @@
+import django
+from django.conf import settings
+from django.db import migrations, models
+
+import occupation.operations
+import occupation.utils
+
+# Field.db_default needs Django 5.0: SetTenantDefault gives the column its default regardless.
+TENANT_DB_DEFAULT = {"db_default": occupation.utils.ActiveTenant()} if django.VERSION >= (5, 0) else {}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tests", "0003_partitionedmodel"),
+        ("occupation", "0004_active_tenant_function"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DefaultTenantModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        verbose_name="ID",
+                        serialize=False,
+                        auto_created=True,
+                        primary_key=True,
+                    ),
+                ),
+                (
+                    "tenant",
+                    models.ForeignKey(
+                        on_delete=models.CASCADE,
+                        related_name="+",
+                        to=settings.OCCUPATION_TENANT_MODEL,
+                        **TENANT_DB_DEFAULT,
+                    ),
+                ),
+                ("name", models.CharField(max_length=10)),
+            ],
+        ),
+        occupation.operations.SetTenantDefault("DefaultTenantModel"),
+        occupation.operations.EnableRowLevelSecurity("DefaultTenantModel"),
+    ]
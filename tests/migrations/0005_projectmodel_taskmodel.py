@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.db import migrations, models
+
+import occupation.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tests", "0004_defaulttenantmodel")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProjectModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        verbose_name="ID",
+                        serialize=False,
+                        auto_created=True,
+                        primary_key=True,
+                    ),
+                ),
+                ("name", models.CharField(max_length=10)),
+                (
+                    "tenant",
+                    models.ForeignKey(
+                        on_delete=models.CASCADE,
+                        related_name="+",
+                        to=settings.OCCUPATION_TENANT_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="TaskModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        verbose_name="ID",
+                        serialize=False,
+                        auto_created=True,
+                        primary_key=True,
+                    ),
+                ),
+                ("name", models.CharField(max_length=10)),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=models.CASCADE,
+                        related_name="tasks",
+                        to="tests.projectmodel",
+                    ),
+                ),
+            ],
+        ),
+        occupation.operations.EnableRowLevelSecurity("ProjectModel"),
+        occupation.operations.EnableRowLevelSecurity("TaskModel"),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tests", "0005_projectmodel_taskmodel")]
+
+    operations = [
+        migrations.AddField(
+            model_name="projectmodel",
+            name="parent",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=models.CASCADE,
+                related_name="subprojects",
+                to="tests.projectmodel",
+            ),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db import migrations, models
+
+import occupation.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tests", "0006_projectmodel_parent")]
+
+    operations = [
+        migrations.CreateModel(
+            name="MilestoneModel",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        verbose_name="ID",
+                        serialize=False,
+                        auto_created=True,
+                        primary_key=True,
+                    ),
+                ),
+                ("name", models.CharField(max_length=10)),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=models.CASCADE,
+                        related_name="milestones",
+                        to="tests.projectmodel",
+                    ),
+                ),
+                (
+                    "tenant",
+                    models.ForeignKey(
+                        on_delete=models.CASCADE,
+                        related_name="+",
+                        to=settings.OCCUPATION_TENANT_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        occupation.operations.EnableRowLevelSecurity("MilestoneModel"),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+import occupation.operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tests", "0007_milestonemodel")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProgrammeModel",
+            fields=[
+                (
+                    "projectmodel_ptr",
+                    models.OneToOneField(
+                        auto_created=True,
+                        on_delete=models.CASCADE,
+                        parent_link=True,
+                        primary_key=True,
+                        serialize=False,
+                        to="tests.projectmodel",
+                    ),
+                ),
+                ("budget", models.PositiveIntegerField(default=0)),
+            ],
+            bases=("tests.projectmodel",),
+        ),
+        occupation.operations.EnableRowLevelSecurity("ProgrammeModel"),
+    ]
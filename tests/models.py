@@ -1,6 +1,13 @@
+import django
 from django.db import models
 
 from occupation.base import BaseRelatedModel
+from occupation.utils import ActiveTenant
+
+# Field.db_default needs Django 5.0: before that, the ORM always inserts the tenant
+# column, and the default that SetTenantDefault gives it only applies to raw SQL.
+HAS_DB_DEFAULT = django.VERSION >= (5, 0)
+TENANT_DB_DEFAULT = {"db_default": ActiveTenant()} if HAS_DB_DEFAULT else {}
 
 
 class RelatedModel(models.Model):
@@ -26,3 +33,54 @@ class RestrictedModel(BaseRelatedModel):
 
     def __str__(self):
         return f'{self.tenant.name}: {self.name}'
+
+
+class RestrictedChildModel(models.Model):
+    parent = models.ForeignKey(RestrictedModel, on_delete=models.CASCADE)
+    name = models.CharField(max_length=10)
+
+    def __str__(self):
+        return f'{self.parent}: {self.name}'
+
+
+class PartitionedModel(BaseRelatedModel):
+    name = models.CharField(max_length=10, db_index=True)
+
+    def __str__(self):
+        return f'{self.tenant.name}: {self.name}'
+
+
+class DefaultTenantModel(models.Model):
+    tenant = models.ForeignKey("occupation.Tenant", related_name="+", on_delete=models.CASCADE, **TENANT_DB_DEFAULT)
+    name = models.CharField(max_length=10)
+
+    def __str__(self):
+        return f'{self.tenant.name}: {self.name}'
+
+
+class ProjectModel(BaseRelatedModel):
+    name = models.CharField(max_length=10)
+    parent = models.ForeignKey("self", null=True, blank=True, related_name="subprojects", on_delete=models.CASCADE)
+
+    def __str__(self):
+        return f'{self.tenant.name}: {self.name}'
+
+
+class ProgrammeModel(ProjectModel):
+    budget = models.PositiveIntegerField(default=0)
+
+
+class TaskModel(models.Model):
+    project = models.ForeignKey(ProjectModel, related_name="tasks", on_delete=models.CASCADE)
+    name = models.CharField(max_length=10)
+
+    def __str__(self):
+        return f'{self.project}: {self.name}'
+
+
+class MilestoneModel(BaseRelatedModel):
+    project = models.ForeignKey(ProjectModel, related_name="milestones", on_delete=models.CASCADE)
+    name = models.CharField(max_length=10)
+
+    def __str__(self):
+        return f'{self.project}: {self.name}'
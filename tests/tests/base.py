@@ -1,12 +1,20 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 from occupation.utils import get_tenant_model
 
 Tenant = get_tenant_model()
 
 
-class TenantTestCase(TestCase):
-    def build_tenants(self, count):
-        tenants = [Tenant(name="{}".format(i)) for i in range(count)]
+class BuildTenantsMixin:
+    def build_tenants(self, count, start=0):
+        tenants = [Tenant(name="{}".format(i)) for i in range(start, start + count)]
         Tenant.objects.bulk_create(tenants)
         return tenants
+
+
+class TenantTestCase(BuildTenantsMixin, TestCase):
+    pass
+
+
+class TenantTransactionTestCase(BuildTenantsMixin, TransactionTestCase):
+    pass
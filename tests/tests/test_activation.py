@@ -0,0 +1,206 @@
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, connection, transaction
+from django.test import TransactionTestCase, override_settings
+
+from occupation.utils import ACTIVE_TENANT, aactivate_tenant, activate_tenant, get_activation_state, get_active_tenant
+
+from ..models import RestrictedModel
+from .base import Tenant, TenantTransactionTestCase
+
+
+def current_settings():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT current_setting('occupation.active_tenant'), current_setting('occupation.user_id')")
+        return cursor.fetchone()
+
+
+def superuser_setting():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT current_setting('occupation.is_superuser')")
+        return cursor.fetchone()[0]
+
+
+class TestActivation(TransactionTestCase):
+    def test_tenant_and_user_are_set_in_one_query(self):
+        connection.ensure_connection()
+        with self.assertNumQueries(1):
+            activate_tenant(1, user_id=2)
+        self.assertEqual(("1", "2"), current_settings())
+
+    def test_unchanged_values_are_not_sent_again(self):
+        activate_tenant(1, user_id=2)
+        skipped = get_activation_state().skipped
+
+        with self.assertNumQueries(0):
+            activate_tenant(1, user_id=2)
+            activate_tenant("1")
+        self.assertEqual(skipped + 2, get_activation_state().skipped)
+
+        with self.assertNumQueries(1):
+            activate_tenant(3, user_id=2)
+        self.assertEqual(("3", "2"), current_settings())
+
+    def test_values_set_in_a_transaction_are_not_trusted(self):
+        activate_tenant(1)
+        with transaction.atomic():
+            activate_tenant(2)
+            transaction.set_rollback(True)
+        self.assertEqual("1", current_settings()[0])
+
+        with self.assertNumQueries(1):
+            activate_tenant(2)
+        self.assertEqual("2", current_settings()[0])
+
+    def test_superuser_status_is_only_set_with_user(self):
+        activate_tenant(1, user_id=2, is_superuser=True)
+        self.assertEqual("true", superuser_setting())
+
+        activate_tenant(3)
+        self.assertEqual("", superuser_setting())
+
+        activate_tenant(3, is_superuser=True)
+        self.assertEqual("", superuser_setting())
+
+        activate_tenant(3, user_id=2, is_superuser=True)
+        activate_tenant(3, user_id=4)
+        self.assertEqual("", superuser_setting())
+
+    def test_reconnecting_resets_state(self):
+        activate_tenant(1, user_id=2)
+        connection.close()
+
+        activate_tenant(1, user_id=2)
+        self.assertEqual(("1", "2"), current_settings())
+
+
+@override_settings(OCCUPATION_ACTIVATION_MODE="lazy")
+class TestLazyActivation(TransactionTestCase):
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    def test_activation_does_not_query(self):
+        connection.ensure_connection()
+        with self.assertNumQueries(0):
+            activate_tenant(1, user_id=2)
+
+    def test_settings_are_sent_with_next_query(self):
+        connection.ensure_connection()
+        activate_tenant(1, user_id=2)
+        with self.assertNumQueries(1):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting(%s)", [ACTIVE_TENANT])
+                self.assertEqual(("1",), cursor.fetchone())
+
+        # Queries without parameters can't have the settings prefixed, so they
+        # are sent in a separate statement first.
+        activate_tenant(3, user_id=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(("3", "2"), current_settings())
+
+    def test_unchanged_settings_are_not_sent(self):
+        activate_tenant(1, user_id=2)
+        current_settings()
+        activate_tenant(1, user_id=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(("1", "2"), current_settings())
+
+    def test_settings_are_resent_after_failed_query(self):
+        connection.ensure_connection()
+        activate_tenant(1, user_id=2)
+        with self.assertRaises(DatabaseError):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 / %s", [0])
+        self.assertEqual(("1", "2"), current_settings())
+
+    def test_server_side_cursor(self):
+        tenant = Tenant.objects.create(name="a")
+        activate_tenant(tenant.pk)
+        RestrictedModel.objects.create(tenant=tenant, name="a")
+
+        connection.close()
+        activate_tenant(tenant.pk, user_id=2)
+        self.assertEqual(["a"], [obj.name for obj in RestrictedModel.objects.iterator()])
+
+    def test_request_without_queries_does_not_hit_database(self):
+        connection.ensure_connection()
+        with self.assertNumQueries(0):
+            self.client.get("/")
+
+
+@override_settings(OCCUPATION_ACTIVATION_MODE="transaction")
+class TestTransactionActivation(TenantTransactionTestCase):
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    def test_activation_does_not_query(self):
+        connection.ensure_connection()
+        with self.assertNumQueries(0):
+            activate_tenant(1, user_id=2)
+
+    def test_settings_do_not_outlive_the_query(self):
+        connection.close()
+        activate_tenant(1, user_id=2)
+        with self.assertNumQueries(1):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting(%s)", [ACTIVE_TENANT])
+                self.assertEqual(("1",), cursor.fetchone())
+
+        self.assertEqual(("1", "2"), current_settings())
+
+        with self.settings(OCCUPATION_ACTIVATION_MODE="eager"):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting('occupation.active_tenant', true)")
+                self.assertIn(cursor.fetchone()[0], ("", None))
+
+    def test_settings_are_applied_once_per_transaction(self):
+        activate_tenant(1, user_id=2)
+        with transaction.atomic():
+            self.assertEqual(("1", "2"), current_settings())
+            with transaction.atomic():
+                self.assertEqual(("1", "2"), current_settings())
+            activate_tenant(3)
+            # Only the next transaction will see the new tenant.
+            self.assertEqual(("1", "2"), current_settings())
+        self.assertEqual(("3", "2"), current_settings())
+
+    def test_row_level_security_is_applied(self):
+        a, b = self.build_tenants(2)
+
+        activate_tenant(a.pk)
+        RestrictedModel.objects.create(tenant=a, name="a")
+        self.assertEqual(1, RestrictedModel.objects.count())
+
+        activate_tenant(b.pk)
+        self.assertEqual(0, RestrictedModel.objects.count())
+        with transaction.atomic():
+            self.assertEqual(0, RestrictedModel.objects.count())
+
+        activate_tenant(a.pk)
+        with transaction.atomic():
+            self.assertEqual(["a"], [obj.name for obj in RestrictedModel.objects.all()])
+
+    def test_server_side_cursor(self):
+        tenant = Tenant.objects.create(name="a")
+        activate_tenant(tenant.pk)
+        RestrictedModel.objects.create(tenant=tenant, name="a")
+
+        self.assertEqual(["a"], [obj.name for obj in RestrictedModel.objects.iterator()])
+        with transaction.atomic():
+            self.assertEqual(["a"], [obj.name for obj in RestrictedModel.objects.iterator()])
+
+
+class TestAsyncActivation(TransactionTestCase):
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    @override_settings(OCCUPATION_ACTIVATION_MODE="lazy")
+    async def test_lazy_activation_does_not_query(self):
+        # Any database access from here would raise SynchronousOnlyOperation.
+        await aactivate_tenant(1, user_id=2)
+        self.assertEqual("1", get_active_tenant())
+        self.assertEqual(("1", "2"), await sync_to_async(current_settings)())
+
+    async def test_eager_activation(self):
+        await aactivate_tenant(1, user_id=2)
+        self.assertEqual("1", get_active_tenant())
+        self.assertEqual(("1", "2"), await sync_to_async(current_settings)())
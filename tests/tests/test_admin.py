@@ -1,11 +1,46 @@
+from django.contrib import admin
 from django.contrib.auth.models import Permission, User
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from occupation.utils import activate_tenant
+from occupation.admin import EstimatedCountChangeList, TenantFormMixin
+from occupation.paginator import EstimatedCountPaginator, estimate_count
+from occupation.utils import activate_tenant, get_tenant_field, get_tenant_fields
 
-from ..models import DistinctModel, RestrictedModel
+from ..models import DistinctModel, RelatedModel, RestrictedChildModel, RestrictedModel
 from .base import TenantTestCase
 
 
+class TestTenantFields(SimpleTestCase):
+    def test_registry_is_built_when_ready(self):
+        self.assertIs(get_tenant_fields(), get_tenant_fields())
+        self.assertEqual(["tenant"], [field.name for field in get_tenant_fields()["tests.restrictedmodel"]])
+        self.assertEqual(
+            ["parent", "tenant"], [field.name for field in get_tenant_fields()["tests.restrictedchildmodel"]]
+        )
+        self.assertNotIn("tests.distinctmodel", get_tenant_fields())
+
+    def test_only_direct_fields_are_tenant_fields(self):
+        self.assertEqual("tenant", get_tenant_field(RelatedModel).name)
+        self.assertEqual("tenant", get_tenant_field(RestrictedModel(name="a")).name)
+        self.assertIsNone(get_tenant_field(RestrictedChildModel))
+        self.assertIsNone(get_tenant_field(DistinctModel))
+
+    def test_tenant_form_is_only_built_once(self):
+        model_admin = admin.site._registry[RestrictedModel]
+        form = model_admin.form
+        self.assertTrue(issubclass(form, TenantFormMixin))
+
+        request = RequestFactory().get("/")
+        first, second = model_admin.get_form(request, fields=["name"]), model_admin.get_form(request, fields=["name"])
+        self.assertIs(form, model_admin.form)
+        self.assertIs(form.clean, first.clean)
+        self.assertIs(first.clean, second.clean)
+
+        self.assertFalse(issubclass(admin.site._registry[DistinctModel].form, TenantFormMixin))
+
+
 class TestAdmin(TenantTestCase):
     def user(self):
         user = User.objects.create_user(
@@ -117,6 +152,33 @@ class TestAdmin(TenantTestCase):
         self.assertTemplateUsed(response, "admin/change-tenant.html")
         self.assertTrue(b'select name="__tenant"' in response.content)
 
+    @override_settings(OCCUPATION_ADMIN_TENANT_SEARCH=True)
+    def test_tenant_search_widget_is_in_admin(self):
+        a, b = self.build_tenants(2)
+        user = self.user()
+        user.visible_tenants.add(a, b)
+        self.client.force_login(user)
+        self.client.get("/__change_tenant__/{}/".format(a.pk))
+
+        response = self.client.get("/admin/")
+        self.assertContains(response, 'data-ajax--url="/__search_tenants__/"')
+        self.assertContains(response, '<option value="{}" selected>0</option>'.format(a.pk), html=True)
+        self.assertNotContains(response, '<option value="{}">1</option>'.format(b.pk), html=True)
+
+    @override_settings(OCCUPATION_ADMIN_TENANT_SEARCH=True)
+    def test_tenant_search_scripts_are_only_loaded_once(self):
+        a, b = self.build_tenants(2)
+        user = self.user()
+        user.visible_tenants.add(a, b)
+        self.client.force_login(user)
+        self.client.get("/__change_tenant__/{}/".format(a.pk))
+
+        for url in ("/admin/", "/admin/tests/restrictedmodel/", "/admin/tests/restrictedmodel/add/"):
+            response = self.client.get(url)
+            self.assertContains(response, "admin/js/vendor/select2/select2.full.js", count=1)
+            self.assertContains(response, "admin/js/jquery.init.js", count=1)
+            self.assertContains(response, "admin/js/autocomplete.js", count=1)
+
     def test_tenant_included_in_admin_url(self):
         a, b = self.build_tenants(2)
         user = self.user()
@@ -174,3 +236,37 @@ class TestAdmin(TenantTestCase):
             {'__all__': ['You must activate a tenant before saving this model.']},
             response.context['adminform'].errors,
         )
+
+
+class TestEstimatedCount(TenantTestCase):
+    def setUp(self):
+        self.tenant = self.build_tenants(1)[0]
+        activate_tenant(self.tenant.pk)
+        RestrictedModel.objects.bulk_create([RestrictedModel(tenant=self.tenant, name=name) for name in "abc"])
+        activate_tenant("")
+
+        user = User.objects.create_superuser(username="username", password="password")
+        user.visible_tenants.add(self.tenant)
+        self.client.force_login(user)
+        self.client.get("/__change_tenant__/{}/".format(self.tenant.pk))
+
+    def test_only_tenant_models_are_estimated(self):
+        self.assertIs(EstimatedCountPaginator, admin.site._registry[RestrictedModel].paginator)
+        self.assertIsNot(EstimatedCountPaginator, admin.site._registry[DistinctModel].paginator)
+
+    def test_small_changelists_are_counted(self):
+        response = self.client.get("/admin/tests/restrictedmodel/")
+        self.assertIsInstance(response.context["cl"], EstimatedCountChangeList)
+        self.assertEqual(3, response.context["cl"].result_count)
+        self.assertEqual(3, response.context["cl"].full_result_count)
+
+    @override_settings(OCCUPATION_ESTIMATED_COUNT_THRESHOLD=0)
+    def test_large_changelists_are_estimated(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/admin/tests/restrictedmodel/")
+
+        self.assertFalse([query for query in queries if "COUNT(" in query["sql"]])
+        activate_tenant(self.tenant.pk)
+        estimate = estimate_count(RestrictedModel.objects.all())
+        self.assertEqual(estimate, response.context["cl"].result_count)
+        self.assertEqual(estimate, response.context["cl"].full_result_count)
@@ -0,0 +1,68 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+
+from occupation.cache import get_visible_tenants
+
+from .base import TenantTestCase
+
+CREDENTIALS = {"username": "test", "password": "test"}
+
+
+@override_settings(OCCUPATION_CACHE="default")
+class TestVisibleTenantsCache(TenantTestCase):
+    def setUp(self):
+        cache.clear()
+        self.a, self.b, self.c = self.build_tenants(3)
+        self.user = User.objects.create_user(**CREDENTIALS)
+        self.user.visible_tenants.add(self.a, self.b)
+
+    def test_visible_tenants_are_cached(self):
+        self.assertEqual({self.a.pk: "0", self.b.pk: "1"}, get_visible_tenants(self.user))
+        with self.assertNumQueries(0):
+            self.assertEqual({self.a.pk: "0", self.b.pk: "1"}, get_visible_tenants(self.user))
+
+    def test_switching_tenant_uses_cache(self):
+        self.client.force_login(self.user)
+        self.client.get("/__change_tenant__/{}/".format(self.a.pk))
+
+        # Only the user is loaded.
+        with self.assertNumQueries(1):
+            self.client.get("/__change_tenant__/{}/".format(self.b.pk))
+        self.assertEqual(self.b.pk, self.client.session["active_tenant"])
+        self.assertEqual("1", self.client.session["active_tenant_name"])
+
+        response = self.client.get("/__change_tenant__/{}/".format(self.c.pk))
+        self.assertEqual(403, response.status_code)
+
+        response = self.client.get("/__change_tenant__/foo/")
+        self.assertEqual(403, response.status_code)
+
+    def test_adding_tenant_to_user_invalidates(self):
+        get_visible_tenants(self.user)
+        self.user.visible_tenants.add(self.c)
+        self.assertIn(self.c.pk, get_visible_tenants(self.user))
+
+    def test_adding_user_to_tenant_invalidates(self):
+        get_visible_tenants(self.user)
+        self.c.users.add(self.user)
+        self.assertIn(self.c.pk, get_visible_tenants(self.user))
+
+    def test_removing_user_from_tenant_invalidates(self):
+        get_visible_tenants(self.user)
+        self.a.users.remove(self.user)
+        self.assertNotIn(self.a.pk, get_visible_tenants(self.user))
+
+    def test_clearing_tenant_users_invalidates(self):
+        get_visible_tenants(self.user)
+        self.a.users.clear()
+        self.assertNotIn(self.a.pk, get_visible_tenants(self.user))
+
+    def test_changing_tenant_invalidates(self):
+        get_visible_tenants(self.user)
+        self.a.name = "renamed"
+        self.a.save()
+        self.assertEqual("renamed", get_visible_tenants(self.user)[self.a.pk])
+
+        self.a.delete()
+        self.assertNotIn(self.a.pk, get_visible_tenants(self.user))
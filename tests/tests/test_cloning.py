@@ -0,0 +1,119 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+
+from occupation.cloning import clone_tenant, get_clone_models
+from occupation.utils import CREATE_SUPERUSER_POLICY, DROP_SUPERUSER_POLICY, activate_tenant, get_active_tenant
+
+from ..models import DefaultTenantModel, MilestoneModel, ProjectModel, RestrictedModel, TaskModel
+from .base import Tenant, TenantTransactionTestCase
+
+
+def tasks(tenant):
+    activate_tenant(tenant.pk)
+    try:
+        return sorted(
+            (task.project.name, task.name, task.project.tenant_id) for task in TaskModel.objects.select_related("project")
+        )
+    finally:
+        activate_tenant("")
+
+
+class TestCloneTenant(TenantTransactionTestCase):
+    def setUp(self):
+        self.source, self.target = self.build_tenants(2)
+        activate_tenant(self.source.pk)
+        self.projects = [ProjectModel.objects.create(tenant=self.source, name=name) for name in "ab"]
+        for project in self.projects:
+            TaskModel.objects.bulk_create([TaskModel(project=project, name=name) for name in "xy"])
+        DefaultTenantModel.objects.create(tenant=self.source, name="a")
+        activate_tenant("")
+
+    def tearDown(self):
+        activate_tenant("")
+
+    def test_models_are_in_dependency_order(self):
+        self.assertEqual([ProjectModel, TaskModel], get_clone_models([TaskModel, ProjectModel]))
+
+    def test_models_follow_those_their_policies_refer_to(self):
+        # Both are linked to the tenant directly, but the policy on milestones also checks their project.
+        with mock.patch(
+            "occupation.cloning.get_row_level_security_models", return_value=[MilestoneModel, ProjectModel]
+        ):
+            self.assertEqual([ProjectModel, MilestoneModel], get_clone_models())
+
+        activate_tenant(self.source.pk)
+        MilestoneModel.objects.create(tenant=self.source, project=self.projects[0], name="m")
+        activate_tenant("")
+        self.assertEqual(
+            {"tests.ProjectModel": 2, "tests.MilestoneModel": 1},
+            clone_tenant(self.source.pk, self.target.pk, [MilestoneModel, ProjectModel]),
+        )
+
+    def test_clone(self):
+        self.assertEqual(
+            {"tests.DefaultTenantModel": 1, "tests.ProjectModel": 2, "tests.TaskModel": 4},
+            clone_tenant(self.source.pk, self.target.pk, [TaskModel, ProjectModel, DefaultTenantModel]),
+        )
+        self.assertEqual(
+            [("a", "x", self.target.pk), ("a", "y", self.target.pk), ("b", "x", self.target.pk), ("b", "y", self.target.pk)],
+            tasks(self.target),
+        )
+        # The source tenant's rows are untouched.
+        self.assertEqual(
+            [("a", "x", self.source.pk), ("a", "y", self.source.pk), ("b", "x", self.source.pk), ("b", "y", self.source.pk)],
+            tasks(self.source),
+        )
+
+        activate_tenant(self.target.pk)
+        self.assertFalse(ProjectModel.objects.filter(pk__in=[project.pk for project in self.projects]).exists())
+        self.assertEqual(["a"], [obj.name for obj in DefaultTenantModel.objects.filter(tenant=self.target)])
+
+    def test_active_tenant_is_unchanged(self):
+        activate_tenant(self.target.pk)
+        clone_tenant(self.source.pk, self.target.pk, [ProjectModel])
+        self.assertEqual(str(self.target.pk), get_active_tenant())
+        self.assertEqual(2, ProjectModel.objects.count())
+
+    def test_superuser_does_not_clone_every_tenant(self):
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_SUPERUSER_POLICY.format(table_name="tests_projectmodel"))
+        self.addCleanup(self.drop_superuser_policy)
+        other = Tenant.objects.create(name="other")
+        activate_tenant(other.pk)
+        ProjectModel.objects.create(tenant=other, name="other")
+
+        activate_tenant(self.target.pk, user_id=1, is_superuser=True)
+        self.assertEqual({"tests.ProjectModel": 2}, clone_tenant(self.source.pk, self.target.pk, [ProjectModel]))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT current_setting('occupation.is_superuser')")
+            self.assertEqual(("true",), cursor.fetchone())
+
+    def drop_superuser_policy(self):
+        with connection.cursor() as cursor:
+            cursor.execute(DROP_SUPERUSER_POLICY.format(table_name="tests_projectmodel"))
+
+    def test_failure_rolls_back(self):
+        activate_tenant(self.source.pk)
+        RestrictedModel.objects.create(tenant=self.source, name="unique")
+        activate_tenant("")
+
+        with self.assertRaises(DatabaseError):
+            clone_tenant(self.source.pk, self.target.pk, [ProjectModel, TaskModel, RestrictedModel])
+
+        self.assertEqual([], tasks(self.target))
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command("clone_tenant", str(self.source.pk), str(self.target.pk), "tests.ProjectModel", stdout=stdout)
+        self.assertEqual("Cloned 2 row(s) of tests.ProjectModel\n", stdout.getvalue())
+
+    def test_command_unknown_tenant(self):
+        with self.assertRaises(CommandError):
+            call_command("clone_tenant", str(self.source.pk), "0")
+
+    def test_command_invalid_tenant(self):
+        with self.assertRaises(CommandError):
+            call_command("clone_tenant", str(self.source.pk), "target")
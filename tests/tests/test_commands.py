@@ -0,0 +1,193 @@
+import json
+import os
+import tempfile
+import unittest
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.db import connections
+
+from occupation.utils import activate_tenant, get_active_tenant
+
+from ..models import HAS_DB_DEFAULT, DefaultTenantModel, ProgrammeModel, RestrictedChildModel, RestrictedModel
+from .base import Tenant, TenantTransactionTestCase
+
+
+class TestExplain(TenantTransactionTestCase):
+    def setUp(self):
+        self.tenants = self.build_tenants(2)
+        for tenant in self.tenants:
+            activate_tenant(tenant.pk)
+            parent = RestrictedModel.objects.create(tenant=tenant, name=tenant.name)
+            RestrictedChildModel.objects.create(parent=parent, name=tenant.name)
+        activate_tenant("")
+
+    def explain(self, *args):
+        stdout = StringIO()
+        call_command("occupation_explain", *args, tenant=self.tenants[0].pk, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_json(self):
+        results = json.loads(self.explain("--json"))
+        self.assertEqual(
+            [
+                "tests.RestrictedModel",
+                "tests.RestrictedChildModel",
+                "tests.PartitionedModel",
+                "tests.DefaultTenantModel",
+                "tests.ProjectModel",
+                "tests.ProgrammeModel",
+                "tests.TaskModel",
+                "tests.MilestoneModel",
+            ],
+            [r["model"] for r in results],
+        )
+
+        restricted, child, _partitioned, _default, _project, _programme, _task, _milestone = results
+        self.assertEqual(1, restricted["depth"])
+        self.assertEqual(2, child["depth"])
+        self.assertEqual(1, restricted["policy"]["rows"])
+        self.assertTrue(restricted["policy"]["index_used"])
+        # The baseline selects the same rows, without the policy.
+        self.assertEqual(1, restricted["baseline"]["rows"])
+        self.assertEqual(1, child["baseline"]["rows"])
+        self.assertEqual(1, child["policy"]["rows_filtered"])
+        self.assertIsNotNone(restricted["overhead"])
+
+        self.assertEqual("", get_active_tenant())
+        # Row level security is forced again afterwards.
+        self.assertEqual(0, RestrictedModel.objects.count())
+
+    def test_text(self):
+        output = self.explain("tests.RestrictedModel", "tests.DistinctModel")
+        self.assertIn("tests.RestrictedModel (tests_restrictedmodel): 1 FK(s) to the tenant", output)
+        self.assertIn("overhead", output)
+        self.assertNotIn("DistinctModel", output)
+
+    def test_unknown_model(self):
+        with self.assertRaises(CommandError):
+            self.explain("tests.MissingModel")
+
+
+# The fixture leaves the tenant out, for the database to fill in.
+@unittest.skipUnless(HAS_DB_DEFAULT, "Field.db_default needs Django 5.0")
+class TestLoadData(TenantTransactionTestCase):
+    def setUp(self):
+        self.tenants = self.build_tenants(3)
+
+    def tearDown(self):
+        activate_tenant("")
+
+    def loaddata(self, *args):
+        stdout = StringIO()
+        call_command("loaddata", "default_tenant", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def loaded(self):
+        counts = []
+        for tenant in self.tenants:
+            activate_tenant(tenant.pk)
+            counts.append(DefaultTenantModel.objects.filter(tenant=tenant).count())
+        return counts
+
+    def test_single_tenant(self):
+        self.assertEqual(
+            "Installed 2 object(s) into tenant {}\n".format(self.tenants[0].pk),
+            self.loaddata("--tenant", str(self.tenants[0].pk)),
+        )
+        self.assertEqual([2, 0, 0], self.loaded())
+
+    def test_fixtures_are_only_parsed_once(self):
+        loads = mock.Mock(wraps=json.loads)
+        with mock.patch.dict("occupation.management.commands.loaddata.PARSERS", {"json": loads}):
+            self.loaddata("--tenant", str(self.tenants[0].pk), "--tenant", str(self.tenants[2].pk))
+        self.assertEqual(1, loads.call_count)
+        self.assertEqual([2, 0, 2], self.loaded())
+
+    def test_all_tenants_in_parallel(self):
+        Tenant.objects.filter(pk=self.tenants[1].pk).update(is_active=False)
+        output = self.loaddata("--all-tenants", "--jobs", "2")
+        self.assertEqual(2, output.count("Installed 2 object(s)"))
+        self.assertEqual([2, 0, 2], self.loaded())
+
+    def test_tenant_keyword(self):
+        call_command("loaddata", "default_tenant", tenant=self.tenants[1].pk, stdout=StringIO())
+        self.assertEqual([0, 2, 0], self.loaded())
+
+    def test_sequences_are_not_moved_backwards(self):
+        self.tenants += self.build_tenants(20, start=3)
+        self.loaddata("--all-tenants", "--jobs", "4")
+        self.assertEqual([2] * len(self.tenants), self.loaded())
+        # The next key is past every tenant's rows.
+        activate_tenant(self.tenants[0].pk)
+        DefaultTenantModel.objects.create(tenant=self.tenants[0], name="new")
+
+    def test_no_tenant(self):
+        with self.assertRaises(Exception):
+            self.loaddata()
+
+
+class TestDumpData(TenantTransactionTestCase):
+    def setUp(self):
+        self.tenants = self.build_tenants(2)
+        self.parents = []
+        for tenant in self.tenants:
+            activate_tenant(tenant.pk)
+            parent = RestrictedModel.objects.create(tenant=tenant, name=tenant.name)
+            RestrictedChildModel.objects.create(parent=parent, name=tenant.name + "-child")
+            self.parents.append(parent)
+        activate_tenant("")
+
+    def dumpdata(self, *args):
+        stdout = StringIO()
+        call_command("dumpdata", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_json(self):
+        objects = json.loads(self.dumpdata("--tenant", str(self.tenants[0].pk)))
+        self.assertEqual(
+            [("tests.restrictedmodel", "0"), ("tests.restrictedchildmodel", "0-child")],
+            [(obj["model"], obj["fields"]["name"]) for obj in objects],
+        )
+        self.assertEqual("", get_active_tenant())
+
+    def test_copy(self):
+        output = self.dumpdata("--tenant", str(self.tenants[1].pk), "--copy", "tests.RestrictedModel")
+        self.assertEqual(
+            'COPY "tests_restrictedmodel" ("id", "tenant_id", "name") FROM stdin;\n'
+            "{}\t{}\t1\n"
+            "\\.\n\n".format(self.parents[1].pk, self.tenants[1].pk),
+            output,
+        )
+
+    def test_copy_inherited_model(self):
+        activate_tenant(self.tenants[0].pk)
+        programme = ProgrammeModel.objects.create(tenant=self.tenants[0], name="p", budget=5)
+        activate_tenant("")
+
+        output = self.dumpdata("--tenant", str(self.tenants[0].pk), "--copy", "tests.ProgrammeModel")
+        self.assertEqual(
+            'COPY "tests_programmemodel" ("projectmodel_ptr_id", "budget") FROM stdin;\n'
+            "{}\t5\n"
+            "\\.\n\n".format(programme.pk),
+            output,
+        )
+
+    def test_tenant_is_activated_on_the_database(self):
+        with mock.patch("occupation.management.commands.dumpdata.activate_tenant") as activate:
+            self.dumpdata("--tenant", str(self.tenants[0].pk), "--database", "default", "--copy")
+        activate.assert_any_call(str(self.tenants[0].pk), connection=connections["default"])
+
+    def test_all_tenants_need_an_output_pattern(self):
+        with self.assertRaises(CommandError):
+            self.dumpdata("--all-tenants")
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "{tenant}.json")
+            self.dumpdata("--all-tenants", "--output", output)
+            for tenant in self.tenants:
+                with open(output.format(tenant=tenant.pk)) as dump:
+                    self.assertEqual(
+                        [tenant.name, tenant.name + "-child"], [obj["fields"]["name"] for obj in json.load(dump)]
+                    )
@@ -1,6 +1,9 @@
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
 
+from occupation.context_processors import tenants
+from occupation.middleware import attach_tenant
 from occupation.utils import get_tenant_model
 
 Tenant = get_tenant_model()
@@ -47,3 +50,60 @@ class TestContextProcessor(TestCase):
         resp = self.client.get("/change/")
         self.assertEqual([], list(resp.context["visible_tenants"]))
         self.assertEqual([], list(resp.context["tenant_choices"]))
+
+    def test_tenants_are_fetched_once(self):
+        user = User.objects.create_user(**CREDENTIALS)
+        user.visible_tenants.add(*Tenant.objects.all())
+        self.client.login(**CREDENTIALS)
+        # The user, the activation, and then the tenants, used for both the choices and the list.
+        with self.assertNumQueries(3):
+            resp = self.client.get("/change/")
+        self.assertEqual(["a", "b", "c"], [name for pk, name in resp.context["tenant_choices"]])
+        self.assertEqual(["a", "b", "c"], [tenant.name for tenant in resp.context["visible_tenants"]])
+
+    def test_tenants_are_not_fetched_unless_used(self):
+        user = User.objects.create_user(**CREDENTIALS)
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = {}
+        with self.assertNumQueries(0):
+            context = tenants(request)
+        with self.assertNumQueries(1):
+            self.assertEqual([], list(context["tenant_choices"]))
+            self.assertEqual([], list(context["visible_tenants"]))
+
+    def test_active_tenant_is_not_fetched(self):
+        user = User.objects.create_user(**CREDENTIALS)
+        tenant = Tenant.objects.get(name="a")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = {}
+        attach_tenant(request, tenant.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(tenant.pk, tenants(request)["active_tenant"])
+        with self.assertNumQueries(1):
+            self.assertEqual("a", tenants(request)["tenant"].name)
+
+    @override_settings(OCCUPATION_CACHE="default")
+    def test_choices_are_read_from_cache(self):
+        cache.clear()
+        user = User.objects.create_user(**CREDENTIALS)
+        user.visible_tenants.add(*Tenant.objects.all())
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = {}
+        self.assertEqual(3, len(tenants(request)["tenant_choices"]))
+
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = {}
+        with self.assertNumQueries(0):
+            self.assertEqual(["a", "b", "c"], [name for pk, name in tenants(request)["tenant_choices"]])
+
+    @override_settings(OCCUPATION_TENANT_CHOICES_LIMIT=2)
+    def test_choices_are_limited(self):
+        user = User.objects.create_user(**CREDENTIALS)
+        user.visible_tenants.add(*Tenant.objects.all())
+        self.client.login(**CREDENTIALS)
+        resp = self.client.get("/change/")
+        self.assertEqual(["a", "b"], [name for pk, name in resp.context["tenant_choices"]])
@@ -1,7 +1,20 @@
+import json
 import unittest
+from unittest import mock
 
-from django.contrib.auth.models import User
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, override_settings
 
+from occupation.cache import invalidate_host_map
+from occupation.middleware import ActivateTenant, SelectTenant, make_tenant_token
+from occupation.utils import IS_SUPERUSER, USER_ID, aactivate_tenant, activate_tenant, get_requested_config
+
+from ..models import RestrictedModel
+from ..urls import echo_tenant
 from .base import Tenant, TenantTestCase
 
 CREDENTIALS = {"username": "test", "password": "test"}
@@ -116,3 +129,238 @@ class TestMiddleware(TenantTestCase):
 
         with self.assertNumQueries(1):
             self.client.get("/__change_tenant__/{}/".format(a.pk))
+
+
+class TestAsyncMiddleware(TenantTestCase):
+    async def test_middleware_activation(self):
+        a, b = await sync_to_async(self.build_tenants)(2)
+
+        user = await User.objects.acreate(username=CREDENTIALS["username"])
+        await sync_to_async(user.visible_tenants.add)(a, b)
+        await sync_to_async(self.async_client.force_login)(user)
+
+        await aactivate_tenant(a.pk)
+        await RestrictedModel.objects.abulk_create([RestrictedModel(tenant=a, name="a")])
+        await aactivate_tenant("")
+
+        response = await self.async_client.get("/__change_tenant__/{}/".format(a.pk))
+        self.assertEqual(200, response.status_code)
+
+        response = await self.async_client.get("/")
+        self.assertEqual(a.pk, int(response.content))
+
+        response = await self.async_client.get("/get/restrictedmodel/")
+        self.assertEqual([{"pk": mock.ANY, "name": "a"}], json.loads(response.content))
+
+        response = await self.async_client.get("/get/restrictedmodel/", headers={"X-Change-Tenant": str(b.pk)})
+        self.assertEqual([], json.loads(response.content))
+
+    async def test_anonymous_user_may_not_change_tenant(self):
+        a, _b = await sync_to_async(self.build_tenants)(2)
+
+        response = await self.async_client.get("/", headers={"X-Change-Tenant": str(a.pk)})
+        self.assertEqual(403, response.status_code)
+
+
+class TestRequestTenant(TenantTestCase):
+    def setUp(self):
+        self.a, self.b = self.build_tenants(2)
+        self.user = User.objects.create_user(**CREDENTIALS)
+        self.user.visible_tenants.add(self.a, self.b)
+        self.client.force_login(self.user)
+
+    def test_no_tenant(self):
+        response = self.client.get("/tenant/")
+        self.assertEqual(b"None", response.content)
+
+    def test_tenant_is_only_fetched_when_used(self):
+        self.client.get("/__change_tenant__/{}/".format(self.a.pk))
+        # The user, and the activation.
+        with self.assertNumQueries(2):
+            self.client.get("/")
+        # ... and the tenant.
+        with self.assertNumQueries(3):
+            response = self.client.get("/tenant/")
+        self.assertEqual(b"0", response.content)
+
+    @override_settings(OCCUPATION_TENANT_CACHE_SIZE=1)
+    def test_tenant_cache(self):
+        self.client.get("/__change_tenant__/{}/".format(self.a.pk))
+        self.client.get("/tenant/")
+        with self.assertNumQueries(2):
+            response = self.client.get("/tenant/")
+        self.assertEqual(b"0", response.content)
+
+        self.a.name = "renamed"
+        self.a.save()
+        response = self.client.get("/tenant/")
+        self.assertEqual(b"renamed", response.content)
+
+        # Only one tenant may be cached.
+        self.client.get("/__change_tenant__/{}/".format(self.b.pk))
+        self.client.get("/tenant/")
+        self.client.get("/__change_tenant__/{}/".format(self.a.pk))
+        with self.assertNumQueries(3):
+            self.client.get("/tenant/")
+
+
+class TestSuperuserActivation(TenantTestCase):
+    def activated(self, user):
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = SessionStore()
+        return ActivateTenant(lambda request: get_requested_config())(request)
+
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    def test_superuser_status_is_activated(self):
+        superuser = User.objects.create_superuser(**SU_CREDENTIALS)
+        config = self.activated(superuser)
+        self.assertEqual(str(superuser.pk), config[USER_ID])
+        self.assertEqual("true", config[IS_SUPERUSER])
+
+        self.assertEqual("", self.activated(User.objects.create_user(**CREDENTIALS))[IS_SUPERUSER])
+        self.assertEqual("", self.activated(AnonymousUser())[IS_SUPERUSER])
+
+
+@override_settings(OCCUPATION_TENANT_HEADER="HTTP_X_TENANT", OCCUPATION_TENANT_TOKEN_HEADER="HTTP_X_TENANT_TOKEN")
+class TestStatelessTenant(TenantTestCase):
+    def setUp(self):
+        self.a, self.b, self.c = self.build_tenants(3)
+        self.user = User.objects.create_user(**CREDENTIALS)
+        self.user.visible_tenants.add(self.a, self.b)
+
+    def get(self, **headers):
+        request = RequestFactory().get("/tenant/", **headers)
+        request.user = self.user
+        request.session = SessionStore()
+        response = SelectTenant(ActivateTenant(echo_tenant))(request)
+        self.assertFalse(request.session.accessed)
+        return response
+
+    def test_header_selects_tenant(self):
+        self.assertEqual(b"0", self.get(HTTP_X_TENANT=str(self.a.pk)).content)
+        self.assertEqual(b"1", self.get(HTTP_X_TENANT=str(self.b.pk)).content)
+        self.assertEqual(b"None", self.get(HTTP_X_TENANT="").content)
+        self.assertEqual(403, self.get(HTTP_X_TENANT=str(self.c.pk)).status_code)
+        self.assertEqual(403, self.get(HTTP_X_TENANT="foo").status_code)
+
+    def test_token_selects_tenant(self):
+        token = make_tenant_token(self.user, self.c.pk)
+        # The token has already been checked, so it does not need to be visible.
+        self.assertEqual(b"2", self.get(HTTP_X_TENANT_TOKEN=token).content)
+        self.assertEqual(403, self.get(HTTP_X_TENANT_TOKEN=token + "x").status_code)
+
+        other = User.objects.create_user(username="other")
+        token = make_tenant_token(other, self.a.pk)
+        self.assertEqual(403, self.get(HTTP_X_TENANT_TOKEN=token).status_code)
+
+    def test_tenant_is_activated(self):
+        activate_tenant(self.a.pk)
+        RestrictedModel.objects.create(tenant=self.a, name="a")
+        activate_tenant("")
+
+        self.client.force_login(self.user)
+        response = self.client.get("/get/restrictedmodel/", HTTP_X_TENANT=str(self.a.pk))
+        self.assertEqual([{"pk": mock.ANY, "name": "a"}], json.loads(response.content))
+        self.assertNotIn("active_tenant", self.client.session)
+
+        response = self.client.get("/get/restrictedmodel/")
+        self.assertEqual([], json.loads(response.content))
+
+    @override_settings(OCCUPATION_TENANT_TOKEN_MAX_AGE=-1)
+    def test_token_expires(self):
+        token = make_tenant_token(self.user, self.a.pk)
+        self.assertEqual(403, self.get(HTTP_X_TENANT_TOKEN=token).status_code)
+
+
+@override_settings(OCCUPATION_TENANT_HOST_FIELD="name", ALLOWED_HOSTS=[".example.com", "localhost"])
+class TestHostTenant(TenantTestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_host_map()
+        self.acme, self.initech, self.hooli = Tenant.objects.bulk_create(
+            [Tenant(name="acme"), Tenant(name="initech.example.com"), Tenant(name="hooli")]
+        )
+        self.user = User.objects.create_user(**CREDENTIALS)
+        self.user.visible_tenants.add(self.acme, self.initech)
+        self.client.force_login(self.user)
+
+    def test_host_selects_tenant(self):
+        response = self.client.get("/tenant/", HTTP_HOST="acme.example.com")
+        self.assertEqual(b"acme", response.content)
+        response = self.client.get("/tenant/", HTTP_HOST="initech.example.com:8000")
+        self.assertEqual(b"initech.example.com", response.content)
+        response = self.client.get("/tenant/", HTTP_HOST="localhost")
+        self.assertEqual(b"None", response.content)
+        self.assertNotIn("active_tenant", self.client.session)
+
+    @override_settings(OCCUPATION_CACHE="default")
+    def test_host_map_is_not_fetched_every_request(self):
+        self.client.get("/", HTTP_HOST="acme.example.com")
+        # The user, and the activation.
+        with self.assertNumQueries(2):
+            self.client.get("/", HTTP_HOST="acme.example.com")
+
+    def test_host_map_is_refreshed_when_tenant_changes(self):
+        self.client.get("/", HTTP_HOST="acme.example.com")
+        self.acme.name = "globex"
+        self.acme.save()
+        response = self.client.get("/tenant/", HTTP_HOST="globex.example.com")
+        self.assertEqual(b"globex", response.content)
+        response = self.client.get("/tenant/", HTTP_HOST="acme.example.com")
+        self.assertEqual(b"None", response.content)
+
+    def test_tenant_must_be_visible(self):
+        response = self.client.get("/tenant/", HTTP_HOST="hooli.example.com")
+        self.assertEqual(403, response.status_code)
+
+    def test_anonymous_user_has_no_tenant(self):
+        self.client.logout()
+        response = self.client.get("/tenant/", HTTP_HOST="acme.example.com")
+        self.assertEqual(b"None", response.content)
+
+
+class TestTenantSearch(TenantTestCase):
+    def setUp(self):
+        self.tenants = Tenant.objects.bulk_create([Tenant(name=name) for name in ("alpha", "alps", "amber", "beta")])
+        self.user = User.objects.create_user(**CREDENTIALS)
+        self.user.visible_tenants.add(*self.tenants[1:])
+        self.client.login(**CREDENTIALS)
+
+    def search(self, **params):
+        response = self.client.get("/__search_tenants__/", params)
+        self.assertEqual(200, response.status_code)
+        return response.json()
+
+    def test_anonymous_user_may_not_search(self):
+        self.client.logout()
+        self.assertEqual(403, self.client.get("/__search_tenants__/").status_code)
+
+    def test_only_visible_tenants_are_found(self):
+        self.assertEqual(
+            {"results": [{"id": str(self.tenants[1].pk), "text": "alps"}], "pagination": {"more": False}},
+            self.search(term="al"),
+        )
+        self.assertEqual(["alps", "amber", "beta"], [result["text"] for result in self.search()["results"]])
+
+    def test_name_is_indexed_for_prefix_search(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'occupation_tenant_name_like'")
+            self.assertIn("varchar_pattern_ops", cursor.fetchone()[0])
+
+    @override_settings(OCCUPATION_TENANT_SEARCH_PAGE_SIZE=2)
+    def test_results_are_paginated(self):
+        first = self.search(page=1)
+        self.assertEqual(["alps", "amber"], [result["text"] for result in first["results"]])
+        self.assertTrue(first["pagination"]["more"])
+
+        second = self.search(page=2)
+        self.assertEqual(["beta"], [result["text"] for result in second["results"]])
+        self.assertFalse(second["pagination"]["more"])
+
+    async def test_async_search(self):
+        await self.async_client.alogin(**CREDENTIALS)
+        response = await self.async_client.get("/__search_tenants__/", {"term": "b"})
+        self.assertEqual(["beta"], [result["text"] for result in response.json()["results"]])
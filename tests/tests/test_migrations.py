@@ -1,10 +1,53 @@
+import os
+import time
 import unittest
+from unittest import mock
 
 from django.apps import apps
-from django.db import ProgrammingError
-from django.test import TransactionTestCase
+from django.db import DatabaseError, ProgrammingError, connection, models
+from django.db.migrations.state import ModelState, ProjectState
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import isolate_apps
 
-from occupation.utils import disable_row_level_security, enable_row_level_security
+from occupation.operations import (
+    EnableRowLevelSecurity,
+    EnableRowLevelSecurityForApp,
+    EnableRowLevelSecurityForModels,
+    SetTenantDefault,
+    UpdateRowLevelSecurityPolicy,
+)
+from occupation.utils import (
+    INDEXES,
+    LEGACY_DIRECT_LINK,
+    activate_tenant,
+    create_missing_indexes,
+    denormalize_tenant,
+    disable_row_level_security,
+    drop_created_indexes,
+    enable_row_level_security,
+    get_fk_chain,
+    get_fk_chains,
+    get_missing_indexes,
+    get_policy_clauses,
+    get_policy_indexes,
+    get_tenant_distances,
+    normalize_tenant,
+    update_row_level_security_policy,
+)
+
+from ..models import (
+    HAS_DB_DEFAULT,
+    DefaultTenantModel,
+    MilestoneModel,
+    PartitionedModel,
+    ProgrammeModel,
+    ProjectModel,
+    RelatedModel,
+    RestrictedChildModel,
+    RestrictedModel,
+    TaskModel,
+)
+from .base import Tenant, TenantTransactionTestCase
 
 
 class TestMigrationOperations(TransactionTestCase):
@@ -29,10 +72,484 @@ class TestMigrationOperations(TransactionTestCase):
         with self.assertRaises(ProgrammingError):
             enable_row_level_security("tests", "RestrictedModel", apps)
 
-    @unittest.expectedFailure
     def test_enable_rls_with_superuser_policy(self):
         enable_row_level_security("tests", "RelatedModel", apps, superuser=True)
+        self.addCleanup(disable_row_level_security, "tests", "RelatedModel", apps, superuser=True)
+
+        self.addCleanup(activate_tenant, "", user_id="")
+        tenant = Tenant.objects.create(name="a")
+        activate_tenant(tenant.pk)
+        RelatedModel.objects.create(tenant=tenant, name="a")
+
+        activate_tenant("", user_id=1)
+        self.assertEqual(0, RelatedModel.objects.count())
+        activate_tenant("", user_id=1, is_superuser=True)
+        self.assertEqual(1, RelatedModel.objects.count())
 
-    @unittest.expectedFailure
     def test_disable_rls_with_superuser_policy(self):
-        disable_row_level_security("tests", "RestrictedModel", apps, superuser=True)
+        enable_row_level_security("tests", "RelatedModel", apps, superuser=True)
+        disable_row_level_security("tests", "RelatedModel", apps, superuser=True)
+        self.assertFalse(has_policy("tests_relatedmodel"))
+
+
+def has_policy(table_name):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_policies WHERE tablename = %s", [table_name])
+        return cursor.fetchone() is not None
+
+
+class TestEnableRowLevelSecurityOperations(TransactionTestCase):
+    state = mock.Mock(apps=apps)
+
+    def test_sql_is_collected(self):
+        operation = EnableRowLevelSecurityForModels(["RelatedModel", "DistinctModel"])
+        with self.assertRaises(Exception):
+            with connection.schema_editor(collect_sql=True) as editor:
+                operation.database_forwards("tests", editor, self.state, self.state)
+
+        operation = EnableRowLevelSecurity("RelatedModel", superuser=True)
+        with connection.schema_editor(collect_sql=True) as editor:
+            operation.database_forwards("tests", editor, self.state, self.state)
+        self.assertEqual(4, len(editor.collected_sql))
+        self.assertIn("CREATE POLICY access_tenant_data ON tests_relatedmodel", editor.collected_sql[2])
+        self.assertFalse(has_policy("tests_relatedmodel"))
+
+    def test_app_models(self):
+        operation = EnableRowLevelSecurityForApp(exclude=["RelatedModel"])
+        self.assertEqual(
+            [
+                RestrictedModel,
+                RestrictedChildModel,
+                PartitionedModel,
+                DefaultTenantModel,
+                ProjectModel,
+                ProgrammeModel,
+                TaskModel,
+                MilestoneModel,
+            ],
+            operation.get_models("tests", apps),
+        )
+
+    def test_app_models_exclude_proxy_and_unmanaged_models(self):
+        state = ProjectState.from_apps(apps)
+        state.add_model(ModelState("tests", "RestrictedProxyModel", [], {"proxy": True}, ("tests.restrictedmodel",)))
+        state.add_model(
+            ModelState(
+                "tests",
+                "UnmanagedModel",
+                [
+                    ("id", models.AutoField(primary_key=True)),
+                    ("tenant", models.ForeignKey("occupation.tenant", on_delete=models.CASCADE)),
+                ],
+                {"managed": False},
+            )
+        )
+        model_names = [model._meta.model_name for model in EnableRowLevelSecurityForApp().get_models("tests", state.apps)]
+        self.assertIn("restrictedmodel", model_names)
+        self.assertNotIn("restrictedproxymodel", model_names)
+        self.assertNotIn("unmanagedmodel", model_names)
+
+    def test_forwards_and_backwards(self):
+        operation = EnableRowLevelSecurityForApp(
+            exclude=[
+                "RestrictedModel",
+                "RestrictedChildModel",
+                "PartitionedModel",
+                "DefaultTenantModel",
+                "ProjectModel",
+                "ProgrammeModel",
+                "TaskModel",
+                "MilestoneModel",
+            ]
+        )
+        with connection.schema_editor() as editor:
+            operation.database_forwards("tests", editor, self.state, self.state)
+        self.assertTrue(has_policy("tests_relatedmodel"))
+
+        with connection.schema_editor() as editor:
+            operation.database_backwards("tests", editor, self.state, self.state)
+        self.assertFalse(has_policy("tests_relatedmodel"))
+
+    def test_rolled_back_as_a_unit(self):
+        operation = EnableRowLevelSecurityForModels(["RelatedModel", "RestrictedModel"])
+        with self.assertRaises(ProgrammingError):
+            with connection.schema_editor() as editor:
+                operation.database_forwards("tests", editor, self.state, self.state)
+        self.assertFalse(has_policy("tests_relatedmodel"))
+
+
+def get_indexes(table_name):
+    with connection.cursor() as cursor:
+        cursor.execute(INDEXES, [table_name])
+        return [columns for (columns,) in cursor.fetchall()]
+
+
+class TestPolicyIndexes(TransactionTestCase):
+    def setUp(self):
+        # Django creates an index for the FK: we need to see what happens without it.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'tests_relatedmodel' AND indexdef LIKE '%(tenant_id%'"
+            )
+            for (index_name,) in cursor.fetchall():
+                cursor.execute("DROP INDEX {}".format(index_name))
+        self.addCleanup(create_missing_indexes, [("tests_relatedmodel", ["tenant_id"])])
+
+    def enable(self, **kwargs):
+        enable_row_level_security("tests", "RelatedModel", apps, **kwargs)
+        self.addCleanup(disable_row_level_security, "tests", "RelatedModel", apps)
+
+    def test_unindexed_predicate_is_reported(self):
+        with self.assertLogs("occupation.utils", "WARNING") as logs:
+            self.enable()
+        self.assertIn("tests_relatedmodel (tenant_id)", logs.output[0])
+        self.assertNotIn(["tenant_id"], get_indexes("tests_relatedmodel"))
+
+    def test_missing_index_is_created(self):
+        with self.assertNoLogs("occupation.utils", "WARNING"):
+            self.enable(create_indexes=True)
+        self.assertIn(["tenant_id"], get_indexes("tests_relatedmodel"))
+
+    def test_created_indexes_are_dropped_when_reversed(self):
+        state = mock.Mock(apps=apps)
+        operation = EnableRowLevelSecurity("RelatedModel", create_indexes=True)
+        with connection.schema_editor() as editor:
+            operation.database_forwards("tests", editor, state, state)
+        self.assertIn(["tenant_id"], get_indexes("tests_relatedmodel"))
+
+        with connection.schema_editor() as editor:
+            operation.database_backwards("tests", editor, state, state)
+        self.assertFalse(has_policy("tests_relatedmodel"))
+        self.assertNotIn(["tenant_id"], get_indexes("tests_relatedmodel"))
+
+        # Indexes we did not create are left alone.
+        indexes = get_indexes("tests_restrictedchildmodel")
+        drop_created_indexes(get_policy_indexes(RestrictedChildModel, Tenant))
+        self.assertEqual(indexes, get_indexes("tests_restrictedchildmodel"))
+
+    def test_composite_index_is_created(self):
+        self.enable(create_indexes=True, composite_index=True)
+        self.assertIn(["tenant_id", "id"], get_indexes("tests_relatedmodel"))
+
+    def test_indirect_link_indexes(self):
+        self.assertEqual(
+            [("tests_restrictedchildmodel", ["parent_id"]), ("tests_restrictedmodel", ["id"])],
+            get_policy_indexes(RestrictedChildModel, Tenant),
+        )
+        self.assertEqual([], get_missing_indexes(get_policy_indexes(RestrictedChildModel, Tenant)))
+
+
+@isolate_apps("tests")
+class TestForeignKeyGraph(SimpleTestCase):
+    def setUp(self):
+        class Tenant(models.Model):
+            pass
+
+        class Customer(models.Model):
+            tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE)
+            referrer = models.ForeignKey("self", null=True, on_delete=models.CASCADE)
+            account = models.ForeignKey("Account", null=True, on_delete=models.CASCADE)
+
+        class Account(models.Model):
+            customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+
+        class Order(models.Model):
+            account = models.ForeignKey(Account, on_delete=models.CASCADE)
+            customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+
+        class Orphan(models.Model):
+            parent = models.ForeignKey("self", null=True, on_delete=models.CASCADE)
+
+        self.Tenant, self.Customer, self.Account, self.Order, self.Orphan = Tenant, Customer, Account, Order, Orphan
+
+    def test_distances(self):
+        self.assertEqual(
+            {"tests.tenant": 0, "tests.customer": 1, "tests.account": 2, "tests.order": 2},
+            get_tenant_distances(self.Tenant),
+        )
+
+    def test_graph_is_only_built_once(self):
+        distances = get_tenant_distances(self.Tenant)
+        self.assertIs(distances, get_tenant_distances(self.Tenant))
+
+        class Invoice(models.Model):
+            order = models.ForeignKey(self.Order, on_delete=models.CASCADE)
+
+        self.assertEqual(3, get_tenant_distances(self.Tenant)["tests.invoice"])
+
+    def test_shortest_chain(self):
+        self.assertEqual(["customer", "tenant"], [field.name for field in get_fk_chain(self.Order, self.Tenant)])
+        self.assertEqual([], get_fk_chain(self.Orphan, self.Tenant))
+
+    def test_chains_do_not_lead_back_through_the_model(self):
+        self.assertEqual(
+            [["tenant"]],
+            [[field.name for field in chain] for chain in get_fk_chains(self.Customer, self.Tenant)],
+        )
+        self.assertEqual([], list(get_fk_chains(self.Orphan, self.Tenant)))
+
+    def test_policy_clauses_are_in_field_order(self):
+        clauses = get_policy_clauses(self.Order, self.Tenant)
+        self.assertEqual(2, len(clauses))
+        self.assertIn("tests_order.account_id = tests_account.id", clauses[0])
+        self.assertIn("tests_order.customer_id = tests_customer.id", clauses[1])
+
+    def test_inherited_fields_are_not_in_the_policy(self):
+        class Subscriber(self.Customer):
+            pass
+
+        self.assertEqual(
+            [["customer_ptr", "tenant"]],
+            [[field.name for field in chain] for chain in get_fk_chains(Subscriber, self.Tenant)],
+        )
+        self.assertEqual(
+            ["EXISTS (SELECT 1 FROM tests_customer WHERE tests_subscriber.customer_ptr_id = tests_customer.id)"],
+            get_policy_clauses(Subscriber, self.Tenant),
+        )
+
+    def test_sibling_tenant_models_are_checked(self):
+        class Invoice(models.Model):
+            tenant = models.ForeignKey(self.Tenant, on_delete=models.CASCADE)
+            customer = models.ForeignKey(self.Customer, on_delete=models.CASCADE)
+
+        clauses = get_policy_clauses(Invoice, self.Tenant)
+        self.assertEqual(2, len(clauses))
+        self.assertIn("tests_invoice.customer_id = tests_customer.id", clauses[1])
+
+
+def get_policy(table_name):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT qual FROM pg_policies WHERE tablename = %s AND policyname = 'access_tenant_data'", [table_name]
+        )
+        return cursor.fetchone()[0]
+
+
+class TestPolicy(TenantTransactionTestCase):
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    def plan(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("EXPLAIN SELECT * FROM tests_restrictedmodel")
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            cursor.execute("RESET enable_seqscan")
+        return plan
+
+    def test_cross_tenant_fk_is_rejected(self):
+        a, b = self.build_tenants(2)
+        activate_tenant(a.pk)
+        project = ProjectModel.objects.create(tenant=a, name="a")
+        MilestoneModel.objects.create(tenant=a, project=project, name="a")
+
+        activate_tenant(b.pk)
+        with self.assertRaises(DatabaseError):
+            MilestoneModel.objects.create(tenant=b, project=project, name="b")
+
+    def test_self_referencing_model(self):
+        update_row_level_security_policy("tests", "ProjectModel")
+        self.assertNotIn("parent_id", get_policy("tests_projectmodel"))
+
+        a, b = self.build_tenants(2)
+        for tenant in (a, b):
+            activate_tenant(tenant.pk)
+            parent = ProjectModel.objects.create(tenant=tenant, name=tenant.name)
+            ProjectModel.objects.create(tenant=tenant, name=tenant.name + "-child", parent=parent)
+
+        self.assertEqual(
+            [("1", None), ("1-child", "1")],
+            [(project.name, project.parent and project.parent.name) for project in ProjectModel.objects.order_by("name")],
+        )
+
+    def test_policy_does_not_cast_column(self):
+        policy = get_policy("tests_restrictedmodel")
+        self.assertIn("occupation_active_tenant()", policy)
+        self.assertNotIn("(tenant_id)::text", policy)
+
+    def test_policy_can_use_index(self):
+        activate_tenant(Tenant.objects.create(name="a").pk)
+        self.assertIn("Index", self.plan())
+
+        update_row_level_security_policy("tests", "RestrictedModel", apps, direct_link=LEGACY_DIRECT_LINK)
+        self.addCleanup(update_row_level_security_policy, "tests", "RestrictedModel", apps)
+        self.assertNotIn("Index", self.plan())
+
+    def test_no_active_tenant(self):
+        self.assertEqual(0, RestrictedModel.objects.count())
+
+    def test_update_policy_operation(self):
+        operation = UpdateRowLevelSecurityPolicy("RestrictedModel")
+        state = mock.Mock(apps=apps)
+        policy = get_policy("tests_restrictedmodel")
+
+        with connection.schema_editor() as editor:
+            operation.database_backwards("tests", editor, state, state)
+        self.addCleanup(update_row_level_security_policy, "tests", "RestrictedModel", apps)
+        self.assertIn("(tenant_id)::text", get_policy("tests_restrictedmodel"))
+
+        with connection.schema_editor() as editor:
+            operation.database_forwards("tests", editor, state, state)
+        self.assertEqual(policy, get_policy("tests_restrictedmodel"))
+
+    def test_update_policy_operation_sql(self):
+        operation = UpdateRowLevelSecurityPolicy("RestrictedModel")
+        state = mock.Mock(apps=apps)
+        policy = get_policy("tests_restrictedmodel")
+
+        with connection.schema_editor(collect_sql=True) as editor:
+            operation.database_forwards("tests", editor, state, state)
+            operation.database_backwards("tests", editor, state, state)
+
+        self.assertEqual(2, len(editor.collected_sql))
+        self.assertTrue(editor.collected_sql[0].startswith("ALTER POLICY access_tenant_data ON tests_restrictedmodel"))
+        self.assertIn("current_setting('occupation.active_tenant')", editor.collected_sql[1])
+        # Only the SQL was collected: the policy is unchanged.
+        self.assertEqual(policy, get_policy("tests_restrictedmodel"))
+
+
+class TestDenormalizeTenant(TenantTransactionTestCase):
+    def setUp(self):
+        self.tenants = self.build_tenants(2)
+        self.parents = []
+        for tenant in self.tenants:
+            activate_tenant(tenant.pk)
+            parent = RestrictedModel.objects.create(tenant=tenant, name=tenant.name)
+            RestrictedChildModel.objects.bulk_create(
+                [RestrictedChildModel(parent=parent, name=str(i)) for i in range(3)]
+            )
+            self.parents.append(parent)
+        activate_tenant("")
+
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    def denormalize(self, **kwargs):
+        denormalize_tenant("tests", "RestrictedChildModel", apps, **kwargs)
+        self.addCleanup(normalize_tenant, "tests", "RestrictedChildModel", apps)
+
+    def tenant_ids(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, tenant_id FROM tests_restrictedchildmodel ORDER BY name")
+            return cursor.fetchall()
+
+    def test_existing_rows_are_backfilled(self):
+        self.denormalize(batch_size=2)
+        self.assertNotIn("EXISTS", get_policy("tests_restrictedchildmodel"))
+
+        for tenant in self.tenants:
+            activate_tenant(tenant.pk)
+            self.assertEqual([(str(i), tenant.pk) for i in range(3)], self.tenant_ids())
+
+    def test_trigger_sets_tenant(self):
+        self.denormalize()
+        activate_tenant(self.tenants[0].pk)
+        RestrictedChildModel.objects.create(parent=self.parents[0], name="new")
+        self.assertEqual(4, RestrictedChildModel.objects.count())
+        self.assertIn(("new", self.tenants[0].pk), self.tenant_ids())
+
+    def test_rls_is_forced_after_backfill(self):
+        self.denormalize()
+        self.assertEqual(0, RestrictedChildModel.objects.count())
+
+    def test_rls_is_forced_after_failed_backfill(self):
+        self.addCleanup(normalize_tenant, "tests", "RestrictedChildModel", apps)
+        with self.assertRaises(DatabaseError):
+            denormalize_tenant("tests", "RestrictedChildModel", apps, batch_size=-1)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname FROM pg_class WHERE relname IN ('tests_restrictedmodel', 'tests_restrictedchildmodel') "
+                "AND NOT relforcerowsecurity"
+            )
+            self.assertEqual([], cursor.fetchall())
+        self.assertEqual(0, RestrictedChildModel.objects.count())
+
+    def test_normalize_restores_policy(self):
+        policy = get_policy("tests_restrictedchildmodel")
+        denormalize_tenant("tests", "RestrictedChildModel", apps)
+        normalize_tenant("tests", "RestrictedChildModel", apps)
+        self.assertEqual(policy, get_policy("tests_restrictedchildmodel"))
+
+    def test_directly_linked_model_is_rejected(self):
+        with self.assertRaises(Exception):
+            denormalize_tenant("tests", "RestrictedModel", apps)
+
+    @unittest.skipUnless(os.environ.get("BENCHMARK"), "Set BENCHMARK=1 to compare policies")
+    def test_benchmark(self):
+        activate_tenant(self.tenants[1].pk)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO tests_restrictedchildmodel (parent_id, name) SELECT %s, 'x' FROM generate_series(1, 200000)",
+                [self.parents[1].pk],
+            )
+            cursor.execute("ANALYZE tests_restrictedchildmodel")
+
+        activate_tenant(self.tenants[0].pk)
+
+        def timing():
+            start = time.perf_counter()
+            for _i in range(10):
+                self.assertEqual(3, RestrictedChildModel.objects.count())
+            return time.perf_counter() - start
+
+        indirect = timing()
+        self.denormalize()
+        direct = timing()
+        self.assertLess(direct, indirect, "indirect policy: {:.3f}s, direct policy: {:.3f}s".format(indirect, direct))
+
+
+class TestTenantDefault(TransactionTestCase):
+    state = mock.Mock(apps=apps)
+
+    def setUp(self):
+        self.tenant = Tenant.objects.create(name="a")
+
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    @unittest.skipUnless(HAS_DB_DEFAULT, "Field.db_default needs Django 5.0")
+    def test_bulk_create_leaves_tenant_out(self):
+        activate_tenant(self.tenant.pk)
+        objects = DefaultTenantModel.objects.bulk_create([DefaultTenantModel(name=name) for name in "ab"])
+        self.assertEqual([self.tenant.pk, self.tenant.pk], [obj.tenant_id for obj in objects])
+        self.assertEqual(2, DefaultTenantModel.objects.filter(tenant=self.tenant).count())
+
+    def test_no_active_tenant(self):
+        with self.assertRaises(DatabaseError):
+            DefaultTenantModel.objects.create(name="a")
+
+    def test_raw_insert_leaves_tenant_out(self):
+        activate_tenant(self.tenant.pk)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO tests_defaulttenantmodel (name) VALUES ('a')")
+        self.assertEqual(self.tenant, DefaultTenantModel.objects.get().tenant)
+
+    def test_sql_is_collected(self):
+        with connection.schema_editor(collect_sql=True) as editor:
+            SetTenantDefault("RestrictedModel").database_forwards("tests", editor, self.state, self.state)
+        self.assertEqual(
+            ["ALTER TABLE tests_restrictedmodel ALTER COLUMN tenant_id SET DEFAULT occupation_active_tenant()::integer;"],
+            editor.collected_sql,
+        )
+
+    def test_operation(self):
+        operation = SetTenantDefault("RestrictedModel")
+        with connection.schema_editor() as editor:
+            operation.database_forwards("tests", editor, self.state, self.state)
+
+        activate_tenant(self.tenant.pk)
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO tests_restrictedmodel (name) VALUES ('a')")
+        self.assertEqual(self.tenant, RestrictedModel.objects.get().tenant)
+
+        with connection.schema_editor() as editor:
+            operation.database_backwards("tests", editor, self.state, self.state)
+        with self.assertRaises(DatabaseError):
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO tests_restrictedmodel (name) VALUES ('b')")
+
+    def test_model_without_tenant_fk_is_rejected(self):
+        with self.assertRaises(Exception):
+            with connection.schema_editor(collect_sql=True) as editor:
+                SetTenantDefault("RestrictedChildModel").database_forwards("tests", editor, self.state, self.state)
@@ -0,0 +1,123 @@
+from unittest import mock
+
+from django.apps import apps
+from django.db import connection
+
+from occupation.operations import PartitionByTenant
+from occupation.partitioning import create_tenant_partitions, partition_table, unpartition_table
+from occupation.utils import activate_tenant
+
+from ..models import PartitionedModel
+from .base import TenantTransactionTestCase
+
+
+def partitions():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT inhrelid::regclass::TEXT FROM pg_inherits WHERE inhparent = 'tests_partitionedmodel'::regclass")
+        return sorted(partition for (partition,) in cursor.fetchall())
+
+
+def rows_by_partition():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT tableoid::regclass::TEXT, name FROM tests_partitionedmodel ORDER BY name")
+        return cursor.fetchall()
+
+
+class TestPartitioning(TenantTransactionTestCase):
+    def setUp(self):
+        self.a, self.b, self.c = self.build_tenants(3)
+        for tenant, prefix in zip((self.a, self.b), "ab"):
+            activate_tenant(tenant.pk)
+            PartitionedModel.objects.bulk_create(
+                [PartitionedModel(tenant=tenant, name="{}{}".format(prefix, i)) for i in range(3)]
+            )
+
+    def tearDown(self):
+        activate_tenant("", user_id="")
+
+    def partition(self, **kwargs):
+        partition_table("tests", "PartitionedModel", apps, batch_size=2, **kwargs)
+        self.addCleanup(unpartition_table, "tests", "PartitionedModel", apps)
+
+    def test_list_partitions(self):
+        self.partition(tenants=[self.a.pk])
+        self.assertEqual(
+            ["tests_partitionedmodel_default", "tests_partitionedmodel_tenant_{}".format(self.a.pk)], partitions()
+        )
+
+        activate_tenant(self.a.pk)
+        self.assertEqual(
+            [("tests_partitionedmodel_tenant_{}".format(self.a.pk), "a{}".format(i)) for i in range(3)],
+            rows_by_partition(),
+        )
+        # The pk sequence carries on from the copied rows.
+        obj = PartitionedModel.objects.create(tenant=self.a, name="a3")
+        self.assertEqual(4, PartitionedModel.objects.filter(pk__lte=obj.pk).count())
+
+        activate_tenant(self.b.pk)
+        self.assertEqual(["b0", "b1", "b2"], [name for (_partition, name) in rows_by_partition()])
+
+        # Rows can't be seen through the partitions themselves.
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM tests_partitionedmodel_default")
+            self.assertEqual((0,), cursor.fetchone())
+
+    def test_tenant_partition_is_created(self):
+        self.partition(tenants=[self.a.pk])
+        create_tenant_partitions(self.c.pk)
+
+        activate_tenant(self.c.pk)
+        PartitionedModel.objects.create(tenant=self.c, name="c0")
+        self.assertEqual([("tests_partitionedmodel_tenant_{}".format(self.c.pk), "c0")], rows_by_partition())
+
+    def test_hash_partitions(self):
+        self.partition(method="hash", modulus=2)
+        self.assertEqual(["tests_partitionedmodel_p0", "tests_partitionedmodel_p1"], partitions())
+
+        activate_tenant(self.b.pk)
+        self.assertEqual(["b0", "b1", "b2"], list(PartitionedModel.objects.values_list("name", flat=True)))
+
+    def test_operation_is_reversible(self):
+        operation = PartitionByTenant("PartitionedModel", method="hash", modulus=2)
+        state = mock.Mock(apps=apps)
+        operation.database_forwards("tests", None, state, state)
+        operation.database_backwards("tests", None, state, state)
+
+        self.assertEqual([], partitions())
+        activate_tenant(self.a.pk)
+        self.assertEqual(3, PartitionedModel.objects.count())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = 'tests_partitionedmodel'")
+            self.assertEqual(4, len(cursor.fetchall()))
+
+    def test_partition_names_are_quoted(self):
+        # Partitioning on another column, whose values (like UUIDs) are not valid identifiers.
+        self.partition(tenants=["x-y"], column="name")
+        self.assertEqual(['"tests_partitionedmodel_tenant_x-y"', "tests_partitionedmodel_default"], partitions())
+
+    def test_generated_columns_are_not_copied(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE tests_partitionedmodel ADD COLUMN name_length INTEGER GENERATED ALWAYS AS (length(name)) STORED"
+            )
+        self.addCleanup(self.drop_name_length)
+        self.partition(method="hash", modulus=2)
+
+        activate_tenant(self.a.pk)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, name_length FROM tests_partitionedmodel ORDER BY name")
+            self.assertEqual([("a0", 2), ("a1", 2), ("a2", 2)], cursor.fetchall())
+
+    def drop_name_length(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE tests_partitionedmodel DROP COLUMN name_length")
+
+    def test_referenced_table_is_rejected(self):
+        with self.assertRaises(Exception) as exc:
+            partition_table("tests", "RestrictedModel", apps)
+        self.assertIn("tests_restrictedchildmodel", str(exc.exception))
+
+    def test_unique_index_without_tenant_is_rejected(self):
+        with self.assertRaises(Exception) as exc:
+            partition_table("tests", "RelatedModel", apps)
+        self.assertIn("Unique indexes must include tenant_id", str(exc.exception))
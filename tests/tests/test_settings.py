@@ -14,6 +14,8 @@ class TestSettings(TestCase):
         self.assertEqual([], apps.check_middleware_installed_correctly())
         self.assertEqual([], apps.check_context_processor_installed())
         self.assertEqual([], apps.check_installed_before_admin())
+        self.assertEqual([], apps.check_activation_mode())
+        self.assertEqual([], apps.check_tenant_host_field())
 
     @modify_settings(MIDDLEWARE={"remove": apps.MIDDLEWARE})
     def test_middleware_missing(self):
@@ -94,7 +96,21 @@ class TestSettings(TestCase):
 
     @modify_settings()
     def test_role_can_bypass_rls(self):
+        user = settings.DATABASES["default"]["USER"]
         settings.DATABASES["default"]["USER"] = os.environ["USER"]
+        self.addCleanup(settings.DATABASES["default"].__setitem__, "USER", user)
         errors = apps.check_database_role_does_not_bypass_rls()
         self.assertEqual(1, len(errors))
         self.assertEqual("occupation.E005", errors[0].id)
+
+    @override_settings(OCCUPATION_ACTIVATION_MODE="sometimes")
+    def test_unknown_activation_mode(self):
+        errors = apps.check_activation_mode()
+        self.assertEqual(1, len(errors))
+        self.assertEqual("occupation.E006", errors[0].id)
+
+    @override_settings(OCCUPATION_TENANT_HOST_FIELD="domain")
+    def test_unknown_tenant_host_field(self):
+        errors = apps.check_tenant_host_field()
+        self.assertEqual(1, len(errors))
+        self.assertEqual("occupation.E007", errors[0].id)
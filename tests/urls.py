@@ -17,6 +17,10 @@ def echo_schema(request):
     return HttpResponse("{0!s}".format(request.session.get("active_tenant")) + data)
 
 
+def echo_tenant(request):
+    return HttpResponse("{0!s}".format(request.tenant and request.tenant.name))
+
+
 def change_schema_view(request):
     return render(request, "occupation/change_tenant.html", {})
 
@@ -41,6 +45,7 @@ def get_object(request, model, pk):
 
 urlpatterns = [
     path("", echo_schema),
+    path("tenant/", echo_tenant),
     path("sql/", sql_injection),
     path("change/", change_schema_view),
     path("get/<model>/", get_list),